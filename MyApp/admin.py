@@ -2,9 +2,9 @@
 from django.contrib import admin
 from .models import (
     # Your existing models
-    Marker, UserLocation, Task, Location,
+    Marker, MarkerChange, UserLocation, LocationTrack, Task, Location,
     # New location/friends models
-    UserProfile, Friendship, ProximityAlert, ProximityNotification
+    UserProfile, Friendship, ProximityAlert, ProximityNotification, Geofence, GeofenceEvent
 )
 
 # Your existing models admin
@@ -15,6 +15,12 @@ class MarkerAdmin(admin.ModelAdmin):
     search_fields = ('title', 'description')
     readonly_fields = ('created_at',)
 
+@admin.register(MarkerChange)
+class MarkerChangeAdmin(admin.ModelAdmin):
+    list_display = ('id', 'action', 'marker_id', 'created_at')
+    list_filter = ('action', 'created_at')
+    readonly_fields = ('marker_id', 'action', 'created_at')
+
 @admin.register(UserLocation)
 class UserLocationAdmin(admin.ModelAdmin):
     list_display = ('user', 'latitude', 'longitude', 'accuracy_m', 'captured_at')
@@ -22,6 +28,13 @@ class UserLocationAdmin(admin.ModelAdmin):
     search_fields = ('user__username',)
     readonly_fields = ('captured_at',)
 
+@admin.register(LocationTrack)
+class LocationTrackAdmin(admin.ModelAdmin):
+    list_display = ('user', 'day', 'point_count', 'raw_count', 'compacted_at')
+    list_filter = ('day',)
+    search_fields = ('user__username',)
+    readonly_fields = ('points', 'compacted_at')
+
 @admin.register(Task)
 class TaskAdmin(admin.ModelAdmin):
     list_display = ('user', 'title', 'start_time', 'end_time', 'is_snoozed')
@@ -68,4 +81,18 @@ class ProximityNotificationAdmin(admin.ModelAdmin):
         self.message_user(request, f'{updated} notifications marked as read.')
     mark_as_read.short_description = 'Mark selected notifications as read'
     
-    actions = ['mark_as_read']
\ No newline at end of file
+    actions = ['mark_as_read']
+
+@admin.register(Geofence)
+class GeofenceAdmin(admin.ModelAdmin):
+    list_display = ('user', 'name', 'shape', 'radius_m', 'dwell_seconds', 'is_active', 'entered_at')
+    list_filter = ('shape', 'is_active')
+    search_fields = ('user__username', 'name')
+    readonly_fields = ('entered_at', 'dwell_sent', 'created_at')
+
+@admin.register(GeofenceEvent)
+class GeofenceEventAdmin(admin.ModelAdmin):
+    list_display = ('user', 'geofence', 'event', 'occurred_at', 'is_read')
+    list_filter = ('event', 'is_read', 'occurred_at')
+    search_fields = ('user__username', 'geofence__name')
+    readonly_fields = ('occurred_at', 'created_at')
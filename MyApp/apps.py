@@ -4,3 +4,8 @@ from django.apps import AppConfig
 class MyappConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'MyApp'
+
+    def ready(self):
+        from . import signals  # noqa: F401  Connects the location_moved receiver
+        from .location_buffer import flush_on_exit, location_buffer
+        flush_on_exit(location_buffer)
@@ -0,0 +1,107 @@
+# bulk_delete.py - Clear the marker table in small primary-key ranges
+import logging
+import threading
+import time
+import uuid
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connections, transaction
+from django.db.models import Max, Min
+from django.utils import timezone
+
+from .marker_io import markers_replaced
+from .models import Marker, MarkerChange
+
+logger = logging.getLogger(__name__)
+
+CLEAR_CHUNK_SIZE = 2000  # Primary keys per DELETE
+CLEAR_PAUSE = 0.01  # Seconds between chunks so other writers can take the lock
+CLEAR_LOCK_TIMEOUT = 10 * 60  # Refreshed every chunk; frees the lock if the process dies
+CLEAR_STATUS_TIMEOUT = 24 * 60 * 60
+
+LOCK_KEY = 'clear-markers:lock'
+STATUS_KEY = 'clear-markers:status'
+
+
+class ClearInProgress(Exception):
+    """Another clear is still running"""
+
+
+def clear_status():
+    """Progress of the current or last clear, or None if none has run"""
+    return cache.get(STATUS_KEY)
+
+
+def start_clear():
+    """Start deleting every existing marker and return the initial status
+
+    Markers are deleted in ranges of CLEAR_CHUNK_SIZE primary keys, each in its
+    own short transaction, so writers such as update_location only ever wait
+    for one chunk. Markers added after the clear started are kept. Runs in a
+    daemon thread unless MARKER_CLEAR_IN_BACKGROUND is False.
+    """
+    job_id = uuid.uuid4().hex
+    if not cache.add(LOCK_KEY, job_id, CLEAR_LOCK_TIMEOUT):
+        raise ClearInProgress()
+
+    try:
+        bounds = Marker.objects.aggregate(first=Min('id'), last=Max('id'))
+        status = {
+            'id': job_id,
+            'state': 'running',
+            'deleted': 0,
+            'total': Marker.objects.count(),
+            'first_id': bounds['first'],
+            'last_id': bounds['last'],
+            'next_id': bounds['first'],
+            'started_at': timezone.now().isoformat(),
+            'finished_at': None,
+            'error': None,
+        }
+        cache.set(STATUS_KEY, status, CLEAR_STATUS_TIMEOUT)
+    except Exception:
+        cache.delete(LOCK_KEY)
+        raise
+
+    if getattr(settings, 'MARKER_CLEAR_IN_BACKGROUND', True):
+        threading.Thread(target=_run, args=(status,), name='clear-markers', daemon=True).start()
+    else:
+        _run(status)
+    return clear_status()
+
+
+def _run(status):
+    try:
+        _delete_ranges(status)
+        with transaction.atomic():
+            MarkerChange.record_clear()
+        status['state'] = 'done'
+    except Exception as e:
+        logger.exception('Clearing markers failed')
+        status['state'] = 'failed'
+        status['error'] = str(e)
+    finally:
+        status['finished_at'] = timezone.now().isoformat()
+        cache.set(STATUS_KEY, status, CLEAR_STATUS_TIMEOUT)
+        cache.delete(LOCK_KEY)
+        markers_replaced()
+        if threading.current_thread() is not threading.main_thread():
+            connections.close_all()
+
+
+def _delete_ranges(status):
+    if status['first_id'] is None:
+        return
+    while status['next_id'] <= status['last_id']:
+        # Each range spans CLEAR_CHUNK_SIZE existing rows however sparse the ids are
+        start = status['next_id']
+        ids = Marker.objects.filter(id__gte=start, id__lte=status['last_id']).order_by('id').values_list('id', flat=True)
+        end = next(iter(ids[CLEAR_CHUNK_SIZE:CLEAR_CHUNK_SIZE + 1]), status['last_id'] + 1)
+        with transaction.atomic():
+            deleted, _ = Marker.objects.filter(id__gte=start, id__lt=end).delete_unlogged()
+        status['deleted'] += deleted
+        status['next_id'] = end
+        cache.set(STATUS_KEY, status, CLEAR_STATUS_TIMEOUT)
+        cache.touch(LOCK_KEY, CLEAR_LOCK_TIMEOUT)
+        time.sleep(CLEAR_PAUSE)
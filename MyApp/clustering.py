@@ -0,0 +1,268 @@
+# clustering.py - Per-zoom marker cluster aggregates for the map
+import math
+import threading
+
+import numpy as np
+
+from .models import MarkerChange
+from .spatial import split_bbox
+
+MAX_CLUSTER_ZOOM = 16
+CELL_SHIFT = 2  # Grid cells are 256 / 2**CELL_SHIFT = 64 px wide at every zoom
+CLUSTER_RADIUS_PX = 60
+MAX_CLUSTERS = 2000
+MAX_QUERY_CELLS = 128  # Grid cells per side of a query, an 8192 px viewport; wider boxes are cut to their middle
+DELTA_MAX = 4096  # Pending updates per zoom before they are merged into the arrays
+MAX_MERCATOR_LAT = 85.05112878
+
+
+def mercator(lats, lngs):
+    """Project degrees to Web Mercator world coordinates in [0, 1)"""
+    lats = np.clip(np.asarray(lats, dtype=np.float64), -MAX_MERCATOR_LAT, MAX_MERCATOR_LAT)
+    lngs = np.asarray(lngs, dtype=np.float64)
+    x = (lngs + 180.0) / 360.0
+    sin_lat = np.sin(np.radians(lats))
+    y = 0.5 - np.log((1 + sin_lat) / (1 - sin_lat)) / (4 * math.pi)
+    return np.clip(x, 0, 1 - 1e-12), np.clip(y, 0, 1 - 1e-12)
+
+
+def unproject(x, y):
+    """Inverse of mercator() for a single point"""
+    lng = x * 360.0 - 180.0
+    lat = math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * y))))
+    return lat, lng
+
+
+def grid_size(zoom):
+    return 1 << (zoom + CELL_SHIFT)
+
+
+def cell_keys(x, y, zoom):
+    """Pack grid (column, row) pairs into sortable int64 keys, column-major"""
+    n = grid_size(zoom)
+    columns = (np.asarray(x) * n).astype(np.int64)
+    rows = (np.asarray(y) * n).astype(np.int64)
+    return (columns << 32) | rows
+
+
+class ZoomLevel:
+    """Sorted cell aggregates for one zoom plus a dict of not-yet-merged changes"""
+
+    def __init__(self, keys, counts, sum_x, sum_y, sum_id):
+        self.keys, self.counts = keys, counts
+        self.sum_x, self.sum_y, self.sum_id = sum_x, sum_y, sum_id
+        self.delta = {}
+
+    @classmethod
+    def aggregate(cls, keys, counts, sum_x, sum_y, sum_id):
+        """Sum rows sharing a key and drop empty cells"""
+        unique, inverse = np.unique(keys, return_inverse=True)
+        sums = [np.bincount(inverse, weights=values, minlength=len(unique))
+                for values in (counts, sum_x, sum_y, sum_id)]
+        live = sums[0] > 0
+        return cls(
+            unique[live], sums[0][live].astype(np.int64), sums[1][live], sums[2][live],
+            np.rint(sums[3][live]).astype(np.int64),
+        )
+
+    def parent(self):
+        """Aggregate this level's cells into the next coarser zoom"""
+        columns, rows = self.keys >> 32, self.keys & 0xFFFFFFFF
+        return ZoomLevel.aggregate(
+            ((columns >> 1) << 32) | (rows >> 1), self.counts, self.sum_x, self.sum_y, self.sum_id
+        )
+
+    def apply(self, key, count, x, y, marker_id):
+        entry = self.delta.setdefault(key, [0, 0.0, 0.0, 0])
+        entry[0] += count
+        entry[1] += x
+        entry[2] += y
+        entry[3] += marker_id
+        if len(self.delta) > DELTA_MAX:
+            self.compact()
+
+    def compact(self):
+        if not self.delta:
+            return
+        delta = np.array([[key, *values] for key, values in self.delta.items()], dtype=object)
+        merged = ZoomLevel.aggregate(
+            np.concatenate((self.keys, delta[:, 0].astype(np.int64))),
+            np.concatenate((self.counts, delta[:, 1].astype(np.int64))),
+            np.concatenate((self.sum_x, delta[:, 2].astype(np.float64))),
+            np.concatenate((self.sum_y, delta[:, 3].astype(np.float64))),
+            np.concatenate((self.sum_id, delta[:, 4].astype(np.int64))),
+        )
+        self.keys, self.counts = merged.keys, merged.counts
+        self.sum_x, self.sum_y, self.sum_id = merged.sum_x, merged.sum_y, merged.sum_id
+        self.delta = {}
+
+    def cells(self, first_column, last_column, first_row, last_row):
+        """Return {(column, row): [count, sum_x, sum_y, sum_id]} for cells inside a grid range"""
+        # Keys are column-major, so the whole column range is one slice; rows outside it are masked off
+        start = np.searchsorted(self.keys, (first_column << 32) | first_row)
+        end = np.searchsorted(self.keys, (last_column << 32) | last_row, side='right')
+        rows = self.keys[start:end] & 0xFFFFFFFF
+        inside = np.flatnonzero((rows >= first_row) & (rows <= last_row)) + start
+        cells = {
+            (column, row): [count, x, y, marker_id]
+            for column, row, count, x, y, marker_id in zip(
+                (self.keys[inside] >> 32).tolist(), (self.keys[inside] & 0xFFFFFFFF).tolist(),
+                self.counts[inside].tolist(), self.sum_x[inside].tolist(), self.sum_y[inside].tolist(),
+                self.sum_id[inside].tolist(),
+            )
+        }
+
+        for key, (count, x, y, marker_id) in self.delta.items():
+            column, row = key >> 32, key & 0xFFFFFFFF
+            if first_column <= column <= last_column and first_row <= row <= last_row:
+                entry = cells.setdefault((column, row), [0, 0.0, 0.0, 0])
+                entry[0] += count
+                entry[1] += x
+                entry[2] += y
+                entry[3] += marker_id
+
+        return {cell: entry for cell, entry in cells.items() if entry[0] > 0}
+
+
+class MarkerClusterIndex:
+    """Marker counts and centroid sums per grid cell for every zoom up to MAX_CLUSTER_ZOOM
+
+    Cells at zoom z are exactly four cells at zoom z + 1, so the index is built
+    once at the finest zoom and summed upwards. Adding or removing a marker
+    touches one cell per zoom. Queries greedily merge neighbouring cells whose
+    centroids are within CLUSTER_RADIUS_PX, like supercluster does with points.
+    Changes logged in MarkerChange by any process are applied before each query.
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._levels = None
+        self._cursor = 0
+
+    def _build(self, ids, lats, lngs):
+        x, y = mercator(lats, lngs)
+        ids = np.asarray(ids, dtype=np.int64)
+        level = ZoomLevel.aggregate(
+            cell_keys(x, y, MAX_CLUSTER_ZOOM), np.ones(len(ids), dtype=np.int64), x, y, ids
+        )
+        levels = [level]
+        for _ in range(MAX_CLUSTER_ZOOM):
+            level = level.parent()
+            levels.append(level)
+        self._levels = levels[::-1]
+        self._placed = {int(marker_id): (float(lat), float(lng)) for marker_id, lat, lng in zip(ids, lats, lngs)}
+
+    def _ensure_loaded(self):
+        """Load on first use, then catch up with changes any process logged since"""
+        if self._levels is not None:
+            changes = MarkerChange.changes_since(self._cursor)
+            if changes is not None:
+                self._cursor, positions = changes
+                for marker_id, position in positions.items():
+                    if position is None:
+                        self.remove(marker_id)
+                    else:
+                        self.add(marker_id, *position)
+                return
+        self._cursor, ids, lats, lngs = MarkerChange.snapshot()
+        self._build(ids, lats, lngs)
+
+    def _apply(self, marker_id, lat, lng, sign):
+        x, y = mercator([lat], [lng])
+        x, y = float(x[0]), float(y[0])
+        for zoom, level in enumerate(self._levels):
+            key = int(cell_keys(x, y, zoom))
+            level.apply(key, sign, sign * x, sign * y, sign * marker_id)
+
+    def add(self, marker_id, lat, lng):
+        """Count a new or moved marker; no-op until the index is first used"""
+        with self._lock:
+            if self._levels is not None:
+                self.remove(marker_id)
+                self._placed[marker_id] = (float(lat), float(lng))
+                self._apply(marker_id, float(lat), float(lng), 1)
+
+    def remove(self, marker_id):
+        """Uncount a marker at the position it was counted at"""
+        with self._lock:
+            if self._levels is not None and marker_id in self._placed:
+                self._apply(marker_id, *self._placed.pop(marker_id), -1)
+
+    def clear(self):
+        with self._lock:
+            self._build([], [], [])
+
+    def invalidate(self):
+        with self._lock:
+            self._levels = None
+
+    def clusters(self, west, south, east, north, zoom):
+        """Return (clusters, truncated) for a bbox; each cluster is a dict with latitude, longitude, count and id when count is 1"""
+        zoom = max(0, min(int(zoom), MAX_CLUSTER_ZOOM))
+        n = grid_size(zoom)
+        with self._lock:
+            self._ensure_loaded()
+            level = self._levels[zoom]
+            cells = {}
+            for box_west, box_south, box_east, box_north in split_bbox(west, south, east, north):
+                (x0, x1), (y1, y0) = mercator([box_south, box_north], [box_west, box_east])
+                first_column, last_column = clamp_span(int(x0 * n), int(x1 * n))
+                first_row, last_row = clamp_span(int(y0 * n), int(y1 * n))
+                # One cell of padding so clusters straddling the edge can merge
+                cells.update(level.cells(
+                    max(first_column - 1, 0), min(last_column + 1, n - 1),
+                    max(first_row - 1, 0), min(last_row + 1, n - 1),
+                ))
+
+        clusters = greedy_merge(cells, CLUSTER_RADIUS_PX / (256.0 * (1 << zoom)), limit=MAX_CLUSTERS + 1)
+        results = []
+        for count, x, y, marker_id in clusters:
+            lat, lng = unproject(x / count, y / count)
+            cluster = {'latitude': lat, 'longitude': lng, 'count': count}
+            if count == 1:
+                cluster['id'] = marker_id
+            results.append(cluster)
+
+        results.sort(key=lambda cluster: -cluster['count'])
+        return results[:MAX_CLUSTERS], len(results) > MAX_CLUSTERS
+
+
+def clamp_span(first, last, limit=None):
+    """Cut a grid range longer than limit cells down to limit cells around its middle"""
+    limit = limit or MAX_QUERY_CELLS
+    if last - first < limit:
+        return first, last
+    first = (first + last + 1 - limit) // 2
+    return first, first + limit - 1
+
+
+def greedy_merge(cells, radius, limit=None):
+    """Merge each cell with neighbouring cells whose centroid lies within radius, largest first
+
+    With limit, stops once that many clusters have been seeded from the fullest cells.
+    """
+    merged = []
+    visited = set()
+    for cell in sorted(cells, key=lambda cell: -cells[cell][0]):
+        if limit is not None and len(merged) >= limit:
+            break
+        if cell in visited:
+            continue
+        visited.add(cell)
+        count, sum_x, sum_y, sum_id = cells[cell]
+        cx, cy = sum_x / count, sum_y / count
+        column, row = cell
+        for dc in (-1, 0, 1):
+            for dr in (-1, 0, 1):
+                neighbour = (column + dc, row + dr)
+                if neighbour in visited or neighbour not in cells:
+                    continue
+                n_count, n_x, n_y, n_id = cells[neighbour]
+                if math.hypot(n_x / n_count - cx, n_y / n_count - cy) <= radius:
+                    visited.add(neighbour)
+                    count, sum_x, sum_y, sum_id = count + n_count, sum_x + n_x, sum_y + n_y, sum_id + n_id
+        merged.append((count, sum_x, sum_y, sum_id))
+    return merged
+
+
+cluster_index = MarkerClusterIndex()
@@ -0,0 +1,264 @@
+# events.py - Fan-out of live events to connected Server-Sent Events clients, across processes
+import asyncio
+import json
+import logging
+import os
+import socket
+import threading
+import time
+from contextlib import contextmanager
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import close_old_connections, transaction
+from django.utils import timezone
+
+from .models import EventRelay, Friendship, LiveEvent
+
+logger = logging.getLogger(__name__)
+
+SUBSCRIBER_QUEUE_SIZE = 100
+KEEPALIVE_SECONDS = 25
+RELAY_BATCH_SIZE = 500
+PRUNE_EVERY = 1000  # Outbox rows written between prunes
+RELAY_HEARTBEAT_SECONDS = 10  # Relays rewrite their EventRelay row at least this often
+RELAY_EXPIRY_SECONDS = 30  # A relay silent for longer is assumed gone
+PRESENCE_CACHE_SECONDS = 2  # How long publishers reuse the list of users served elsewhere
+
+
+def process_origin():
+    """Identify this process in LiveEvent.origin; computed per call so forked workers differ"""
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+class EventBroker:
+    """Route events to the asyncio queues of a user's open streams
+
+    publish() is safe to call from any thread, e.g. request threads or the
+    location buffer's flusher, and takes effect when the caller's transaction
+    commits. It delivers to this process's streams at once. For users whose
+    stream is open in another process, going by the EventRelay rows, it also
+    writes the event to the LiveEvent outbox. Every process with open streams
+    runs a relay thread that tails the outbox every EVENT_RELAY_INTERVAL
+    seconds and keeps its EventRelay row current.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._subscribers = {}
+        self._relay = None
+        self._remote = None  # (monotonic time read, user IDs served by other processes)
+
+    @property
+    def relay_interval(self):
+        return getattr(settings, 'EVENT_RELAY_INTERVAL', 1.0)
+
+    @contextmanager
+    def subscribe(self, user_id):
+        """Register a queue for user_id for the lifetime of the context"""
+        queue = asyncio.Queue(maxsize=SUBSCRIBER_QUEUE_SIZE)
+        subscriber = (asyncio.get_running_loop(), queue)
+        with self._lock:
+            self._subscribers.setdefault(user_id, set()).add(subscriber)
+            if self._relay is None and self.relay_interval > 0:
+                self._relay = threading.Thread(target=self._run_relay, name='event-relay', daemon=True)
+                self._relay.start()
+        try:
+            yield queue
+        finally:
+            with self._lock:
+                subscribers = self._subscribers.get(user_id, set())
+                subscribers.discard(subscriber)
+                if not subscribers:
+                    self._subscribers.pop(user_id, None)
+
+    def connected_user_ids(self):
+        """IDs of users with at least one open stream in this process"""
+        with self._lock:
+            return set(self._subscribers)
+
+    def publish(self, user_ids, event, data):
+        """Send an event to every open stream of the given users, in any process"""
+        self.publish_many([(user_ids, event, data)])
+
+    def publish_many(self, items):
+        """publish() for a list of (user_ids, event, data), written to the outbox in one batch"""
+        items = [(set(user_ids), event, data) for user_ids, event, data in items]
+        items = [item for item in items if item[0]]
+        if items:
+            transaction.on_commit(lambda: self._publish(items))
+
+    def _publish(self, items):
+        for user_ids, event, data in items:
+            self._deliver(user_ids, event, data)
+        try:
+            remote = self.remote_user_ids()
+            rows = [
+                LiveEvent(origin=process_origin(), user_ids=sorted(user_ids & remote), event=event, data=data)
+                for user_ids, event, data in items if user_ids & remote
+            ]
+            if rows:
+                rows = LiveEvent.objects.bulk_create(rows)
+                last_id = rows[-1].id
+                if last_id is not None and last_id // PRUNE_EVERY > (last_id - len(rows)) // PRUNE_EVERY:
+                    LiveEvent.prune()
+        except Exception:
+            logger.exception('Could not write live events to the outbox')
+
+    def remote_user_ids(self):
+        """IDs of users with a stream open in another process, re-read every PRESENCE_CACHE_SECONDS"""
+        now = time.monotonic()
+        remote = self._remote
+        if remote is None or now - remote[0] > PRESENCE_CACHE_SECONDS:
+            users = set()
+            relays = EventRelay.objects.filter(
+                seen_at__gte=timezone.now() - timedelta(seconds=RELAY_EXPIRY_SECONDS)
+            ).exclude(origin=process_origin())
+            for user_ids in relays.values_list('user_ids', flat=True):
+                users.update(user_ids)
+            remote = self._remote = (now, users)
+        return remote[1]
+
+    def relay(self, cursor=None):
+        """Deliver outbox events from other processes written after cursor; returns the new cursor"""
+        if cursor is None:
+            return LiveEvent.latest_cursor()  # Start from now; earlier events were for earlier streams
+        origin = process_origin()
+        while True:
+            rows = list(
+                LiveEvent.objects.filter(id__gt=cursor).order_by('id')
+                .values_list('id', 'origin', 'user_ids', 'event', 'data')[:RELAY_BATCH_SIZE]
+            )
+            for event_id, event_origin, user_ids, event, data in rows:
+                if event_origin != origin:
+                    self._deliver(user_ids, event, data)
+                cursor = event_id
+            if len(rows) < RELAY_BATCH_SIZE:
+                return cursor
+
+    def heartbeat(self, served=None):
+        """Record the users this process serves, and forget relays that went silent"""
+        now = timezone.now()
+        EventRelay.objects.update_or_create(origin=process_origin(), defaults={
+            'user_ids': sorted(self.connected_user_ids() if served is None else served), 'seen_at': now,
+        })
+        EventRelay.objects.filter(seen_at__lt=now - timedelta(seconds=RELAY_EXPIRY_SECONDS)).delete()
+
+    def _run_relay(self):
+        cursor = None
+        served, beat_at = None, 0.0
+        while True:
+            try:
+                connected = self.connected_user_ids()
+                if connected != served or time.monotonic() - beat_at > RELAY_HEARTBEAT_SECONDS:
+                    self.heartbeat(connected)
+                    served, beat_at = connected, time.monotonic()
+                cursor = self.relay(cursor)
+            except Exception:
+                logger.exception('Event relay failed')
+            finally:
+                close_old_connections()
+            time.sleep(self.relay_interval)
+            if self.connected_user_ids():
+                continue
+            try:
+                EventRelay.objects.filter(origin=process_origin()).delete()
+            except Exception:
+                logger.exception('Could not remove the event relay row')
+            finally:
+                close_old_connections()
+            with self._lock:
+                if not self._subscribers:
+                    self._relay = None  # The next subscriber starts a new relay
+                    return
+            served = None  # Someone connected while the row was removed
+
+    def _deliver(self, user_ids, event, data):
+        """Queue an event for this process's open streams of the given users"""
+        with self._lock:
+            targets = [
+                subscriber for user_id in user_ids
+                for subscriber in self._subscribers.get(user_id, ())
+            ]
+        for loop, queue in targets:
+            try:
+                loop.call_soon_threadsafe(_offer, queue, (event, data))
+            except RuntimeError:
+                pass  # Loop closed while the stream was shutting down
+
+
+def _offer(queue, item):
+    """Enqueue without blocking, dropping the oldest event for slow clients"""
+    if queue.full():
+        queue.get_nowait()
+    queue.put_nowait(item)
+
+
+def format_event(event, data):
+    """Serialize one event in text/event-stream framing"""
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+async def stream_events(user_id):
+    """Yield text/event-stream chunks for a user until the client disconnects"""
+    with broker.subscribe(user_id) as queue:
+        yield 'retry: 5000\n\n'
+        while True:
+            try:
+                event, data = await asyncio.wait_for(queue.get(), timeout=KEEPALIVE_SECONDS)
+            except asyncio.TimeoutError:
+                yield ': keepalive\n\n'
+                continue
+            yield format_event(event, data)
+
+
+def publish_notification(notification, friend_username):
+    """Push a newly created ProximityNotification to its recipient"""
+    publish_notifications([notification], {notification.friend_id: friend_username})
+
+
+def publish_notifications(notifications, usernames):
+    """Push newly created ProximityNotifications; usernames maps friend_id to username"""
+    broker.publish_many([
+        ([notification.user_id], 'notification', {
+            'id': notification.id,
+            'peer_username': usernames[notification.friend_id],
+            'distance': notification.distance,
+            'message': notification.message,
+            'is_read': notification.is_read,
+        })
+        for notification in notifications
+    ])
+
+
+def publish_geofence_events(events):
+    """Push newly created GeofenceEvents to their owners"""
+    broker.publish_many([
+        ([event.user_id], 'geofence', {
+            'id': event.id,
+            'geofence_id': event.geofence_id,
+            'name': event.geofence.name,
+            'event': event.event,
+            'message': event.message,
+            'occurred_at': event.occurred_at.isoformat(),
+        })
+        for event in events
+    ])
+
+
+def publish_friend_location(user, profile):
+    """Push a user's new position to their friends, if they share their location"""
+    if not profile.location_sharing_enabled or profile.latitude is None or profile.longitude is None:
+        return
+    targets = Friendship.get_friend_ids(user.id)  # Friends may be connected to any process
+    if targets:
+        broker.publish(targets, 'friend_location', {
+            'user_id': user.id,
+            'username': user.username,
+            'latitude': float(profile.latitude),
+            'longitude': float(profile.longitude),
+            'last_location_update': profile.last_location_update.isoformat() if profile.last_location_update else None,
+        })
+
+
+broker = EventBroker()
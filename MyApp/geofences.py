@@ -0,0 +1,129 @@
+# geofences.py - Match fixes against users' geofences and record enter/exit/dwell events in bulk
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from .events import publish_geofence_events
+from .models import Geofence, GeofenceEvent
+
+QUERY_CHUNK_SIZE = 900  # Stay below SQLite's bound-parameter limit
+
+
+def event_message(event, fence, seconds=None):
+    if event == GeofenceEvent.ENTER:
+        return f"You entered {fence.name}"
+    if event == GeofenceEvent.EXIT:
+        return f"You left {fence.name}"
+    return f"You have been at {fence.name} for {round(seconds / 60)} minutes"
+
+
+def candidate_fences(fixes):
+    """Active fences that a fix might enter or leave, for {user_id: (lat, lng, captured_at)}
+
+    Fences are prefiltered in the database by bounding box, through
+    geofence_bbox_idx, plus any fence the user is currently inside, since
+    leaving it has to be noticed however far the fix is.
+    """
+    user_ids = sorted(fixes)
+    for start in range(0, len(user_ids), QUERY_CHUNK_SIZE):
+        chunk = user_ids[start:start + QUERY_CHUNK_SIZE]
+        if len(chunk) == 1:
+            lat, lng, _ = fixes[chunk[0]]
+            nearby = Q(min_lat__lte=lat, max_lat__gte=lat, min_lng__lte=lng, max_lng__gte=lng)
+        else:
+            # One box around the whole chunk; each fence is checked against its own fix below
+            lats = [fixes[user_id][0] for user_id in chunk]
+            lngs = [fixes[user_id][1] for user_id in chunk]
+            nearby = Q(min_lat__lte=max(lats), max_lat__gte=min(lats), min_lng__lte=max(lngs), max_lng__gte=min(lngs))
+        fences = Geofence.objects.filter(nearby | Q(entered_at__isnull=False), user_id__in=chunk, is_active=True)
+        for fence in fences:
+            lat, lng, _ = fixes[fence.user_id]
+            if fence.entered_at is not None or (
+                fence.min_lat <= lat <= fence.max_lat and fence.min_lng <= lng <= fence.max_lng
+            ):
+                yield fence
+
+
+def transition(fence, lat, lng, captured_at):
+    """Apply one fix to a fence's presence state; returns the event it causes, or None"""
+    if fence.entered_at is not None and captured_at < fence.entered_at:
+        return None  # Late fix from before the user entered
+    inside = fence.contains(lat, lng)
+    if inside and fence.entered_at is None:
+        fence.entered_at = captured_at
+        fence.dwell_sent = False
+        return GeofenceEvent.ENTER
+    if not inside and fence.entered_at is not None:
+        fence.entered_at = None
+        fence.dwell_sent = False
+        return GeofenceEvent.EXIT
+    if inside and dwell_due(fence, captured_at):
+        fence.dwell_sent = True
+        return GeofenceEvent.DWELL
+    return None
+
+
+def dwell_due(fence, now):
+    return (
+        fence.dwell_seconds is not None and not fence.dwell_sent and fence.entered_at is not None
+        and (now - fence.entered_at).total_seconds() >= fence.dwell_seconds
+    )
+
+
+def process_fixes(fixes):
+    """Evaluate fixes against their users' fences and store the resulting events in bulk
+
+    fixes is an iterable of (user_id, latitude, longitude, captured_at); only
+    the newest fix per user is used. Returns the created GeofenceEvents.
+    """
+    latest = {}
+    for user_id, lat, lng, captured_at in fixes:
+        if user_id not in latest or captured_at > latest[user_id][2]:
+            latest[user_id] = (float(lat), float(lng), captured_at or timezone.now())
+    if not latest:
+        return []
+
+    changed, events = [], []
+    for fence in candidate_fences(latest):
+        lat, lng, captured_at = latest[fence.user_id]
+        event = transition(fence, lat, lng, captured_at)
+        if event is None:
+            continue
+        changed.append(fence)
+        seconds = (captured_at - fence.entered_at).total_seconds() if event == GeofenceEvent.DWELL else None
+        events.append(GeofenceEvent(
+            user_id=fence.user_id, geofence=fence, event=event, latitude=lat, longitude=lng,
+            message=event_message(event, fence, seconds), occurred_at=captured_at,
+        ))
+    return save_events(changed, events)
+
+
+def sweep_dwell(now=None):
+    """Create dwell events for users still inside a fence without a new fix; returns them"""
+    now = now or timezone.now()
+    inside = Geofence.objects.filter(
+        is_active=True, entered_at__isnull=False, dwell_sent=False, dwell_seconds__isnull=False
+    )
+    changed, events = [], []
+    for fence in inside.iterator(chunk_size=QUERY_CHUNK_SIZE):
+        if not dwell_due(fence, now):
+            continue
+        fence.dwell_sent = True
+        changed.append(fence)
+        events.append(GeofenceEvent(
+            user_id=fence.user_id, geofence=fence, event=GeofenceEvent.DWELL,
+            message=event_message(GeofenceEvent.DWELL, fence, (now - fence.entered_at).total_seconds()),
+            occurred_at=now,
+        ))
+    return save_events(changed, events)
+
+
+def save_events(fences, events):
+    """Write fence state and new events in one transaction, then push the events"""
+    if not events:
+        return []
+    with transaction.atomic():
+        Geofence.objects.bulk_update(fences, ['entered_at', 'dwell_sent'], batch_size=QUERY_CHUNK_SIZE)
+        GeofenceEvent.objects.bulk_create(events, batch_size=QUERY_CHUNK_SIZE)
+    publish_geofence_events(events)
+    return events
@@ -0,0 +1,219 @@
+# instrumentation.py - Per-view request latency, query and response-size metrics
+import bisect
+import cProfile
+import io
+import pstats
+import random
+import threading
+import time
+from collections import deque
+from contextlib import ExitStack
+
+from django.conf import settings
+from django.db import connections
+
+# Upper bounds of the latency histogram buckets, in milliseconds
+LATENCY_BUCKETS_MS = (5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+PROFILE_LINES = 25  # Functions kept from each slow-request profile
+PROFILES_KEPT = 50
+UNRESOLVED = '<unresolved>'
+
+
+class RequestMetrics:
+    """Thread-safe per-view counters and latency histograms for this process"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._views = {}
+        self.profiles = deque(maxlen=PROFILES_KEPT)
+
+    def record(self, view, elapsed_ms, status, queries, query_ms, size):
+        with self._lock:
+            stats = self._views.get(view)
+            if stats is None:
+                stats = self._views[view] = {
+                    'count': 0, 'errors': 0, 'buckets': [0] * (len(LATENCY_BUCKETS_MS) + 1),
+                    'latency_ms': 0.0, 'max_ms': 0.0, 'queries': 0, 'query_ms': 0.0, 'bytes': 0,
+                }
+            stats['count'] += 1
+            stats['errors'] += status >= 500
+            stats['buckets'][bisect.bisect_left(LATENCY_BUCKETS_MS, elapsed_ms)] += 1
+            stats['latency_ms'] += elapsed_ms
+            stats['max_ms'] = max(stats['max_ms'], elapsed_ms)
+            stats['queries'] += queries
+            stats['query_ms'] += query_ms
+            stats['bytes'] += size
+
+    def add_profile(self, entry):
+        with self._lock:
+            self.profiles.append(entry)
+
+    def reset(self):
+        with self._lock:
+            self._views.clear()
+            self.profiles.clear()
+
+    def snapshot(self):
+        """Per-view summary with estimated percentiles, plus recent slow-request profiles"""
+        with self._lock:
+            views = {view: dict(stats, buckets=list(stats['buckets'])) for view, stats in self._views.items()}
+            profiles = list(self.profiles)
+        summary = {}
+        for view, stats in sorted(views.items()):
+            count = stats['count']
+            summary[view] = {
+                'count': count,
+                'errors': stats['errors'],
+                'mean_ms': round(stats['latency_ms'] / count, 3),
+                'p50_ms': bucket_percentile(stats['buckets'], 0.5),
+                'p95_ms': bucket_percentile(stats['buckets'], 0.95),
+                'p99_ms': bucket_percentile(stats['buckets'], 0.99),
+                'max_ms': round(stats['max_ms'], 3),
+                'queries_per_request': round(stats['queries'] / count, 2),
+                'query_ms_per_request': round(stats['query_ms'] / count, 3),
+                'bytes_per_request': round(stats['bytes'] / count),
+            }
+        return {'views': summary, 'slow_profiles': profiles}
+
+    def prometheus(self):
+        """Render the counters in the Prometheus text exposition format"""
+        with self._lock:
+            views = {view: dict(stats, buckets=list(stats['buckets'])) for view, stats in self._views.items()}
+        lines = [
+            '# HELP geomap_request_duration_seconds Request latency by view',
+            '# TYPE geomap_request_duration_seconds histogram',
+        ]
+        for view, stats in sorted(views.items()):
+            label = f'view="{escape_label(view)}"'
+            cumulative = 0
+            for bound, count in zip(LATENCY_BUCKETS_MS + ('+Inf',), stats['buckets']):
+                cumulative += count
+                le = bound if bound == '+Inf' else f'{bound / 1000:g}'
+                lines.append(f'geomap_request_duration_seconds_bucket{{{label},le="{le}"}} {cumulative}')
+            lines.append(f'geomap_request_duration_seconds_sum{{{label}}} {stats["latency_ms"] / 1000:.6f}')
+            lines.append(f'geomap_request_duration_seconds_count{{{label}}} {stats["count"]}')
+        for name, key, help_text in (
+            ('geomap_request_errors_total', 'errors', 'Responses with a 5xx status'),
+            ('geomap_db_queries_total', 'queries', 'Database queries run by requests'),
+            ('geomap_db_query_seconds_total', 'query_ms', 'Time spent in database queries'),
+            ('geomap_response_bytes_total', 'bytes', 'Response body bytes'),
+        ):
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} counter')
+            for view, stats in sorted(views.items()):
+                value = round(stats[key] / 1000, 6) if key == 'query_ms' else stats[key]
+                lines.append(f'{name}{{view="{escape_label(view)}"}} {value}')
+        return '\n'.join(lines) + '\n'
+
+
+def bucket_percentile(buckets, fraction):
+    """Upper bound of the bucket holding the given fraction of requests (None past the last bound)"""
+    target = sum(buckets) * fraction
+    cumulative = 0
+    for bound, count in zip(LATENCY_BUCKETS_MS, buckets):
+        cumulative += count
+        if cumulative >= target:
+            return bound
+    return None
+
+
+def escape_label(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+request_metrics = RequestMetrics()
+
+
+class RequestMetricsMiddleware:
+    """Time each request and count its queries and response bytes, tagged by URL name
+
+    With REQUEST_PROFILE_THRESHOLD_MS set, a REQUEST_PROFILE_SAMPLE_RATE
+    fraction of requests run under cProfile and those slower than the
+    threshold keep their top functions in request_metrics.profiles.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        if not getattr(settings, 'REQUEST_METRICS', False):
+            return self.get_response(request)
+
+        queries = [0, 0.0]
+
+        def count_query(execute, sql, params, many, context):
+            started = time.perf_counter()
+            try:
+                return execute(sql, params, many, context)
+            finally:
+                queries[0] += 1
+                queries[1] += (time.perf_counter() - started) * 1000
+
+        threshold = getattr(settings, 'REQUEST_PROFILE_THRESHOLD_MS', None)
+        profiler = None
+        if threshold is not None and random.random() < getattr(settings, 'REQUEST_PROFILE_SAMPLE_RATE', 1.0):
+            profiler = cProfile.Profile()
+
+        started = time.perf_counter()
+        with counting_queries(count_query):
+            if profiler is not None:
+                try:
+                    profiler.enable()
+                except ValueError:  # Another profiler is already active in this thread
+                    profiler = None
+            try:
+                response = self.get_response(request)
+            finally:
+                if profiler is not None:
+                    profiler.disable()
+        elapsed_ms = (time.perf_counter() - started) * 1000
+
+        match = getattr(request, 'resolver_match', None)
+        view = match.view_name if match is not None else UNRESOLVED
+
+        if profiler is not None and elapsed_ms >= threshold:
+            request_metrics.add_profile({
+                'view': view,
+                'path': request.path,
+                'elapsed_ms': round(elapsed_ms, 3),
+                'queries': queries[0],
+                'query_ms': round(queries[1], 3),
+                'at': time.time(),
+                'profile': format_profile(profiler),
+            })
+
+        if response.streaming and not response.is_async:
+            # The body is produced after we return; record once it has been sent
+            response.streaming_content = self._count_stream(
+                response.streaming_content, view, started, response.status_code, queries, count_query
+            )
+        else:
+            size = 0 if response.streaming else len(response.content)
+            request_metrics.record(view, elapsed_ms, response.status_code, queries[0], queries[1], size)
+        return response
+
+    def _count_stream(self, content, view, started, status, queries, count_query):
+        size = 0
+        try:
+            with counting_queries(count_query):
+                for chunk in content:
+                    size += len(chunk)
+                    yield chunk
+        finally:
+            elapsed_ms = (time.perf_counter() - started) * 1000
+            request_metrics.record(view, elapsed_ms, status, queries[0], queries[1], size)
+
+
+def counting_queries(wrapper):
+    """Install an execute wrapper on every database connection"""
+    stack = ExitStack()
+    for connection in connections.all():
+        stack.enter_context(connection.execute_wrapper(wrapper))
+    return stack
+
+
+def format_profile(profiler):
+    """The slowest functions of a profile by cumulative time, as pstats text"""
+    output = io.StringIO()
+    pstats.Stats(profiler, stream=output).strip_dirs().sort_stats('cumulative').print_stats(PROFILE_LINES)
+    return output.getvalue()
@@ -0,0 +1,249 @@
+# loadtest.py - Seed synthetic data and drive the location/proximity hot path through the test client
+import json
+import platform
+import random
+import subprocess
+import threading
+import time
+
+import django
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db import connection
+from django.test import Client
+from django.urls import reverse
+
+from .instrumentation import request_metrics
+from .models import Friendship, Marker, ProximityAlert, UserProfile, UserSearchIndex
+
+SEED_BATCH_SIZE = 5000
+CENTER = (37.7749, -122.4194)
+SPREAD_DEGREES = 0.5  # Users and markers are scattered this far around CENTER
+MOVE_DEGREES = 0.01  # How far update_location moves a user from its seeded position
+USERNAME_PREFIX = 'load'
+
+
+def seed(users, friends_per_user=10, markers=0, rng=None, stdout=None):
+    """Bulk-create users with located profiles, accepted friendships, proximity alerts and markers; returns counts
+
+    Friendships link each user to its next friends_per_user // 2 neighbours
+    on a ring, so everyone has about friends_per_user friends and the graph
+    has no duplicates.
+    """
+    rng = rng or random.Random(0)
+    started = time.perf_counter()
+    first_id = (User.objects.order_by('-id').values_list('id', flat=True).first() or 0) + 1
+
+    def progress(message):
+        if stdout is not None:
+            stdout.write(f'{message} ({time.perf_counter() - started:.1f}s)')
+
+    for start in range(0, users, SEED_BATCH_SIZE):
+        count = min(SEED_BATCH_SIZE, users - start)
+        created = User.objects.bulk_create([
+            User(username=f'{USERNAME_PREFIX}{first_id + start + i}', password='!') for i in range(count)
+        ])
+        UserProfile.objects.bulk_create([
+            UserProfile(
+                user=user,
+                latitude=round(CENTER[0] + rng.uniform(-SPREAD_DEGREES, SPREAD_DEGREES), 6),
+                longitude=round(CENTER[1] + rng.uniform(-SPREAD_DEGREES, SPREAD_DEGREES), 6),
+                location_sharing_enabled=rng.random() < 0.8,
+            )
+            for user in created
+        ])
+        UserSearchIndex.index_users(created)  # bulk_create skips the post_save receiver that maintains it
+    user_ids = list(User.objects.filter(username__startswith=USERNAME_PREFIX).order_by('id').values_list('id', flat=True))
+    progress(f'Seeded {len(user_ids)} users and profiles')
+
+    links = [
+        (user_ids[i], user_ids[(i + offset) % len(user_ids)])
+        for i in range(len(user_ids))
+        for offset in range(1, min(friends_per_user // 2, len(user_ids) - 1) + 1)
+    ]
+    links = list(dict.fromkeys(tuple(sorted(link)) for link in links if link[0] != link[1]))
+    for start in range(0, len(links), SEED_BATCH_SIZE):
+        batch = links[start:start + SEED_BATCH_SIZE]
+        Friendship.objects.bulk_create([
+            Friendship(requester_id=a, addressee_id=b, status=Friendship.ACCEPTED) for a, b in batch
+        ])
+        ProximityAlert.objects.bulk_create(
+            [ProximityAlert(user_id=a, friend_id=b, distance_threshold=5.0) for a, b in batch]
+            + [ProximityAlert(user_id=b, friend_id=a, distance_threshold=5.0) for a, b in batch]
+        )
+    progress(f'Seeded {len(links)} friendships')
+
+    for start in range(0, markers, SEED_BATCH_SIZE):
+        Marker.objects.bulk_create([
+            Marker(
+                title=f'Marker {start + i}',
+                latitude=round(CENTER[0] + rng.uniform(-SPREAD_DEGREES, SPREAD_DEGREES), 7),
+                longitude=round(CENTER[1] + rng.uniform(-SPREAD_DEGREES, SPREAD_DEGREES), 7),
+            )
+            for i in range(min(SEED_BATCH_SIZE, markers - start))
+        ])
+    progress(f'Seeded {markers} markers')
+
+    return {'users': len(user_ids), 'friendships': len(links), 'markers': markers,
+            'seconds': round(time.perf_counter() - started, 3)}
+
+
+def _move(client, user, rng):
+    lat, lng = user.home
+    return client.post(
+        reverse('MyApp:update_location'),
+        json.dumps({'latitude': lat + rng.uniform(-MOVE_DEGREES, MOVE_DEGREES),
+                    'longitude': lng + rng.uniform(-MOVE_DEGREES, MOVE_DEGREES)}),
+        content_type='application/json',
+    )
+
+
+def _add_marker(client, user, rng):
+    lat, lng = user.home
+    return client.post(
+        reverse('MyApp:add_marker'),
+        json.dumps({'latitude': round(lat, 7), 'longitude': round(lng, 7), 'title': 'Load test'}),
+        content_type='application/json',
+    )
+
+
+SCENARIOS = {
+    'update_location': _move,
+    'dashboard': lambda client, user, rng: client.get(reverse('MyApp:dashboard')),
+    'map_view': lambda client, user, rng: client.get(reverse('MyApp:map')),
+    'get_proximity_notifications': lambda client, user, rng: client.get(reverse('MyApp:get_proximity_notifications')),
+    'add_marker': _add_marker,
+}
+
+
+def load_users(count, rng):
+    """Pick count seeded users, each with its profile position as .home"""
+    profiles = list(
+        UserProfile.objects.filter(user__username__startswith=USERNAME_PREFIX)
+        .select_related('user').order_by('user_id')[:max(count * 20, count)]
+    )
+    users = []
+    for profile in rng.sample(profiles, min(count, len(profiles))):
+        profile.user.home = (float(profile.latitude), float(profile.longitude))
+        users.append(profile.user)
+    return users
+
+
+def run_scenario(name, users, concurrency, requests, seed=0):
+    """Send requests through concurrency clients, each logged in as its own user; returns stats
+
+    With a concurrency of 1 the requests run on the calling thread.
+    """
+    scenario = SCENARIOS[name]
+    per_client = max(1, requests // concurrency)
+    lock = threading.Lock()
+    latencies = []
+    statuses = {}
+    request_metrics.reset()
+
+    def client_loop(index):
+        rng = random.Random(seed * 1000 + index)
+        user = users[index % len(users)]
+        client = Client()
+        client.force_login(user)
+        mine = []
+        codes = {}
+        try:
+            for _ in range(per_client):
+                started = time.perf_counter()
+                try:
+                    status = scenario(client, user, rng).status_code
+                except Exception:
+                    status = 'exception'
+                mine.append((time.perf_counter() - started) * 1000)
+                codes[status] = codes.get(status, 0) + 1
+        finally:
+            with lock:
+                latencies.extend(mine)
+                for status, count in codes.items():
+                    statuses[status] = statuses.get(status, 0) + count
+            if threading.current_thread() is not threading.main_thread():
+                connection.close()
+
+    started = time.perf_counter()
+    if concurrency == 1:
+        client_loop(0)
+    else:
+        threads = [threading.Thread(target=client_loop, args=(i,)) for i in range(concurrency)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    ok = sum(count for status, count in statuses.items() if isinstance(status, int) and status < 400)
+    views = request_metrics.snapshot()['views'].values()
+    counted = sum(stats['count'] for stats in views)
+    return {
+        'scenario': name,
+        'concurrency': concurrency,
+        'requests': len(latencies),
+        'errors': len(latencies) - ok,
+        'statuses': {str(status): count for status, count in sorted(statuses.items(), key=str)},
+        'seconds': round(elapsed, 3),
+        'requests_per_second': round(len(latencies) / elapsed, 1) if elapsed > 0 else 0.0,
+        'latency_ms': {
+            'mean': round(sum(latencies) / len(latencies), 3) if latencies else 0.0,
+            'p50': round(percentile(latencies, 0.5), 3),
+            'p90': round(percentile(latencies, 0.9), 3),
+            'p99': round(percentile(latencies, 0.99), 3),
+            'max': round(latencies[-1], 3) if latencies else 0.0,
+        },
+        'queries_per_request': round(sum(s['queries_per_request'] * s['count'] for s in views) / counted, 2)
+        if counted else None,
+        'bytes_per_request': round(sum(s['bytes_per_request'] * s['count'] for s in views) / counted)
+        if counted else None,
+    }
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(int(len(sorted_values) * fraction), len(sorted_values) - 1)]
+
+
+def environment():
+    """Identify the code and runtime a report was produced with"""
+    try:
+        commit = subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=settings.BASE_DIR,
+            capture_output=True, text=True, timeout=10,
+        ).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        commit = None
+    return {
+        'commit': commit,
+        'python': platform.python_version(),
+        'django': django.get_version(),
+        'db_profile': settings.DB_PROFILE,
+        'location_write_behind': settings.LOCATION_WRITE_BEHIND,
+    }
+
+
+def compare(old, new):
+    """Per scenario and concurrency, the relative change in throughput and p90 latency between two reports"""
+    before = {(run['scenario'], run['concurrency']): run for run in old['runs']}
+    rows = []
+    for run in new['runs']:
+        previous = before.get((run['scenario'], run['concurrency']))
+        if previous is None:
+            continue
+        rows.append({
+            'scenario': run['scenario'],
+            'concurrency': run['concurrency'],
+            'requests_per_second': (previous['requests_per_second'], run['requests_per_second'],
+                                    relative_change(previous['requests_per_second'], run['requests_per_second'])),
+            'p90_ms': (previous['latency_ms']['p90'], run['latency_ms']['p90'],
+                       relative_change(previous['latency_ms']['p90'], run['latency_ms']['p90'])),
+        })
+    return rows
+
+
+def relative_change(old, new):
+    return round((new - old) / old * 100, 1) if old else None
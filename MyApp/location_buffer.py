@@ -0,0 +1,201 @@
+# location_buffer.py - Write-behind buffer that coalesces location fixes per user
+import atexit
+import logging
+import threading
+import time
+
+from django.conf import settings
+from django.db import IntegrityError, close_old_connections, transaction
+from django.utils import timezone
+
+from .models import UserProfile, location_moved
+
+logger = logging.getLogger(__name__)
+
+FLUSH_CHUNK_SIZE = 500
+
+
+class LocationBuffer:
+    """Keep only the latest fix per user in memory and persist them with bulk_update
+
+    Fixes are flushed every LOCATION_FLUSH_INTERVAL seconds by a daemon thread,
+    or by calling flush() directly when the interval is 0. Fixes are stored the
+    same way as UserProfile.update_location stores them, and location_moved is
+    sent once per flush for every profile that moved.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()  # Keeps concurrent flushes from reordering writes
+        self._pending = {}
+        self._thread = None
+        self._stop = threading.Event()
+        self._metrics = {
+            'submitted': 0,
+            'coalesced': 0,
+            'flushes': 0,
+            'rows_written': 0,
+            'unchanged': 0,
+            'failed_flushes': 0,
+            'last_flush_at': None,
+            'last_flush_duration_ms': 0.0,
+            'last_flush_max_lag_ms': 0.0,
+        }
+
+    @property
+    def interval(self):
+        return getattr(settings, 'LOCATION_FLUSH_INTERVAL', 2.0)
+
+    def submit(self, user_id, lat, lng, captured_at=None):
+        """Queue a fix, replacing any unflushed fix for the same user"""
+        captured_at = captured_at or timezone.now()
+        with self._lock:
+            if user_id in self._pending:
+                if captured_at < self._pending[user_id][2]:
+                    return  # An older fix from a replayed backlog
+                self._metrics['coalesced'] += 1
+            self._pending[user_id] = (lat, lng, captured_at, time.monotonic())
+            self._metrics['submitted'] += 1
+            self._ensure_thread()
+
+    def _ensure_thread(self):
+        if self.interval > 0 and (self._thread is None or not self._thread.is_alive()):
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name='location-buffer', daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.flush()
+            except Exception:
+                logger.exception('Location buffer flush failed')
+            finally:
+                close_old_connections()
+
+    def stop(self):
+        """Stop the flusher thread and write out anything still pending"""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.flush()
+
+    def flush(self):
+        """Write all pending fixes; returns the IDs of users whose location was written"""
+        with self._flush_lock:
+            return self._flush()
+
+    def _flush(self):
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        if not pending:
+            return []
+
+        started = time.monotonic()
+        try:
+            written, moved = self._write(pending)
+        except Exception:
+            with self._lock:
+                # Put fixes back unless a newer one arrived meanwhile
+                for user_id, fix in pending.items():
+                    self._pending.setdefault(user_id, fix)
+                self._metrics['failed_flushes'] += 1
+            raise
+
+        finished = time.monotonic()
+        with self._lock:
+            self._metrics['flushes'] += 1
+            self._metrics['rows_written'] += len(written)
+            self._metrics['unchanged'] += len(pending) - len(written)
+            self._metrics['last_flush_at'] = timezone.now().isoformat()
+            self._metrics['last_flush_duration_ms'] = round((finished - started) * 1000, 3)
+            self._metrics['last_flush_max_lag_ms'] = round(
+                (finished - min(fix[3] for fix in pending.values())) * 1000, 3
+            )
+
+        if moved:
+            location_moved.send(sender=UserProfile, profiles=moved)
+        return written
+
+    def _write(self, pending):
+        profiles = self._fetch(list(pending))
+        moved, heartbeats = [], []
+        for profile in profiles.values():
+            self._apply(profile, pending[profile.user_id], moved, heartbeats)
+
+        missing = [user_id for user_id in pending if user_id not in profiles]
+        created = []
+        with transaction.atomic():
+            while missing:
+                created = []
+                for user_id in missing:
+                    lat, lng, captured_at, _ = pending[user_id]
+                    created.append(UserProfile(user_id=user_id, latitude=lat, longitude=lng,
+                                               last_location_update=captured_at))
+                try:
+                    with transaction.atomic():
+                        UserProfile.objects.bulk_create(created, batch_size=FLUSH_CHUNK_SIZE)
+                    break
+                except IntegrityError:
+                    # Another process created some of these profiles first; update those instead
+                    raced = self._fetch(missing)
+                    if not raced:
+                        raise
+                    for profile in raced.values():
+                        self._apply(profile, pending[profile.user_id], moved, heartbeats)
+                    missing = [user_id for user_id in missing if user_id not in raced]
+                    created = []
+            UserProfile.objects.bulk_update(
+                moved, fields=['latitude', 'longitude', 'last_location_update'], batch_size=FLUSH_CHUNK_SIZE
+            )
+            UserProfile.objects.bulk_update(heartbeats, fields=['last_location_update'], batch_size=FLUSH_CHUNK_SIZE)
+        written = created + moved + heartbeats
+        return [profile.user_id for profile in written], created + moved
+
+    def _fetch(self, user_ids):
+        profiles = {}
+        for start in range(0, len(user_ids), FLUSH_CHUNK_SIZE):
+            chunk = user_ids[start:start + FLUSH_CHUNK_SIZE]
+            profiles.update(
+                (profile.user_id, profile)
+                for profile in UserProfile.objects.filter(user_id__in=chunk).select_related('user')
+            )
+        return profiles
+
+    def _apply(self, profile, fix, moved, heartbeats):
+        """Set a fix on an existing profile and file it under the write it needs, if any"""
+        lat, lng, captured_at, _ = fix
+        change = profile.classify_fix(lat, lng, captured_at)
+        if change == UserProfile.UNCHANGED:
+            return
+        profile.last_location_update = captured_at
+        if change == UserProfile.MOVED:
+            profile.latitude = lat
+            profile.longitude = lng
+            moved.append(profile)
+        else:
+            heartbeats.append(profile)
+
+    def metrics(self):
+        """Snapshot of counters plus the age of the oldest unflushed fix"""
+        with self._lock:
+            data = dict(self._metrics)
+            data['pending'] = len(self._pending)
+            oldest = min((fix[3] for fix in self._pending.values()), default=None)
+        data['oldest_pending_age_ms'] = round((time.monotonic() - oldest) * 1000, 3) if oldest is not None else 0.0
+        data['flush_interval_s'] = self.interval
+        return data
+
+
+def flush_on_exit(buffer):
+    """Register a best-effort flush when the process exits"""
+    def _flush():
+        try:
+            buffer.stop()
+        except Exception:
+            logger.exception('Location buffer flush at exit failed')
+    atexit.register(_flush)
+
+
+location_buffer = LocationBuffer()
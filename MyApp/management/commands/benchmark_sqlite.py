@@ -0,0 +1,159 @@
+# benchmark_sqlite.py - Compare concurrent location-write throughput across SQLite profiles
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import OperationalError, connection, connections
+from django.test import override_settings
+
+from MyApp.models import UserProfile
+
+PROFILES = ('development', 'production')
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(int(len(values) * fraction), len(values) - 1)]
+
+
+def run_workload(users, writers, readers, seconds):
+    """Hammer record_location from writer threads while reader threads query profiles; returns stats"""
+    from MyApp.views import record_location
+
+    stop = threading.Event()
+    lock = threading.Lock()
+    stats = {'writes': 0, 'reads': 0, 'errors': 0, 'write_latencies_ms': []}
+
+    def writer(index):
+        mine = users[index::writers]
+        step = 0
+        try:
+            while not stop.is_set():
+                user = mine[step % len(mine)]
+                step += 1
+                # Move far enough each time to take the full update_location path
+                lat, lng = 37.7 + (step % 100) * 0.002, -122.4 + index * 0.01
+                started = time.perf_counter()
+                try:
+                    record_location(user, lat, lng)
+                except OperationalError:
+                    with lock:
+                        stats['errors'] += 1
+                    continue
+                elapsed = (time.perf_counter() - started) * 1000
+                with lock:
+                    stats['writes'] += 1
+                    stats['write_latencies_ms'].append(elapsed)
+        finally:
+            connection.close()
+
+    def reader():
+        try:
+            while not stop.is_set():
+                try:
+                    list(UserProfile.objects.within_bbox(-123, 37, -121, 39).values_list('user_id', 'latitude')[:200])
+                except OperationalError:
+                    with lock:
+                        stats['errors'] += 1
+                    continue
+                with lock:
+                    stats['reads'] += 1
+        finally:
+            connection.close()
+
+    threads = [threading.Thread(target=writer, args=(i,)) for i in range(writers)]
+    threads += [threading.Thread(target=reader) for _ in range(readers)]
+    with override_settings(LOCATION_WRITE_BEHIND=False):
+        for thread in threads:
+            thread.start()
+        time.sleep(seconds)
+        stop.set()
+        for thread in threads:
+            thread.join()
+
+    latencies = stats.pop('write_latencies_ms')
+    with connection.cursor() as cursor:
+        cursor.execute('PRAGMA journal_mode')
+        journal_mode = cursor.fetchone()[0]
+    stats.update({
+        'profile': settings.DB_PROFILE,
+        'journal_mode': journal_mode,
+        'seconds': seconds,
+        'writers': writers,
+        'readers': readers,
+        'writes_per_second': round(stats['writes'] / seconds, 1),
+        'reads_per_second': round(stats['reads'] / seconds, 1),
+        'write_p50_ms': round(percentile(latencies, 0.5), 2),
+        'write_p95_ms': round(percentile(latencies, 0.95), 2),
+    })
+    return stats
+
+
+class Command(BaseCommand):
+    help = 'Benchmark concurrent update_location writes under the development and production SQLite profiles'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--writers', type=int, default=8, help='Threads recording locations')
+        parser.add_argument('--readers', type=int, default=2, help='Threads querying profiles meanwhile')
+        parser.add_argument('--users', type=int, default=200, help='Users to spread writes across')
+        parser.add_argument('--seconds', type=float, default=10.0, help='Duration of each run')
+        parser.add_argument('--profile', choices=PROFILES, action='append',
+                            help='Profile(s) to run (default: both)')
+        parser.add_argument('--json', action='store_true', help='Print results as JSON')
+        parser.add_argument('--worker', action='store_true', help='Internal: run one profile in this process')
+
+    def handle(self, *args, **options):
+        if options['worker']:
+            return self.run_worker(options)
+
+        results = []
+        for profile in options['profile'] or PROFILES:
+            results.append(self.run_profile(profile, options))
+
+        if options['json']:
+            self.stdout.write(json.dumps(results, indent=2))
+            return
+        self.stdout.write(f"{'profile':<12} {'journal':<8} {'writes/s':>9} {'reads/s':>9} {'p50 ms':>8} {'p95 ms':>8} {'errors':>7}")
+        for result in results:
+            self.stdout.write(
+                f"{result['profile']:<12} {result['journal_mode']:<8} {result['writes_per_second']:>9} "
+                f"{result['reads_per_second']:>9} {result['write_p50_ms']:>8} {result['write_p95_ms']:>8} "
+                f"{result['errors']:>7}"
+            )
+
+    def run_profile(self, profile, options):
+        """Migrate a scratch database and benchmark it in a child process using the given profile"""
+        with tempfile.TemporaryDirectory() as directory:
+            env = dict(os.environ, GEOMAP_DB_PROFILE=profile, GEOMAP_DB_NAME=os.path.join(directory, 'bench.sqlite3'))
+            manage = [sys.executable, os.path.join(settings.BASE_DIR, 'manage.py')]
+            subprocess.run(manage + ['migrate', '--verbosity', '0'], env=env, check=True)
+            self.stderr.write(f'Running {profile} profile for {options["seconds"]:.0f}s...')
+            worker = subprocess.run(
+                manage + [
+                    'benchmark_sqlite', '--worker',
+                    '--writers', str(options['writers']), '--readers', str(options['readers']),
+                    '--users', str(options['users']), '--seconds', str(options['seconds']),
+                ],
+                env=env, check=True, capture_output=True, text=True,
+            )
+        return json.loads(worker.stdout.strip().splitlines()[-1])
+
+    def run_worker(self, options):
+        if os.environ.get('GEOMAP_DB_NAME') is None:
+            raise CommandError('--worker only runs against a scratch database (GEOMAP_DB_NAME)')
+        User.objects.bulk_create([User(username=f'bench{i}') for i in range(options['users'])])
+        users = list(User.objects.filter(username__startswith='bench').order_by('id'))
+        UserProfile.objects.bulk_create([UserProfile(user=user, location_sharing_enabled=True) for user in users])
+        connections.close_all()
+
+        stats = run_workload(users, options['writers'], options['readers'], options['seconds'])
+        self.stdout.write(json.dumps(stats))
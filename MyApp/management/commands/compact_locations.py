@@ -0,0 +1,26 @@
+# compact_locations.py - Simplify old location history into daily tracks and delete the raw fixes
+from django.core.management.base import BaseCommand, CommandError
+
+from MyApp.tracks import compact_locations
+
+
+class Command(BaseCommand):
+    help = 'Fold raw UserLocation fixes past the retention window into simplified per-day LocationTracks'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=None,
+                            help='Keep raw fixes this many days (default: LOCATION_RAW_RETENTION_DAYS)')
+        parser.add_argument('--tolerance', type=float, default=None,
+                            help='Simplification tolerance in metres (default: LOCATION_SIMPLIFY_TOLERANCE_M)')
+
+    def handle(self, *args, **options):
+        if options['days'] is not None and options['days'] < 0:
+            raise CommandError('--days must not be negative')
+        stats = compact_locations(days=options['days'], tolerance_m=options['tolerance'])
+        ratio = stats['raw_points'] / stats['track_points'] if stats['track_points'] else 0
+        self.stdout.write(self.style.SUCCESS(
+            f"Compacted {stats['raw_points']} fixes before {stats['cutoff']} into {stats['days']} tracks "
+            f"for {stats['users']} users ({stats['track_points']} points, {ratio:.1f}x smaller) "
+            f"in {stats['seconds']:.2f}s; deleted {stats['orphans_deleted']} fixes without a user "
+            f"and {stats['tracks_expired']} expired tracks"
+        ))
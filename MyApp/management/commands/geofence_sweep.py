@@ -0,0 +1,17 @@
+# geofence_sweep.py - Send dwell events for users who stay inside a geofence without moving
+import time
+
+from django.core.management.base import BaseCommand
+
+from MyApp.geofences import sweep_dwell
+
+
+class Command(BaseCommand):
+    help = ('Create dwell events for geofences whose owner has been inside for dwell_seconds; '
+            'stationary users send no fixes, so run this every minute or so')
+
+    def handle(self, *args, **options):
+        started = time.perf_counter()
+        events = sweep_dwell()
+        elapsed = time.perf_counter() - started
+        self.stdout.write(self.style.SUCCESS(f"Created {len(events)} dwell events in {elapsed:.2f}s"))
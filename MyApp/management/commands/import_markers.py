@@ -0,0 +1,38 @@
+# import_markers.py - Load markers from a GeoJSON or NDJSON file in bulk
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+
+from MyApp.marker_io import (
+    FORMATS, IMPORT_BATCH_SIZE, ImportFormatError, guess_format, import_markers, markers_replaced
+)
+
+
+class Command(BaseCommand):
+    help = 'Stream markers from a GeoJSON FeatureCollection or NDJSON file into the database'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help="File to read, or '-' for stdin")
+        parser.add_argument('--format', choices=FORMATS, help='Input format (default: guessed from the file name)')
+        parser.add_argument('--batch-size', type=int, default=IMPORT_BATCH_SIZE, help='Markers per bulk_create')
+
+    def handle(self, *args, **options):
+        path = options['path']
+        data_format = options['format'] or guess_format(path)
+        try:
+            if path == '-':
+                stats = import_markers(sys.stdin.buffer, data_format, options['batch_size'])
+            else:
+                with open(path, 'rb') as stream:
+                    stats = import_markers(stream, data_format, options['batch_size'])
+        except (OSError, ImportFormatError) as e:
+            raise CommandError(f'Import failed: {e}')
+        finally:
+            markers_replaced()
+
+        for error in stats['errors']:
+            self.stderr.write(f"Rejected feature {error['index']}: {error['error']}")
+        self.stdout.write(self.style.SUCCESS(
+            f"Imported {stats['imported']} markers ({stats['rejected']} rejected) in {stats['seconds']:.2f}s: "
+            f"{stats['markers_per_second']} markers/s"
+        ))
@@ -0,0 +1,142 @@
+# loadtest.py - Reproducible load test of the location/proximity hot path on a scratch database
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.test import override_settings
+from django.test.utils import setup_test_environment
+
+from MyApp import loadtest
+from MyApp.location_buffer import location_buffer
+
+
+def concurrency_levels(value):
+    try:
+        levels = [int(level) for level in value.split(',')]
+    except ValueError:
+        levels = []
+    if not levels or min(levels) < 1:
+        raise CommandError('--concurrency takes a comma-separated list of positive integers, e.g. 1,4,16')
+    return levels
+
+
+def percent(change):
+    return 'n/a' if change is None else f'{change:+}%'
+
+
+class Command(BaseCommand):
+    help = ('Seed synthetic users, friendships and markers into a throwaway SQLite database and measure '
+            'throughput and latency of the hot-path views at several concurrency levels')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=10000, help='Users to seed (10k to 1M)')
+        parser.add_argument('--friends', type=int, default=10, help='Friends per user')
+        parser.add_argument('--markers', type=int, default=10000, help='Markers to seed')
+        parser.add_argument('--scenario', choices=sorted(loadtest.SCENARIOS), action='append',
+                            help='Scenario(s) to run (default: all)')
+        parser.add_argument('--concurrency', default='1,4,16', help='Comma-separated client counts')
+        parser.add_argument('--requests', type=int, default=500, help='Requests per scenario and concurrency level')
+        parser.add_argument('--seed', type=int, default=0, help='Random seed for data and requests')
+        parser.add_argument('--db', help='Reuse this SQLite file instead of a temporary one (seeded if empty)')
+        parser.add_argument('--output', help='Write the JSON report to this file')
+        parser.add_argument('--compare', help='Print the change against an earlier JSON report')
+        parser.add_argument('--worker', action='store_true', help='Internal: seed and run in this process')
+
+    def handle(self, *args, **options):
+        levels = concurrency_levels(options['concurrency'])
+        if options['worker']:
+            return self.run_worker(options, levels)
+
+        baseline = None
+        if options['compare']:
+            with open(options['compare']) as f:
+                baseline = json.load(f)
+
+        if options['db']:
+            report = self.run_in(os.path.abspath(options['db']), options)
+        else:
+            with tempfile.TemporaryDirectory() as directory:
+                report = self.run_in(os.path.join(directory, 'loadtest.sqlite3'), options)
+
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                json.dump(report, f, indent=2)
+            self.stderr.write(f'Report written to {options["output"]}')
+
+        self.stdout.write(f"{'scenario':<28} {'clients':>7} {'req/s':>9} {'p50 ms':>8} {'p90 ms':>8} "
+                          f"{'p99 ms':>8} {'queries':>7} {'errors':>6}")
+        for run in report['runs']:
+            self.stdout.write(
+                f"{run['scenario']:<28} {run['concurrency']:>7} {run['requests_per_second']:>9} "
+                f"{run['latency_ms']['p50']:>8} {run['latency_ms']['p90']:>8} {run['latency_ms']['p99']:>8} "
+                f"{run['queries_per_request'] if run['queries_per_request'] is not None else '-':>7} "
+                f"{run['errors']:>6}"
+            )
+
+        if baseline is not None:
+            self.stdout.write(f"\nChange against {options['compare']} ({baseline['environment'].get('commit')}):")
+            rows = loadtest.compare(baseline, report)
+            if not rows:
+                self.stdout.write('No scenario and concurrency level in common')
+            for row in rows:
+                old_rps, new_rps, rps_change = row['requests_per_second']
+                old_p90, new_p90, p90_change = row['p90_ms']
+                self.stdout.write(
+                    f"{row['scenario']:<28} {row['concurrency']:>7} req/s {old_rps} -> {new_rps} "
+                    f"({percent(rps_change)})  p90 {old_p90} -> {new_p90} ms ({percent(p90_change)})"
+                )
+
+    def run_in(self, path, options):
+        """Migrate the database at path and run the worker against it in a child process"""
+        env = dict(os.environ, GEOMAP_DB_NAME=path)
+        manage = [sys.executable, os.path.join(settings.BASE_DIR, 'manage.py')]
+        subprocess.run(manage + ['migrate', '--verbosity', '0'], env=env, check=True)
+        command = manage + [
+            'loadtest', '--worker',
+            '--users', str(options['users']), '--friends', str(options['friends']),
+            '--markers', str(options['markers']), '--concurrency', options['concurrency'],
+            '--requests', str(options['requests']), '--seed', str(options['seed']),
+        ]
+        for scenario in options['scenario'] or []:
+            command += ['--scenario', scenario]
+        # Progress goes straight to our stderr; the report is the last line of stdout
+        worker = subprocess.run(command, env=env, check=True, stdout=subprocess.PIPE, text=True)
+        return json.loads(worker.stdout.strip().splitlines()[-1])
+
+    def run_worker(self, options, levels):
+        if os.environ.get('GEOMAP_DB_NAME') is None:
+            raise CommandError('--worker only runs against a scratch database (GEOMAP_DB_NAME)')
+        setup_test_environment()  # Lets the test client's "testserver" host through ALLOWED_HOSTS
+        rng = random.Random(options['seed'])
+
+        seeded = None
+        if not User.objects.filter(username__startswith=loadtest.USERNAME_PREFIX).exists():
+            seeded = loadtest.seed(options['users'], options['friends'], options['markers'], rng, self.stderr)
+
+        users = loadtest.load_users(max(levels), rng)
+        if not users:
+            raise CommandError('The database has no seeded users')
+        runs = []
+        # Query counts come from the request metrics; profiling would skew the timings
+        with override_settings(REQUEST_METRICS=True, REQUEST_PROFILE_THRESHOLD_MS=None):
+            for name in options['scenario'] or list(loadtest.SCENARIOS):
+                for concurrency in levels:
+                    self.stderr.write(f'Running {name} with {concurrency} clients...')
+                    runs.append(loadtest.run_scenario(name, users, concurrency, options['requests'], options['seed']))
+        location_buffer.flush()
+
+        report = {
+            'environment': loadtest.environment(),
+            'scale': {'users': options['users'], 'friends': options['friends'], 'markers': options['markers']},
+            'seeded': seeded,
+            'created_at': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+            'runs': runs,
+        }
+        self.stdout.write(json.dumps(report))
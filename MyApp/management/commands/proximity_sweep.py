@@ -0,0 +1,169 @@
+# proximity_sweep.py - Evaluate every active proximity alert in one batch
+import time
+
+import numpy as np
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.utils import timezone
+
+from MyApp.events import publish_notifications
+from MyApp.models import Friendship, ProximityAlert, ProximityNotification, UserProfile
+from MyApp.nearest import to_unit_vectors
+from MyApp.proximity import (
+    geodesic_km, haversine_km, notification_message, BOUNDARY_TOLERANCE
+)
+from MyApp.spatial import EARTH_RADIUS_KM
+
+QUERY_CHUNK_SIZE = 900  # Stay below SQLite's bound-parameter limit
+
+
+def grid_cells(lats, lngs, cell_km):
+    """Bucket coordinates into a 3D grid over the sphere with cells cell_km wide
+
+    Two points within cell_km of each other (great-circle) are always in the
+    same or neighbouring cells, with no special cases at poles or the antimeridian.
+    """
+    return np.floor(to_unit_vectors(lats, lngs) * (EARTH_RADIUS_KM / cell_km)).astype(np.int64)
+
+
+def load_profiles():
+    """Return (user_ids, lats, lngs, sharing, notify) arrays for located profiles, sorted by user id"""
+    rows = UserProfile.objects.filter(latitude__isnull=False, longitude__isnull=False).order_by('user_id').values_list(
+        'user_id', 'latitude', 'longitude', 'location_sharing_enabled', 'proximity_notifications_enabled'
+    )
+    user_ids, lats, lngs, sharing, notify = [], [], [], [], []
+    for user_id, lat, lng, is_sharing, is_notified in rows.iterator(chunk_size=10000):
+        user_ids.append(user_id)
+        lats.append(float(lat))
+        lngs.append(float(lng))
+        sharing.append(is_sharing)
+        notify.append(is_notified)
+    return (
+        np.array(user_ids, dtype=np.int64), np.array(lats), np.array(lngs),
+        np.array(sharing, dtype=bool), np.array(notify, dtype=bool),
+    )
+
+
+def load_alerts():
+    """Return (alert_ids, user_ids, friend_ids, thresholds) arrays for active alerts"""
+    rows = ProximityAlert.objects.filter(is_active=True).order_by().values_list(
+        'id', 'user_id', 'friend_id', 'distance_threshold'
+    )
+    data = np.array(list(rows.iterator(chunk_size=10000)), dtype=np.float64).reshape(-1, 4)
+    return data[:, 0].astype(np.int64), data[:, 1].astype(np.int64), data[:, 2].astype(np.int64), data[:, 3]
+
+
+def lookup(sorted_ids, ids):
+    """Positions of ids in sorted_ids, with a mask of which were found"""
+    positions = np.searchsorted(sorted_ids, ids)
+    positions = np.minimum(positions, max(len(sorted_ids) - 1, 0))
+    found = sorted_ids[positions] == ids if len(sorted_ids) else np.zeros(len(ids), dtype=bool)
+    return positions, found
+
+
+def in_chunks(values, size=QUERY_CHUNK_SIZE):
+    for start in range(0, len(values), size):
+        yield values[start:start + size]
+
+
+def sweep(now=None, dry_run=False):
+    """Check every active alert once and bulk-create due notifications; returns stats"""
+    now = now or timezone.now()
+    stats = {'profiles': 0, 'alerts': 0, 'candidates': 0, 'in_range': 0, 'notifications': 0}
+
+    user_ids, lats, lngs, sharing, notify = load_profiles()
+    alert_ids, alert_users, alert_friends, thresholds = load_alerts()
+    stats['profiles'], stats['alerts'] = len(user_ids), len(alert_ids)
+
+    # Alerts fire for users with notifications on, about friends who share their location
+    u, user_found = lookup(user_ids, alert_users)
+    f, friend_found = lookup(user_ids, alert_friends)
+    # A non-positive threshold can never fire and would make the grid cells zero-sized
+    valid = user_found & friend_found & (thresholds > 0)
+    valid[valid] = notify[u[valid]] & sharing[f[valid]]
+    if not valid.any():
+        return stats
+
+    cells = grid_cells(lats, lngs, thresholds[valid].max())
+    valid[valid] = np.all(np.abs(cells[u[valid]] - cells[f[valid]]) <= 1, axis=1)
+    alert_ids, u, f, thresholds = alert_ids[valid], u[valid], f[valid], thresholds[valid]
+    stats['candidates'] = len(alert_ids)
+    if not len(alert_ids):
+        return stats
+
+    # Mutual alerts share one distance computation per unordered pair
+    pairs, inverse = np.unique(np.minimum(u, f) * len(user_ids) + np.maximum(u, f), return_inverse=True)
+    first, second = pairs // len(user_ids), pairs % len(user_ids)
+    pair_distances = haversine_km(lats[first], lngs[first], lats[second], lngs[second])
+    distances = pair_distances[inverse]
+
+    boundary = np.unique(inverse[np.abs(distances - thresholds) <= thresholds * BOUNDARY_TOLERANCE])
+    if len(boundary):
+        pair_distances[boundary] = geodesic_km(
+            lats[first[boundary]], lngs[first[boundary]], lats[second[boundary]], lngs[second[boundary]]
+        )
+        distances = pair_distances[inverse]
+
+    hits = np.flatnonzero(distances <= thresholds)
+    friends = Friendship.get_friends_many({int(user_ids[u[i]]) for i in hits.tolist()})
+    hits = [i for i in hits.tolist() if int(user_ids[f[i]]) in friends[int(user_ids[u[i]])]]
+    stats['in_range'] = len(hits)
+    if not hits:
+        return stats
+
+    recent = ProximityNotification.recently_sent(
+        [(int(user_ids[u[i]]), int(user_ids[f[i]])) for i in hits], now
+    )
+    due = [
+        i for i in hits
+        if (int(user_ids[u[i]]), int(user_ids[f[i]])) not in recent
+    ]
+    if not due or dry_run:
+        stats['notifications'] = len(due)
+        return stats
+
+    friend_ids = sorted({int(user_ids[f[i]]) for i in due})
+    usernames = {}
+    for chunk in in_chunks(friend_ids):
+        usernames.update(User.objects.filter(id__in=chunk).values_list('id', 'username'))
+
+    notifications = []
+    for i in due:
+        friend_id = int(user_ids[f[i]])
+        distance = float(distances[i])
+        notifications.append(ProximityNotification(
+            user_id=int(user_ids[u[i]]),
+            friend_id=friend_id,
+            distance=round(distance, 2),
+            message=notification_message(usernames[friend_id], distance),
+        ))
+
+    with transaction.atomic():
+        ProximityNotification.objects.bulk_create(notifications, batch_size=QUERY_CHUNK_SIZE)
+        for chunk in in_chunks(alert_ids[due].tolist()):
+            ProximityAlert.objects.filter(id__in=chunk).update(last_triggered=now)
+    ProximityNotification.remember_sent(notifications)
+
+    publish_notifications(notifications, usernames)
+
+    stats['notifications'] = len(notifications)
+    return stats
+
+
+class Command(BaseCommand):
+    help = 'Check proximity alerts for all users at once and create due notifications'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true', help='Report notifications without creating them')
+
+    def handle(self, *args, **options):
+        started = time.perf_counter()
+        stats = sweep(dry_run=options['dry_run'])
+        elapsed = time.perf_counter() - started
+        self.stdout.write(self.style.SUCCESS(
+            f"Swept {stats['profiles']} profiles and {stats['alerts']} alerts in {elapsed:.2f}s: "
+            f"{stats['candidates']} candidate pairs, {stats['in_range']} in range, "
+            f"{stats['notifications']} notifications"
+            + (' (dry run)' if options['dry_run'] else '')
+        ))
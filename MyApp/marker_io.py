@@ -0,0 +1,267 @@
+# marker_io.py - Streaming GeoJSON / NDJSON import and export of markers
+import codecs
+import json
+import time
+
+from . import tiles
+from .clustering import cluster_index
+from .models import Marker, MarkerChange
+from .nearest import marker_index
+
+IMPORT_BATCH_SIZE = 5000
+EXPORT_CHUNK_SIZE = 5000
+READ_SIZE = 64 * 1024
+MAX_REPORTED_ERRORS = 20
+MAX_VALUE_SIZE = 1024 * 1024  # Largest single feature accepted, so bad input cannot fill memory
+
+FORMATS = ('geojson', 'ndjson')
+CONTENT_TYPES = {
+    'geojson': 'application/geo+json',
+    'ndjson': 'application/x-ndjson',
+}
+
+
+class ImportFormatError(ValueError):
+    """The input is not a GeoJSON FeatureCollection or NDJSON stream"""
+
+
+def guess_format(name, default='geojson'):
+    """Pick a format from a file name or content type"""
+    name = (name or '').lower()
+    if name.endswith(('.ndjson', '.jsonl')) or 'ndjson' in name or 'jsonl' in name:
+        return 'ndjson'
+    if name.endswith(('.geojson', '.json')) or 'json' in name:
+        return 'geojson'
+    return default
+
+
+class _Reader:
+    """Pull JSON values out of a byte or text stream without holding more than one value in memory"""
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.decoder = codecs.getincrementaldecoder('utf-8')()
+        self.json = json.JSONDecoder()
+        self.buffer = ''
+        self.pos = 0
+        self.eof = False
+
+    def _fill(self):
+        if self.eof:
+            return False
+        data = self.stream.read(READ_SIZE)
+        if isinstance(data, str):
+            text = data
+        else:
+            text = self.decoder.decode(data, final=not data)
+        if not data:
+            self.eof = True
+        # Drop what has been consumed so the buffer only holds the current value
+        self.buffer = self.buffer[self.pos:] + text
+        self.pos = 0
+        return bool(data)
+
+    def peek(self):
+        """Return the next non-whitespace character, or '' at the end of the stream"""
+        while True:
+            while self.pos < len(self.buffer) and self.buffer[self.pos] in ' \t\r\n':
+                self.pos += 1
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if not self._fill():
+                return ''
+
+    def expect(self, char):
+        if self.peek() != char:
+            raise ImportFormatError(f'Expected {char!r}')
+        self.pos += 1
+
+    def value(self):
+        """Decode the next JSON value, reading more input until it is complete"""
+        self.peek()
+        while True:
+            try:
+                value, end = self.json.raw_decode(self.buffer, self.pos)
+            except json.JSONDecodeError:
+                if len(self.buffer) - self.pos > MAX_VALUE_SIZE or not self._fill():
+                    raise ImportFormatError('Truncated or invalid JSON')
+                continue
+            if end == len(self.buffer) and not self.eof:
+                # A number at the end of the buffer may continue in the next read
+                self._fill()
+                continue
+            self.pos = end
+            return value
+
+
+def iter_geojson(stream):
+    """Yield the features of a FeatureCollection one at a time"""
+    reader = _Reader(stream)
+    reader.expect('{')
+    if reader.peek() == '}':
+        return
+    while True:
+        key = reader.value()
+        reader.expect(':')
+        if key == 'features':
+            reader.expect('[')
+            if reader.peek() == ']':
+                reader.pos += 1
+            else:
+                while True:
+                    yield reader.value()
+                    char = reader.peek()
+                    reader.pos += 1
+                    if char == ']':
+                        break
+                    if char != ',':
+                        raise ImportFormatError("Expected ',' or ']' in features")
+        else:
+            reader.value()  # Skip other members such as "type" or "crs"
+
+        char = reader.peek()
+        reader.pos += 1
+        if char == '}':
+            return
+        if char != ',':
+            raise ImportFormatError("Expected ',' or '}' in FeatureCollection")
+
+
+def iter_ndjson(stream):
+    """Yield one decoded object per non-empty line
+
+    Malformed lines are yielded as ImportFormatError instances so that one
+    bad line is reported without aborting the rest of the import.
+    """
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    pending = ''
+    while True:
+        data = stream.read(READ_SIZE)
+        text = data if isinstance(data, str) else decoder.decode(data, final=not data)
+        lines = (pending + text).split('\n')
+        pending = lines.pop() if data else ''
+        for line in lines:
+            line = line.strip()
+            if line:
+                try:
+                    yield json.loads(line)
+                except json.JSONDecodeError as e:
+                    yield ImportFormatError(f'Invalid JSON line: {e}')
+        if not data:
+            return
+
+
+def feature_to_marker(feature):
+    """Build an unsaved Marker from a GeoJSON Point feature or a flat latitude/longitude record"""
+    if not isinstance(feature, dict):
+        raise ValueError('Feature is not an object')
+    if feature.get('type') == 'Feature':
+        geometry = feature.get('geometry') or {}
+        if geometry.get('type') != 'Point':
+            raise ValueError('Only Point geometries are supported')
+        longitude, latitude = geometry['coordinates'][:2]
+        properties = feature.get('properties') or {}
+    else:
+        latitude, longitude = feature['latitude'], feature['longitude']
+        properties = feature
+
+    latitude, longitude = float(latitude), float(longitude)
+    if not (-90 <= latitude <= 90 and -180 <= longitude <= 180):
+        raise ValueError('Coordinates out of range')
+    return Marker(
+        latitude=round(latitude, 7),
+        longitude=round(longitude, 7),
+        title=str(properties.get('title') or 'Location Point')[:200],
+        description=properties.get('description') or '',
+    )
+
+
+def import_markers(stream, format='geojson', batch_size=IMPORT_BATCH_SIZE):
+    """Stream markers from a file-like object into the database in bulk_create batches; returns stats
+
+    The import is logged as one MarkerChange reset entry, not one per marker.
+    """
+    if format not in FORMATS:
+        raise ImportFormatError(f'Unknown format {format!r}')
+    features = iter_ndjson(stream) if format == 'ndjson' else iter_geojson(stream)
+
+    started = time.perf_counter()
+    stats = {'imported': 0, 'rejected': 0, 'errors': []}
+    batch = []
+    try:
+        for index, feature in enumerate(features):
+            try:
+                if isinstance(feature, Exception):
+                    raise feature
+                batch.append(feature_to_marker(feature))
+            except (KeyError, IndexError, TypeError, ValueError) as e:
+                stats['rejected'] += 1
+                if len(stats['errors']) < MAX_REPORTED_ERRORS:
+                    stats['errors'].append({'index': index, 'error': str(e) or type(e).__name__})
+                continue
+            if len(batch) >= batch_size:
+                Marker.objects.bulk_create_unlogged(batch)
+                stats['imported'] += len(batch)
+                batch = []
+        if batch:
+            Marker.objects.bulk_create_unlogged(batch)
+            stats['imported'] += len(batch)
+    finally:
+        if stats['imported']:
+            # One reset entry rather than one per marker, so change-feed clients reload once
+            MarkerChange.record_reset()
+
+    return _with_throughput(stats, stats['imported'], started)
+
+
+def export_markers(format='geojson', stats=None):
+    """Yield the whole marker table as GeoJSON or NDJSON text chunks
+
+    stats, if given, is filled in with the count and throughput once the
+    generator is exhausted.
+    """
+    if format not in FORMATS:
+        raise ImportFormatError(f'Unknown format {format!r}')
+    started = time.perf_counter()
+    count = 0
+    rows = Marker.objects.order_by('id').values_list(
+        'id', 'latitude', 'longitude', 'title', 'description'
+    ).iterator(chunk_size=EXPORT_CHUNK_SIZE)
+
+    if format == 'geojson':
+        yield '{"type": "FeatureCollection", "features": [\n'
+    chunk = []
+    for marker_id, latitude, longitude, title, description in rows:
+        feature = {
+            'type': 'Feature',
+            'id': marker_id,
+            'geometry': {'type': 'Point', 'coordinates': [float(longitude), float(latitude)]},
+            'properties': {'title': title, 'description': description or ''},
+        }
+        separator = ',\n' if format == 'geojson' and count else ''
+        chunk.append(separator + json.dumps(feature) + ('\n' if format == 'ndjson' else ''))
+        count += 1
+        if len(chunk) >= EXPORT_CHUNK_SIZE:
+            yield ''.join(chunk)
+            chunk = []
+    if chunk:
+        yield ''.join(chunk)
+    if format == 'geojson':
+        yield '\n]}\n'
+
+    if stats is not None:
+        stats.update(_with_throughput({'exported': count}, count, started))
+
+
+def _with_throughput(stats, count, started):
+    elapsed = time.perf_counter() - started
+    stats['seconds'] = round(elapsed, 3)
+    stats['markers_per_second'] = round(count / elapsed) if elapsed > 0 else count
+    return stats
+
+
+def markers_replaced():
+    """Drop this process's in-memory marker indexes and all tile versions after a bulk load"""
+    marker_index.invalidate()
+    cluster_index.invalidate()
+    tiles.bump_all()
@@ -0,0 +1,69 @@
+# Generated by Django 5.2.4 on 2026-10-18 02:31
+
+from django.db import migrations, models
+
+GEOHASH_BASE32 = '0123456789bcdefghjkmnpqrstuvwxyz'
+
+
+def geohash_encode(lat, lng, precision=9):
+    # Frozen copy of MyApp.spatial.geohash_encode as of this migration
+    lat_range = [-90.0, 90.0]
+    lng_range = [-180.0, 180.0]
+    chars = []
+    bits = 0
+    bit_count = 0
+    even = True
+
+    while len(chars) < precision:
+        rng, value = (lng_range, lng) if even else (lat_range, lat)
+        mid = (rng[0] + rng[1]) / 2
+        if value >= mid:
+            bits = (bits << 1) | 1
+            rng[0] = mid
+        else:
+            bits = bits << 1
+            rng[1] = mid
+        even = not even
+        bit_count += 1
+        if bit_count == 5:
+            chars.append(GEOHASH_BASE32[bits])
+            bits = 0
+            bit_count = 0
+
+    return ''.join(chars)
+
+
+def backfill_geohash(apps, schema_editor):
+    for model_name in ('Marker', 'UserProfile'):
+        model = apps.get_model('MyApp', model_name)
+        rows = model.objects.exclude(latitude=None).exclude(longitude=None).only('latitude', 'longitude')
+        batch = []
+        for row in rows.iterator(chunk_size=2000):
+            row.geohash = geohash_encode(float(row.latitude), float(row.longitude))
+            batch.append(row)
+            if len(batch) >= 2000:
+                model.objects.bulk_update(batch, ['geohash'])
+                batch = []
+        if batch:
+            model.objects.bulk_update(batch, ['geohash'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('MyApp', '0008_proximitynotification_userprofile_friendship_and_more'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='marker',
+            name='geohash',
+            field=models.CharField(blank=True, db_index=True, default='', editable=False, max_length=12),
+        ),
+        migrations.AddField(
+            model_name='userprofile',
+            name='geohash',
+            field=models.CharField(blank=True, db_index=True, default='', editable=False, max_length=12),
+        ),
+        migrations.RunPython(backfill_geohash, migrations.RunPython.noop),
+    ]
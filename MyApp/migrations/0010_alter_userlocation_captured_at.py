@@ -0,0 +1,19 @@
+# Generated by Django 5.2.18 on 2026-10-18 02:42
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('MyApp', '0009_marker_geohash_userprofile_geohash'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='userlocation',
+            name='captured_at',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+    ]
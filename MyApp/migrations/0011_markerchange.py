@@ -0,0 +1,22 @@
+# Generated by Django 5.2.18 on 2026-10-18 02:50
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('MyApp', '0010_alter_userlocation_captured_at'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MarkerChange',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('marker_id', models.BigIntegerField(blank=True, null=True)),
+                ('action', models.CharField(choices=[('create', 'Create'), ('update', 'Update'), ('delete', 'Delete'), ('clear', 'Clear')], max_length=10)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+    ]
@@ -0,0 +1,34 @@
+# Generated by Django 5.2.18 on 2026-10-18 03:00
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('MyApp', '0011_markerchange'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='LocationTrack',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('day', models.DateField()),
+                ('started_at', models.DateTimeField()),
+                ('ended_at', models.DateTimeField()),
+                ('points', models.JSONField(default=list)),
+                ('point_count', models.PositiveIntegerField(default=0)),
+                ('raw_count', models.PositiveIntegerField(default=0)),
+                ('compacted_at', models.DateTimeField(auto_now=True)),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'ordering': ['day'],
+                'unique_together': {('user', 'day')},
+            },
+        ),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 5.2.18 on 2026-10-18 03:02
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('MyApp', '0012_locationtrack'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='userlocation',
+            index=models.Index(fields=['user', 'captured_at'], name='userlocation_user_time_idx'),
+        ),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 5.2.18 on 2026-10-18 03:07
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('MyApp', '0013_userlocation_user_time_idx'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='proximitynotification',
+            index=models.Index(fields=['user', 'friend', 'created_at'], name='notification_cooldown_idx'),
+        ),
+    ]
@@ -0,0 +1,61 @@
+# Generated by Django 5.2.18 on 2026-10-18 03:17
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('MyApp', '0014_notification_cooldown_idx'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Geofence',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=100)),
+                ('shape', models.CharField(choices=[('circle', 'Circle'), ('polygon', 'Polygon')], max_length=10)),
+                ('latitude', models.FloatField(blank=True, null=True)),
+                ('longitude', models.FloatField(blank=True, null=True)),
+                ('radius_m', models.FloatField(blank=True, null=True)),
+                ('vertices', models.JSONField(blank=True, default=list)),
+                ('dwell_seconds', models.PositiveIntegerField(blank=True, null=True)),
+                ('is_active', models.BooleanField(default=True)),
+                ('min_lat', models.FloatField(default=0, editable=False)),
+                ('max_lat', models.FloatField(default=0, editable=False)),
+                ('min_lng', models.FloatField(default=0, editable=False)),
+                ('max_lng', models.FloatField(default=0, editable=False)),
+                ('entered_at', models.DateTimeField(blank=True, null=True)),
+                ('dwell_sent', models.BooleanField(default=False)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='geofences', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='GeofenceEvent',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('event', models.CharField(choices=[('enter', 'Enter'), ('exit', 'Exit'), ('dwell', 'Dwell')], max_length=10)),
+                ('latitude', models.FloatField(blank=True, null=True)),
+                ('longitude', models.FloatField(blank=True, null=True)),
+                ('message', models.TextField()),
+                ('is_read', models.BooleanField(default=False)),
+                ('occurred_at', models.DateTimeField()),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('geofence', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='events', to='MyApp.geofence')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='geofence_events', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='geofence',
+            index=models.Index(fields=['user', 'min_lat', 'max_lat'], name='geofence_bbox_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='geofenceevent',
+            index=models.Index(fields=['user', 'created_at'], name='geofence_event_user_idx'),
+        ),
+    ]
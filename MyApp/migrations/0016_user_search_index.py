@@ -0,0 +1,43 @@
+# Generated by Django 5.2.18 on 2026-10-18 03:19
+
+import unicodedata
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+def normalize_username(value):
+    # Frozen copy of MyApp.models.normalize_username as of this migration
+    return unicodedata.normalize('NFKC', value).casefold()
+
+
+def backfill_search_index(apps, schema_editor):
+    User = apps.get_model(*settings.AUTH_USER_MODEL.split('.'))
+    UserSearchIndex = apps.get_model('MyApp', 'UserSearchIndex')
+    batch = []
+    for user_id, username in User.objects.values_list('id', 'username').iterator(chunk_size=2000):
+        batch.append(UserSearchIndex(user_id=user_id, username=normalize_username(username)))
+        if len(batch) >= 2000:
+            UserSearchIndex.objects.bulk_create(batch)
+            batch = []
+    if batch:
+        UserSearchIndex.objects.bulk_create(batch)
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('MyApp', '0015_geofences'),
+        ('auth', '0012_alter_user_first_name_max_length'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UserSearchIndex',
+            fields=[
+                ('user', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='search_index', serialize=False, to=settings.AUTH_USER_MODEL)),
+                ('username', models.CharField(db_index=True, max_length=150)),
+            ],
+        ),
+        migrations.RunPython(backfill_search_index, migrations.RunPython.noop),
+    ]
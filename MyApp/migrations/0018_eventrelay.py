@@ -0,0 +1,23 @@
+# Generated by Django 5.2.18 on 2026-10-18 03:45
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('MyApp', '0017_liveevent'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='EventRelay',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('origin', models.CharField(max_length=100, unique=True)),
+                ('user_ids', models.JSONField(default=list)),
+                ('seen_at', models.DateTimeField(db_index=True, default=django.utils.timezone.now)),
+            ],
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 03:46
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('MyApp', '0018_eventrelay'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='markerchange',
+            name='action',
+            field=models.CharField(choices=[('create', 'Create'), ('update', 'Update'), ('delete', 'Delete'), ('clear', 'Clear'), ('reset', 'Reset')], max_length=10),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 03:48
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('MyApp', '0019_markerchange_reset'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='locationtrack',
+            name='raw_through_id',
+            field=models.BigIntegerField(default=0),
+        ),
+    ]
@@ -1,6 +1,10 @@
 # from django.db import models
 # from django.contrib.auth.models import User
 # from django.conf import settings
+from django.core.cache import cache
+from django.core.exceptions import ValidationError
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import Signal, receiver
 
 # class Marker(models.Model):
 #     title = models.CharField(max_length=200, default='Location Point')
@@ -46,11 +50,161 @@
 #         return self.name
 
 # models.py
+import math
+import re
+import unicodedata
+from datetime import timedelta
+
 from django.contrib.auth.models import User
-from django.db import models
+from django.db import models, router, transaction
+from django.db.models import functions
 from django.utils import timezone
 from django.conf import settings
-from geopy.distance import geodesic
+from .proximity import haversine_km, profile_distances_km, NOTIFICATION_COOLDOWN
+from .spatial import geohash_encode, geohash_cover, point_in_polygon, split_bbox, radius_bbox, EARTH_RADIUS_KM
+
+FRIEND_CACHE_TIMEOUT = 60  # Invalidation only reaches this process's cache; others may lag this long
+FRIEND_QUERY_CHUNK_SIZE = 450  # Two IN lists per query must fit SQLite's bound-parameter limit
+MARKER_CHANGE_BATCH_SIZE = 900
+INDEX_CATCH_UP_MAX = 10000  # In-memory marker indexes reload rather than replay more changes than this
+NOTIFICATION_QUERY_CHUNK_SIZE = 450  # Pairs per cooldown query; two IN lists must fit SQLite's limit
+LIVE_EVENT_RETENTION_SECONDS = 300  # Outbox rows older than this are pruned; relays must keep up within it
+
+# Spatial lookups
+class SpatialQuerySet(models.QuerySet):
+    """QuerySet for models with latitude/longitude and an indexed geohash column"""
+
+    def within_bbox(self, west, south, east, north):
+        """Filter to rows inside a (west, south, east, north) bbox using the geohash index"""
+        cells = models.Q()
+        for prefix in sorted(geohash_cover(west, south, east, north)):
+            if prefix:
+                # Range scan instead of LIKE so SQLite can use the index
+                cells |= models.Q(geohash__gte=prefix, geohash__lt=prefix + '~')
+
+        bounds = models.Q()
+        for box_west, box_south, box_east, box_north in split_bbox(west, south, east, north):
+            bounds |= models.Q(
+                latitude__gte=box_south, latitude__lte=box_north,
+                longitude__gte=box_west, longitude__lte=box_east,
+            )
+        return self.filter(cells, bounds)
+
+    def bulk_create(self, objs, *args, **kwargs):
+        objs = list(objs)
+        for obj in objs:
+            sync_geohash(obj)
+        return super().bulk_create(objs, *args, **kwargs)
+
+    def bulk_update(self, objs, fields, *args, **kwargs):
+        objs = list(objs)
+        if {'latitude', 'longitude'} & set(fields):
+            for obj in objs:
+                sync_geohash(obj)
+            fields = list(set(fields) | {'geohash'})
+        return super().bulk_update(objs, fields, *args, **kwargs)
+
+    def near(self, lat, lng, radius_km):
+        """Filter to rows within radius_km of a point, annotated with distance in km"""
+        west, south, east, north = radius_bbox(lat, lng, radius_km)
+        return self.within_bbox(west, south, east, north).annotate(
+            distance=haversine_expression(lat, lng)
+        ).filter(distance__lte=radius_km)
+
+
+def haversine_expression(lat, lng):
+    """Database expression for the great-circle distance in km from a point"""
+    lat_rad = functions.Radians(functions.Cast('latitude', models.FloatField()))
+    lng_rad = functions.Radians(functions.Cast('longitude', models.FloatField()))
+    origin_lat, origin_lng = math.radians(lat), math.radians(lng)
+    a = (
+        functions.Power(functions.Sin((lat_rad - origin_lat) / 2), 2)
+        + math.cos(origin_lat) * functions.Cos(lat_rad)
+        * functions.Power(functions.Sin((lng_rad - origin_lng) / 2), 2)
+    )
+    return models.ExpressionWrapper(
+        2 * EARTH_RADIUS_KM * functions.ASin(functions.Sqrt(a)),
+        output_field=models.FloatField(),
+    )
+
+
+def sync_geohash(instance, kwargs=None):
+    """Recompute the geohash column from latitude/longitude before a save"""
+    if instance.latitude is None or instance.longitude is None:
+        instance.geohash = ''
+    else:
+        instance.geohash = geohash_encode(float(instance.latitude), float(instance.longitude))
+
+    update_fields = (kwargs or {}).get('update_fields')
+    if update_fields is not None and {'latitude', 'longitude'} & set(update_fields):
+        kwargs['update_fields'] = set(update_fields) | {'geohash'}
+
+# Sent on commit with positions=[(lat, lng), ...] touched by a marker change,
+# or positions=None when every marker may have changed
+markers_changed = Signal()
+
+class MarkerQuerySet(SpatialQuerySet):
+    """SpatialQuerySet that writes bulk changes to the MarkerChange log"""
+
+    def positions(self, ids):
+        """{id: (latitude, longitude)} for the given marker ids that exist"""
+        ids = list(ids)
+        found = {}
+        for start in range(0, len(ids), MARKER_CHANGE_BATCH_SIZE):
+            chunk = ids[start:start + MARKER_CHANGE_BATCH_SIZE]
+            for marker_id, lat, lng in self.filter(id__in=chunk).values_list('id', 'latitude', 'longitude'):
+                found[marker_id] = (lat, lng)
+        return found
+
+    def bulk_create(self, objs, *args, **kwargs):
+        with transaction.atomic(using=self.db):
+            created = super().bulk_create(objs, *args, **kwargs)
+            MarkerChange.record(MarkerChange.CREATE, [
+                (obj.pk, None, (obj.latitude, obj.longitude)) for obj in created if obj.pk is not None
+            ], self.db)
+        return created
+
+    def bulk_update(self, objs, fields, *args, **kwargs):
+        objs = list(objs)
+        with transaction.atomic(using=self.db):
+            before = Marker.objects.using(self.db).positions(obj.pk for obj in objs)
+            rows = super().bulk_update(objs, fields, *args, **kwargs)
+            MarkerChange.record(MarkerChange.UPDATE, [
+                (obj.pk, before[obj.pk], (obj.latitude, obj.longitude)) for obj in objs if obj.pk in before
+            ], self.db)
+        return rows
+
+    def update(self, **kwargs):
+        with transaction.atomic(using=self.db):
+            before = {marker_id: (lat, lng) for marker_id, lat, lng in self.values_list('id', 'latitude', 'longitude')}
+            rows = super().update(**kwargs)
+            after = Marker.objects.using(self.db).positions(before)
+            MarkerChange.record(MarkerChange.UPDATE, [
+                (marker_id, position, after.get(marker_id)) for marker_id, position in before.items()
+            ], self.db)
+        return rows
+
+    def delete(self):
+        with transaction.atomic(using=self.db):
+            if not self.query.has_filters():
+                # Deleting everything is logged as one entry, not one per marker
+                result = super().delete()
+                MarkerChange.record_clear(self.db)
+                return result
+            before = list(self.values_list('id', 'latitude', 'longitude'))
+            result = super().delete()
+            MarkerChange.record(MarkerChange.DELETE, [
+                (marker_id, (lat, lng), None) for marker_id, lat, lng in before
+            ], self.db)
+            return result
+
+    def delete_unlogged(self):
+        """Delete without change entries, for callers that log the change themselves"""
+        return super().delete()
+
+    def bulk_create_unlogged(self, objs, *args, **kwargs):
+        """bulk_create without change entries, for callers that log the change themselves"""
+        return super().bulk_create(objs, *args, **kwargs)
 
 # Your existing models
 class Marker(models.Model):
@@ -58,23 +212,167 @@ class Marker(models.Model):
     description = models.TextField(blank=True, null=True)
     latitude = models.DecimalField(max_digits=10, decimal_places=7)
     longitude = models.DecimalField(max_digits=10, decimal_places=7)
+    geohash = models.CharField(max_length=12, blank=True, default='', editable=False, db_index=True)
     created_at = models.DateTimeField(auto_now_add=True)
+
+    objects = MarkerQuerySet.as_manager()
     
     def __str__(self):
         return f"{self.title} at ({self.latitude}, {self.longitude})"
+
+    def save(self, *args, **kwargs):
+        sync_geohash(self, kwargs)
+        adding = self._state.adding
+        action = MarkerChange.CREATE if adding else MarkerChange.UPDATE
+        using = kwargs.get('using') or router.db_for_write(Marker, instance=self)
+        with transaction.atomic(using=using):
+            before = None if adding else Marker.objects.using(using).positions([self.pk]).get(self.pk)
+            super().save(*args, **kwargs)
+            MarkerChange.record(action, [(self.pk, before, (self.latitude, self.longitude))], using)
+
+    def delete(self, *args, **kwargs):
+        marker_id = self.pk
+        using = kwargs.get('using') or router.db_for_write(Marker, instance=self)
+        with transaction.atomic(using=using):
+            before = Marker.objects.using(using).positions([marker_id]).get(marker_id)
+            result = super().delete(*args, **kwargs)
+            MarkerChange.record(MarkerChange.DELETE, [(marker_id, before, None)], using)
+        return result
     
     class Meta:
         ordering = ['-created_at']
 
+class MarkerChange(models.Model):
+    """Append-only log of marker changes; its id is the cursor clients sync from"""
+    CREATE = 'create'
+    UPDATE = 'update'
+    DELETE = 'delete'
+    CLEAR = 'clear'
+    RESET = 'reset'  # Markers changed in bulk, e.g. an import; clients reload everything
+    RESYNC_ACTIONS = (CLEAR, RESET)
+
+    ACTION_CHOICES = [
+        (CREATE, 'Create'),
+        (UPDATE, 'Update'),
+        (DELETE, 'Delete'),
+        (CLEAR, 'Clear'),
+        (RESET, 'Reset'),
+    ]
+
+    marker_id = models.BigIntegerField(null=True, blank=True)  # Not a foreign key: deletes must outlive the marker
+    action = models.CharField(max_length=10, choices=ACTION_CHOICES)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f"#{self.id} {self.action} marker {self.marker_id}"
+
+    @classmethod
+    def record(cls, action, changes, using=None):
+        """Append one entry per (marker_id, before, after) and send markers_changed on commit
+
+        before and after are (lat, lng) positions, or None where the marker
+        did not exist.
+        """
+        changes = list(changes)
+        if not changes:
+            return
+        cls.objects.db_manager(using).bulk_create(
+            [cls(action=action, marker_id=marker_id) for marker_id, _, _ in changes],
+            batch_size=MARKER_CHANGE_BATCH_SIZE,
+        )
+        positions = [position for _, before, after in changes for position in (before, after) if position]
+        transaction.on_commit(lambda: markers_changed.send(sender=Marker, positions=positions), using=using)
+
+    @classmethod
+    def record_clear(cls, using=None, action=CLEAR):
+        """Append a clear (or reset) entry and drop the history it makes irrelevant"""
+        change = cls.objects.db_manager(using).create(action=action)
+        cls.objects.db_manager(using).filter(id__lt=change.id).delete()
+        transaction.on_commit(lambda: markers_changed.send(sender=Marker, positions=None), using=using)
+        return change
+
+    @classmethod
+    def record_reset(cls, using=None):
+        """One entry for a bulk change, instead of one per marker, so clients reload once"""
+        return cls.record_clear(using, cls.RESET)
+
+    @classmethod
+    def latest_cursor(cls):
+        return cls.objects.aggregate(cursor=models.Max('id'))['cursor'] or 0
+
+    @classmethod
+    def snapshot(cls):
+        """(cursor, ids, lats, lngs) for every marker, to build an in-memory index from
+
+        The cursor is read first, so the rows include at least every change up
+        to it; changes_since(cursor) then brings the index up to date.
+        """
+        cursor = cls.latest_cursor()
+        ids, lats, lngs = [], [], []
+        rows = Marker.objects.order_by().values_list('id', 'latitude', 'longitude').iterator(chunk_size=10000)
+        for marker_id, lat, lng in rows:
+            ids.append(marker_id)
+            lats.append(float(lat))
+            lngs.append(float(lng))
+        return cursor, ids, lats, lngs
+
+    @classmethod
+    def changes_since(cls, cursor, limit=INDEX_CATCH_UP_MAX):
+        """(cursor, {marker_id: (lat, lng) or None}) for markers changed after cursor
+
+        Positions are read from the markers now, None meaning deleted, so
+        applying them is idempotent. Returns None after a clear or reset entry,
+        a log reset or more than limit entries; callers then rebuild from snapshot().
+        """
+        entries = list(
+            cls.objects.filter(id__gt=cursor).order_by('id').values_list('id', 'marker_id', 'action')[:limit + 1]
+        )
+        if not entries:
+            # A cursor past the end means the log was reset, e.g. a test rollback
+            return None if cursor > cls.latest_cursor() else (cursor, {})
+        if len(entries) > limit or any(action in cls.RESYNC_ACTIONS for _, _, action in entries):
+            return None
+        changed = {marker_id for _, marker_id, _ in entries}
+        positions = {
+            marker_id: (float(lat), float(lng))
+            for marker_id, (lat, lng) in Marker.objects.positions(changed).items()
+        }
+        return entries[-1][0], {marker_id: positions.get(marker_id) for marker_id in changed}
+
 class UserLocation(models.Model):
     user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, null=True, blank=True)
     latitude = models.DecimalField(max_digits=9, decimal_places=6)
     longitude = models.DecimalField(max_digits=9, decimal_places=6)
     accuracy_m = models.IntegerField(null=True, blank=True)
-    captured_at = models.DateTimeField(auto_now_add=True)
+    captured_at = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        indexes = [
+            # Serves history range scans and per-user compaction
+            models.Index(fields=['user', 'captured_at'], name='userlocation_user_time_idx'),
+        ]
 
     def __str__(self):
         return f"{self.latitude}, {self.longitude} at {self.captured_at}"
+
+class LocationTrack(models.Model):
+    """One user's simplified path for one UTC day, written by compact_locations"""
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE)
+    day = models.DateField()
+    started_at = models.DateTimeField()
+    ended_at = models.DateTimeField()
+    points = models.JSONField(default=list)  # [[latitude, longitude, unix seconds], ...] in time order
+    point_count = models.PositiveIntegerField(default=0)
+    raw_count = models.PositiveIntegerField(default=0)  # Raw fixes folded into this track so far
+    raw_through_id = models.BigIntegerField(default=0)  # Highest UserLocation id folded in; rows up to it await deletion
+    compacted_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        unique_together = ('user', 'day')
+        ordering = ['day']
+
+    def __str__(self):
+        return f"{self.user} on {self.day} ({self.point_count} of {self.raw_count} points)"
   
 class Task(models.Model):
     user = models.ForeignKey(User, on_delete=models.CASCADE)
@@ -96,6 +394,9 @@ class Location(models.Model):
     def __str__(self):
         return self.name
 
+# Sent with profiles=[UserProfile, ...] after their new positions are saved
+location_moved = Signal()
+
 # New location/friends models
 class UserProfile(models.Model):
     user = models.OneToOneField(User, on_delete=models.CASCADE)
@@ -104,25 +405,61 @@ class UserProfile(models.Model):
     last_location_update = models.DateTimeField(null=True, blank=True)
     location_sharing_enabled = models.BooleanField(default=False)
     proximity_notifications_enabled = models.BooleanField(default=True)
+    geohash = models.CharField(max_length=12, blank=True, default='', editable=False, db_index=True)
+
+    objects = SpatialQuerySet.as_manager()
     
     def __str__(self):
         return f"{self.user.username}'s Profile"
+
+    def save(self, *args, **kwargs):
+        sync_geohash(self, kwargs)
+        super().save(*args, **kwargs)
     
-    def update_location(self, lat, lng):
-        """Update user's location and timestamp"""
-        self.latitude = lat
-        self.longitude = lng
-        self.last_location_update = timezone.now()
-        self.save()
+    # How a new fix is stored, see classify_fix()
+    MOVED = 'moved'
+    HEARTBEAT = 'heartbeat'
+    UNCHANGED = 'unchanged'
+
+    def classify_fix(self, lat, lng, captured_at):
+        """Decide whether a fix moves the profile, only refreshes its timestamp, or needs no write"""
+        if self.latitude is None or self.longitude is None:
+            return self.MOVED
+        if self.last_location_update and captured_at < self.last_location_update:
+            return self.UNCHANGED  # Never move a profile back to an older fix
+        metres = float(haversine_km(float(self.latitude), float(self.longitude), lat, lng)) * 1000
+        if metres >= settings.LOCATION_MIN_MOVE_M:
+            return self.MOVED
+        if (self.last_location_update is None or (captured_at - self.last_location_update).total_seconds()
+                >= settings.LOCATION_HEARTBEAT_SECONDS):
+            return self.HEARTBEAT
+        return self.UNCHANGED
+
+    def update_location(self, lat, lng, captured_at=None):
+        """Store a fix, writing only the columns that change; returns MOVED, HEARTBEAT or UNCHANGED
+
+        Moves of LOCATION_MIN_MOVE_M or more send location_moved.
+        """
+        captured_at = captured_at or timezone.now()
+        change = self.classify_fix(lat, lng, captured_at)
+        if change == self.UNCHANGED:
+            return change
+
+        self.last_location_update = captured_at
+        fields = ['last_location_update']
+        if change == self.MOVED:
+            self.latitude = lat
+            self.longitude = lng
+            fields += ['latitude', 'longitude']
+        self.save(update_fields=None if self._state.adding else fields)
+
+        if change == self.MOVED:
+            location_moved.send(sender=UserProfile, profiles=[self])
+        return change
     
     def get_distance_to(self, other_profile):
         """Calculate distance to another user in kilometers"""
-        if not all([self.latitude, self.longitude, other_profile.latitude, other_profile.longitude]):
-            return None
-        
-        coords_1 = (float(self.latitude), float(self.longitude))
-        coords_2 = (float(other_profile.latitude), float(other_profile.longitude))
-        return geodesic(coords_1, coords_2).kilometers
+        return profile_distances_km(self, [other_profile])[0]
 
 class Friendship(models.Model):
     PENDING = 'pending'
@@ -150,10 +487,169 @@ class Friendship(models.Model):
     @classmethod
     def get_friends(cls, user):
         """Get all accepted friends for a user"""
-        return User.objects.filter(
-            models.Q(friend_requests_sent__addressee=user, friend_requests_sent__status=cls.ACCEPTED) |
-            models.Q(friend_requests_received__requester=user, friend_requests_received__status=cls.ACCEPTED)
-        ).distinct()
+        return User.objects.filter(id__in=cls.get_friend_ids(user.id))
+
+    @classmethod
+    def get_friend_ids(cls, user_id, cached=True):
+        """Get the set of accepted friend IDs for a user
+
+        Pass cached=False where the answer grants access to someone's data, so
+        an unfriend made through another process takes effect at once.
+        """
+        return cls.get_friends_many([user_id], cached)[user_id]
+
+    @classmethod
+    def get_friends_many(cls, user_ids, cached=True):
+        """Map each user ID to a frozenset of accepted friend IDs, loading cache misses in bulk"""
+        user_ids = set(user_ids)
+        cached = cache.get_many([friend_cache_key(user_id) for user_id in user_ids]) if cached else {}
+        friends = {
+            user_id: frozenset(cached[friend_cache_key(user_id)])
+            for user_id in user_ids if friend_cache_key(user_id) in cached
+        }
+
+        missing = sorted(user_ids - friends.keys())
+        adjacency = {user_id: set() for user_id in missing}
+        for start in range(0, len(missing), FRIEND_QUERY_CHUNK_SIZE):
+            chunk = missing[start:start + FRIEND_QUERY_CHUNK_SIZE]
+            pairs = cls.objects.filter(
+                models.Q(requester_id__in=chunk) | models.Q(addressee_id__in=chunk),
+                status=cls.ACCEPTED,
+            ).values_list('requester_id', 'addressee_id')
+            for requester_id, addressee_id in pairs:
+                if requester_id in adjacency:
+                    adjacency[requester_id].add(addressee_id)
+                if addressee_id in adjacency:
+                    adjacency[addressee_id].add(requester_id)
+
+        if adjacency:
+            cache.set_many(
+                {friend_cache_key(user_id): sorted(ids) for user_id, ids in adjacency.items()},
+                FRIEND_CACHE_TIMEOUT,
+            )
+            friends.update((user_id, frozenset(ids)) for user_id, ids in adjacency.items())
+        return friends
+
+
+def friend_cache_key(user_id):
+    return f'friends:{user_id}'
+
+
+@receiver([post_save, post_delete], sender=Friendship)
+def invalidate_friend_cache(sender, instance, **kwargs):
+    """Drop both users' cached friend sets whenever a friendship changes"""
+    cache.delete_many([friend_cache_key(instance.requester_id), friend_cache_key(instance.addressee_id)])
+
+# Autocomplete results are cached per normalized prefix and limit; see UserSearchIndex.autocomplete().
+# Only the limits the view asks for are cached, so invalidation knows every key a prefix can have.
+AUTOCOMPLETE_CACHE_TIMEOUT = 10 * 60
+AUTOCOMPLETE_LIMIT = 10
+AUTOCOMPLETE_CACHED_LIMITS = (AUTOCOMPLETE_LIMIT, AUTOCOMPLETE_LIMIT + 1)  # The view fetches one extra to drop the viewer
+SEARCH_INDEX_CHUNK_SIZE = 900
+SEARCH_RANGE_END = '\U0010ffff'  # Sorts after any character, closing a prefix range
+USERNAME_CHARS = re.compile(r'[\w.@+-]+\Z')  # What Django's username validator allows
+
+
+def normalize_username(value):
+    """Canonical form usernames are indexed and searched by"""
+    return unicodedata.normalize('NFKC', value).casefold()
+
+
+class UserSearchIndex(models.Model):
+    """Normalized username of each user, indexed for prefix search
+
+    Kept up to date by a post_save receiver on User; writes that bypass
+    save(), such as bulk_create, have to call index_users() themselves.
+    """
+    user = models.OneToOneField(User, on_delete=models.CASCADE, primary_key=True, related_name='search_index')
+    username = models.CharField(max_length=150, db_index=True)
+
+    def __str__(self):
+        return self.username
+
+    @classmethod
+    def prefix_range(cls, query):
+        """Filter arguments selecting usernames that start with query, as an index range scan"""
+        prefix = normalize_username(query)
+        return {'username__gte': prefix, 'username__lt': prefix + SEARCH_RANGE_END}
+
+    @classmethod
+    def search(cls, query, viewer, limit=AUTOCOMPLETE_LIMIT):
+        """Users whose username starts with query, with the viewer's friendship status, in one query"""
+        status = Friendship.objects.filter(
+            models.Q(requester_id=viewer.id, addressee_id=models.OuterRef('user_id'))
+            | models.Q(requester_id=models.OuterRef('user_id'), addressee_id=viewer.id)
+        ).values('status')[:1]
+        rows = (
+            cls.objects.filter(**cls.prefix_range(query)).exclude(user_id=viewer.id)
+            .order_by('username', 'user_id')
+            .annotate(friendship_status=models.Subquery(status))
+            .values_list('user_id', 'user__username', 'friendship_status')[:limit]
+        )
+        return [{'id': user_id, 'username': username, 'friendship_status': friendship_status}
+                for user_id, username, friendship_status in rows]
+
+    @classmethod
+    def autocomplete(cls, query, limit=AUTOCOMPLETE_LIMIT):
+        """[(user_id, username), ...] starting with query, cached per normalized prefix and limit"""
+        prefix = normalize_username(query)
+        if not USERNAME_CHARS.match(prefix) or len(prefix) > User._meta.get_field('username').max_length:
+            return []  # Cannot match a username, and would not make a valid cache key
+        cached = limit in AUTOCOMPLETE_CACHED_LIMITS
+        key = autocomplete_cache_key(prefix, limit)
+        matches = cache.get(key) if cached else None
+        if matches is None:
+            matches = list(
+                cls.objects.filter(**cls.prefix_range(query)).order_by('username', 'user_id')
+                .values_list('user_id', 'user__username')[:limit]
+            )
+            if cached:
+                cache.set(key, matches, AUTOCOMPLETE_CACHE_TIMEOUT)
+        return matches
+
+    @classmethod
+    def index_users(cls, users):
+        """Create or refresh index rows for users, dropping cached autocomplete results they affect"""
+        users = list(users)
+        existing = {}
+        for start in range(0, len(users), SEARCH_INDEX_CHUNK_SIZE):
+            chunk = [user.id for user in users[start:start + SEARCH_INDEX_CHUNK_SIZE]]
+            existing.update(cls.objects.filter(user_id__in=chunk).values_list('user_id', 'username'))
+        changed = [cls(user_id=user.id, username=normalize_username(user.username)) for user in users]
+        changed = [entry for entry in changed if existing.get(entry.user_id) != entry.username]
+        if not changed:
+            return
+        cls.objects.bulk_create(
+            changed, batch_size=SEARCH_INDEX_CHUNK_SIZE,
+            update_conflicts=True, unique_fields=['user'], update_fields=['username'],
+        )
+        stale = {entry.username for entry in changed} | {existing[entry.user_id] for entry in changed
+                                                        if entry.user_id in existing}
+        invalidate_autocomplete(stale)
+
+
+def autocomplete_cache_key(prefix, limit):
+    return f'usersearch:{limit}:{prefix}'
+
+
+def invalidate_autocomplete(usernames):
+    """Drop the cached results of every prefix of the given normalized usernames"""
+    cache.delete_many(list({
+        autocomplete_cache_key(username[:length], limit)
+        for username in usernames for length in range(1, len(username) + 1) for limit in AUTOCOMPLETE_CACHED_LIMITS
+    }))
+
+
+@receiver(post_save, sender=User)
+def update_user_search_index(sender, instance, created, update_fields=None, **kwargs):
+    """Index new users and renames; saves that only touch other fields, like last_login, are skipped"""
+    if created or update_fields is None or 'username' in update_fields:
+        UserSearchIndex.index_users([instance])
+
+
+@receiver(post_delete, sender=UserSearchIndex)
+def forget_user_search_entry(sender, instance, **kwargs):
+    invalidate_autocomplete([instance.username])
 
 class ProximityAlert(models.Model):
     user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='proximity_alerts')
@@ -169,6 +665,10 @@ class ProximityAlert(models.Model):
     def __str__(self):
         return f"{self.user.username} -> {self.friend.username} alert"
 
+    def clean(self):
+        if not is_finite_number(self.distance_threshold) or self.distance_threshold <= 0:
+            raise ValidationError('distance_threshold must be a positive number of kilometers')
+
 class ProximityNotification(models.Model):
     user = models.ForeignKey(User, on_delete=models.CASCADE)
     friend = models.ForeignKey(User, on_delete=models.CASCADE, related_name='friend_notifications')
@@ -176,6 +676,242 @@ class ProximityNotification(models.Model):
     message = models.TextField()
     is_read = models.BooleanField(default=False)
     created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            # Serves the cooldown lookup for cache misses
+            models.Index(fields=['user', 'friend', 'created_at'], name='notification_cooldown_idx'),
+        ]
     
     def __str__(self):
-        return f"Notification for {self.user.username}: {self.friend.username} is nearby"
\ No newline at end of file
+        return f"Notification for {self.user.username}: {self.friend.username} is nearby"
+
+    @classmethod
+    def recently_sent(cls, pairs, now=None):
+        """Return the (user_id, friend_id) pairs notified within NOTIFICATION_COOLDOWN
+
+        Only sends are cached, until their cooldown ends. A pair never notified
+        is always checked against the cooldown index, since the send may come
+        from another process whose cache this one cannot see.
+        """
+        now = now or timezone.now()
+        since = (now - NOTIFICATION_COOLDOWN).timestamp()
+        pairs = set(pairs)
+        cached = cache.get_many([cooldown_cache_key(*pair) for pair in pairs])
+        last_sent = {pair: cached[cooldown_cache_key(*pair)] for pair in pairs if cooldown_cache_key(*pair) in cached}
+
+        missing = sorted(pairs - last_sent.keys())
+        for start in range(0, len(missing), NOTIFICATION_QUERY_CHUNK_SIZE):
+            chunk = missing[start:start + NOTIFICATION_QUERY_CHUNK_SIZE]
+            wanted = set(chunk)
+            rows = cls.objects.filter(
+                user_id__in={user_id for user_id, _ in chunk},
+                friend_id__in={friend_id for _, friend_id in chunk},
+                created_at__gte=now - NOTIFICATION_COOLDOWN,
+            ).values_list('user_id', 'friend_id').annotate(last=models.Max('created_at')).order_by()
+            loaded = {(user_id, friend_id): last for user_id, friend_id, last in rows if (user_id, friend_id) in wanted}
+            cls.remember_sent_at(loaded, now)
+            last_sent.update((pair, last.timestamp()) for pair, last in loaded.items())
+
+        return {pair for pair, sent in last_sent.items() if sent >= since}
+
+    @classmethod
+    def remember_sent_at(cls, sent, now=None):
+        """Cache {(user_id, friend_id): sent_at} until each pair's cooldown ends"""
+        now = now or timezone.now()
+        for (user_id, friend_id), sent_at in sent.items():
+            remaining = (sent_at + NOTIFICATION_COOLDOWN - now).total_seconds()
+            if remaining > 0:
+                cache.set(cooldown_cache_key(user_id, friend_id), sent_at.timestamp(), remaining)
+
+    @classmethod
+    def remember_sent(cls, notifications):
+        """Start the cooldown for each notification's pair, for writes that bypass post_save"""
+        cls.remember_sent_at({
+            (notification.user_id, notification.friend_id): notification.created_at for notification in notifications
+        })
+
+
+def cooldown_cache_key(user_id, friend_id):
+    return f'notified:{user_id}:{friend_id}'
+
+
+@receiver(post_save, sender=ProximityNotification)
+def start_notification_cooldown(sender, instance, created, **kwargs):
+    if created:
+        ProximityNotification.remember_sent([instance])
+
+
+@receiver(post_delete, sender=ProximityNotification)
+def reset_notification_cooldown(sender, instance, **kwargs):
+    """Forget the cached send time so the next check reads what is left in the table"""
+    cache.delete(cooldown_cache_key(instance.user_id, instance.friend_id))
+
+def is_finite_number(value):
+    """A real int or float that is not NaN or infinite; booleans do not count"""
+    return isinstance(value, (int, float)) and not isinstance(value, bool) and math.isfinite(value)
+
+
+class GeofenceQuerySet(models.QuerySet):
+    def bulk_create(self, objs, *args, **kwargs):
+        objs = list(objs)
+        for obj in objs:
+            obj.sync_bbox()
+        return super().bulk_create(objs, *args, **kwargs)
+
+
+class Geofence(models.Model):
+    """A user's named circle or polygon; the user's fixes crossing it create GeofenceEvents"""
+    CIRCLE = 'circle'
+    POLYGON = 'polygon'
+
+    SHAPE_CHOICES = [
+        (CIRCLE, 'Circle'),
+        (POLYGON, 'Polygon'),
+    ]
+
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='geofences')
+    name = models.CharField(max_length=100)
+    shape = models.CharField(max_length=10, choices=SHAPE_CHOICES)
+    latitude = models.FloatField(null=True, blank=True)  # Circle centre
+    longitude = models.FloatField(null=True, blank=True)
+    radius_m = models.FloatField(null=True, blank=True)
+    vertices = models.JSONField(default=list, blank=True)  # Polygon ring [[latitude, longitude], ...], not closed
+    dwell_seconds = models.PositiveIntegerField(null=True, blank=True)  # Send a dwell event after this long inside
+    is_active = models.BooleanField(default=True)
+    # Bounding box, kept in sync by save() and used to prefilter fixes
+    min_lat = models.FloatField(default=0, editable=False)
+    max_lat = models.FloatField(default=0, editable=False)
+    min_lng = models.FloatField(default=0, editable=False)
+    max_lng = models.FloatField(default=0, editable=False)
+    # Whether the owner is inside, updated as fixes arrive
+    entered_at = models.DateTimeField(null=True, blank=True)
+    dwell_sent = models.BooleanField(default=False)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    objects = GeofenceQuerySet.as_manager()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['user', 'min_lat', 'max_lat'], name='geofence_bbox_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.user.username}: {self.name} ({self.shape})"
+
+    def clean(self):
+        if self.shape == self.CIRCLE:
+            if not all(is_finite_number(value) for value in (self.latitude, self.longitude, self.radius_m)) \
+                    or self.radius_m <= 0:
+                raise ValidationError('A circle needs latitude, longitude and a positive radius_m')
+            if not (-90 <= self.latitude <= 90 and -180 <= self.longitude <= 180):
+                raise ValidationError('Circle centre is out of range')
+        elif self.shape == self.POLYGON:
+            if not isinstance(self.vertices, list) or len(self.vertices) < 3:
+                raise ValidationError('A polygon needs at least three [latitude, longitude] vertices')
+            for vertex in self.vertices:
+                if (not isinstance(vertex, (list, tuple)) or len(vertex) != 2
+                        or not all(is_finite_number(value) for value in vertex)
+                        or not (-90 <= vertex[0] <= 90 and -180 <= vertex[1] <= 180)):
+                    raise ValidationError(f'Invalid polygon vertex: {vertex!r}')
+        else:
+            raise ValidationError(f'Unknown shape: {self.shape!r}')
+
+    def save(self, *args, **kwargs):
+        self.sync_bbox()
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None and {'latitude', 'longitude', 'radius_m', 'vertices'} & set(update_fields):
+            kwargs['update_fields'] = set(update_fields) | {'min_lat', 'max_lat', 'min_lng', 'max_lng'}
+        super().save(*args, **kwargs)
+
+    def sync_bbox(self):
+        """Recompute the bounding box from the shape"""
+        if self.shape == self.CIRCLE:
+            west, south, east, north = radius_bbox(self.latitude, self.longitude, self.radius_m / 1000)
+            if west > east:  # Crosses the antimeridian; keep the box conservative
+                west, east = -180.0, 180.0
+            self.min_lat, self.max_lat, self.min_lng, self.max_lng = south, north, west, east
+        else:
+            lats = [vertex[0] for vertex in self.vertices]
+            lngs = [vertex[1] for vertex in self.vertices]
+            self.min_lat, self.max_lat, self.min_lng, self.max_lng = min(lats), max(lats), min(lngs), max(lngs)
+
+    def contains(self, lat, lng):
+        """Exact test of a point against the shape"""
+        if not (self.min_lat <= lat <= self.max_lat and self.min_lng <= lng <= self.max_lng):
+            return False
+        if self.shape == self.CIRCLE:
+            return float(haversine_km(self.latitude, self.longitude, lat, lng)) * 1000 <= self.radius_m
+        return point_in_polygon(lat, lng, self.vertices)
+
+
+class GeofenceEvent(models.Model):
+    """An enter, exit or dwell transition of a user across one of their geofences"""
+    ENTER = 'enter'
+    EXIT = 'exit'
+    DWELL = 'dwell'
+
+    EVENT_CHOICES = [
+        (ENTER, 'Enter'),
+        (EXIT, 'Exit'),
+        (DWELL, 'Dwell'),
+    ]
+
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='geofence_events')
+    geofence = models.ForeignKey(Geofence, on_delete=models.CASCADE, related_name='events')
+    event = models.CharField(max_length=10, choices=EVENT_CHOICES)
+    latitude = models.FloatField(null=True, blank=True)  # The fix that caused it; empty for swept dwells
+    longitude = models.FloatField(null=True, blank=True)
+    message = models.TextField()
+    is_read = models.BooleanField(default=False)
+    occurred_at = models.DateTimeField()
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['user', 'created_at'], name='geofence_event_user_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.user.username} {self.event} {self.geofence.name}"
+
+
+class LiveEvent(models.Model):
+    """Outbox of pushed events; each process with open event streams tails it by id
+
+    This carries events published by management commands and other workers
+    to the streams another process is serving. Rows are only needed for a
+    few minutes and are pruned as new ones are written.
+    """
+    origin = models.CharField(max_length=100)  # Publishing process, which already delivered it locally
+    user_ids = models.JSONField()
+    event = models.CharField(max_length=30)
+    data = models.JSONField()
+    created_at = models.DateTimeField(default=timezone.now, db_index=True)
+
+    def __str__(self):
+        return f"#{self.id} {self.event} for {len(self.user_ids)} users"
+
+    @classmethod
+    def latest_cursor(cls):
+        return cls.objects.aggregate(cursor=models.Max('id'))['cursor'] or 0
+
+    @classmethod
+    def prune(cls, now=None):
+        """Delete rows older than LIVE_EVENT_RETENTION_SECONDS"""
+        cutoff = (now or timezone.now()) - timedelta(seconds=LIVE_EVENT_RETENTION_SECONDS)
+        return cls.objects.filter(created_at__lt=cutoff).delete()[0]
+
+
+class EventRelay(models.Model):
+    """A process tailing LiveEvent, and the users whose streams it serves
+
+    Publishers only write to the outbox for users listed by a relay in
+    another process, so nothing is written when no stream is open elsewhere.
+    """
+    origin = models.CharField(max_length=100, unique=True)
+    user_ids = models.JSONField(default=list)
+    seen_at = models.DateTimeField(default=timezone.now, db_index=True)
+
+    def __str__(self):
+        return f"{self.origin} serving {len(self.user_ids)} users"
@@ -0,0 +1,213 @@
+# nearest.py - In-process k-nearest-neighbour index over Marker coordinates
+import heapq
+import threading
+
+import numpy as np
+
+from .models import MarkerChange
+from .proximity import haversine_km
+
+NEAREST_MAX_K = 50
+KDTREE_LEAF_SIZE = 32
+PENDING_MAX = 16384  # Adds scanned by brute force before the tree is rebuilt
+REBUILD_MIN_DELETES = 1024
+REBUILD_RATIO = 0.05  # Rebuild once tombstones exceed this share of the tree
+
+
+def to_unit_vectors(lat, lng):
+    """Convert degrees to (N, 3) points on the unit sphere"""
+    lat = np.radians(np.asarray(lat, dtype=np.float64))
+    lng = np.radians(np.asarray(lng, dtype=np.float64))
+    cos_lat = np.cos(lat)
+    return np.column_stack((cos_lat * np.cos(lng), cos_lat * np.sin(lng), np.sin(lat)))
+
+
+class KDTree:
+    """Static KD-tree over 3D points; chord distance preserves great-circle order"""
+
+    def __init__(self, points, leaf_size=KDTREE_LEAF_SIZE):
+        self.points = points
+        self.order = np.arange(len(points))
+        starts, ends, lefts, rights, mins, maxs = [], [], [], [], [], []
+
+        stack = [(0, len(points), None, None)] if len(points) else []
+        while stack:
+            start, end, parent, side = stack.pop()
+            node = len(starts)
+            if parent is not None:
+                (lefts if side == 0 else rights)[parent] = node
+
+            idx = self.order[start:end]
+            box = points[idx]
+            box_min, box_max = box.min(axis=0), box.max(axis=0)
+            starts.append(start)
+            ends.append(end)
+            lefts.append(-1)
+            rights.append(-1)
+            mins.append(box_min)
+            maxs.append(box_max)
+
+            if end - start > leaf_size:
+                dim = int(np.argmax(box_max - box_min))
+                mid = (start + end) // 2
+                self.order[start:end] = idx[np.argpartition(box[:, dim], mid - start)]
+                stack.append((mid, end, node, 1))
+                stack.append((start, mid, node, 0))
+
+        self.starts, self.ends = starts, ends
+        self.lefts, self.rights = lefts, rights
+        self.mins = np.array(mins).reshape(-1, 3)
+        self.maxs = np.array(maxs).reshape(-1, 3)
+
+    def _box_distance(self, node, query):
+        gap = np.maximum(self.mins[node] - query, 0) + np.maximum(query - self.maxs[node], 0)
+        return float(gap @ gap)
+
+    def query(self, query, k, alive=None):
+        """Return (squared chord distances, point positions) of the k nearest live points"""
+        best_d2 = np.empty(0)
+        best_pos = np.empty(0, dtype=np.int64)
+        if not len(self.points):
+            return best_d2, best_pos
+
+        heap = [(0.0, 0)]
+        while heap:
+            bound, node = heapq.heappop(heap)
+            if len(best_d2) == k and bound > best_d2.max():
+                break
+
+            if self.lefts[node] == -1:
+                idx = self.order[self.starts[node]:self.ends[node]]
+                if alive is not None:
+                    idx = idx[alive[idx]]
+                diff = self.points[idx] - query
+                d2 = np.einsum('ij,ij->i', diff, diff)
+                best_d2 = np.concatenate((best_d2, d2))
+                best_pos = np.concatenate((best_pos, idx))
+                if len(best_d2) > k:
+                    keep = np.argpartition(best_d2, k - 1)[:k]
+                    best_d2, best_pos = best_d2[keep], best_pos[keep]
+            else:
+                for child in (self.lefts[node], self.rights[node]):
+                    heapq.heappush(heap, (self._box_distance(child, query), child))
+
+        return best_d2, best_pos
+
+
+class NearestMarkerIndex:
+    """KD-tree snapshot of all markers plus a small delta of adds and tombstoned deletes
+
+    The index follows the MarkerChange log from the cursor of its snapshot,
+    so edits made by other processes, the admin or management commands show
+    up on the next query.
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._loaded = False
+        self._cursor = 0
+
+    def _reset(self, ids, lats, lngs):
+        self._ids = np.asarray(ids, dtype=np.int64)
+        self._lats = np.asarray(lats, dtype=np.float64)
+        self._lngs = np.asarray(lngs, dtype=np.float64)
+        self._tree = KDTree(to_unit_vectors(self._lats, self._lngs))
+        self._positions = {marker_id: pos for pos, marker_id in enumerate(self._ids.tolist())}
+        self._alive = np.ones(len(self._ids), dtype=bool)
+        self._deleted = 0
+        self._pending = {}
+        self._pending_arrays = None
+        self._loaded = True
+
+    def _ensure_loaded(self):
+        """Load on first use, then catch up with changes any process logged since"""
+        if self._loaded:
+            changes = MarkerChange.changes_since(self._cursor)
+            if changes is not None:
+                self._cursor, positions = changes
+                for marker_id, position in positions.items():
+                    if position is None:
+                        self.remove(marker_id)
+                    else:
+                        self.add(marker_id, *position)
+                return
+        self._cursor, ids, lats, lngs = MarkerChange.snapshot()
+        self._reset(ids, lats, lngs)
+
+    def _maybe_rebuild(self):
+        if (len(self._pending) >= PENDING_MAX
+                or self._deleted >= max(REBUILD_MIN_DELETES, REBUILD_RATIO * len(self._ids))):
+            live = self._alive
+            ids = self._ids[live].tolist() + list(self._pending)
+            lats = self._lats[live].tolist() + [lat for lat, lng in self._pending.values()]
+            lngs = self._lngs[live].tolist() + [lng for lat, lng in self._pending.values()]
+            self._reset(ids, lats, lngs)
+
+    def add(self, marker_id, lat, lng):
+        """Record a new or moved marker; no-op until the index is first used"""
+        with self._lock:
+            if not self._loaded:
+                return
+            self._tombstone(marker_id)
+            self._pending[marker_id] = (float(lat), float(lng))
+            self._pending_arrays = None
+            self._maybe_rebuild()
+
+    def remove(self, marker_id):
+        """Drop a marker from the index"""
+        with self._lock:
+            if not self._loaded:
+                return
+            if self._pending.pop(marker_id, None) is not None:
+                self._pending_arrays = None
+            self._tombstone(marker_id)
+            self._maybe_rebuild()
+
+    def _tombstone(self, marker_id):
+        pos = self._positions.get(marker_id)
+        if pos is not None and self._alive[pos]:
+            self._alive[pos] = False
+            self._deleted += 1
+
+    def clear(self):
+        """Forget every marker, e.g. after clear_markers"""
+        with self._lock:
+            self._reset([], [], [])
+
+    def invalidate(self):
+        """Reload from the database on next use"""
+        with self._lock:
+            self._loaded = False
+
+    def nearest(self, lat, lng, k):
+        """Return [(marker_id, distance_km)] for the k closest markers, nearest first"""
+        with self._lock:
+            self._ensure_loaded()
+            query = to_unit_vectors([lat], [lng])[0]
+
+            alive = self._alive if self._deleted else None
+            _, positions = self._tree.query(query, k, alive)
+            ids = self._ids[positions]
+            lats = self._lats[positions]
+            lngs = self._lngs[positions]
+
+            if self._pending:
+                if self._pending_arrays is None:
+                    coords = np.array(list(self._pending.values()), dtype=np.float64).reshape(-1, 2)
+                    self._pending_arrays = (np.fromiter(self._pending, dtype=np.int64), coords[:, 0], coords[:, 1])
+                pending_ids, pending_lats, pending_lngs = self._pending_arrays
+                ids = np.concatenate((ids, pending_ids))
+                lats = np.concatenate((lats, pending_lats))
+                lngs = np.concatenate((lngs, pending_lngs))
+
+        if not len(ids):
+            return []
+        distances = haversine_km(lat, lng, lats, lngs)
+        if len(distances) > k:
+            top = np.argpartition(distances, k - 1)[:k]
+            ids, distances = ids[top], distances[top]
+        ranked = np.argsort(distances, kind='stable')
+        return [(int(ids[i]), float(distances[i])) for i in ranked]
+
+
+marker_index = NearestMarkerIndex()
@@ -0,0 +1,105 @@
+# proximity.py - Vectorized distance checks between users
+from datetime import timedelta
+
+import numpy as np
+from geopy.distance import geodesic
+
+from .spatial import EARTH_RADIUS_KM
+
+# Haversine on a sphere differs from the WGS-84 geodesic by at most ~0.5%,
+# so only pairs this close (relatively) to their threshold need the exact answer
+BOUNDARY_TOLERANCE = 0.006
+
+# Minimum gap between two notifications for the same (user, friend) pair
+NOTIFICATION_COOLDOWN = timedelta(minutes=30)
+
+
+def haversine_km(lat1, lng1, lat2, lng2):
+    """Vectorized great-circle distance in kilometers"""
+    phi1, phi2 = np.radians(lat1), np.radians(lat2)
+    a = (
+        np.sin((phi2 - phi1) / 2) ** 2
+        + np.cos(phi1) * np.cos(phi2) * np.sin(np.radians(np.subtract(lng2, lng1)) / 2) ** 2
+    )
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.minimum(1.0, np.sqrt(a)))
+
+
+def pair_distances_km(lats1, lngs1, lats2, lngs2, thresholds=None):
+    """Element-wise distances between two coordinate arrays
+
+    When thresholds are given, pairs within BOUNDARY_TOLERANCE of their
+    threshold are recomputed with the exact geodesic so in/out-of-range
+    decisions match geopy.
+    """
+    lats1, lngs1, lats2, lngs2 = np.broadcast_arrays(
+        *(np.asarray(values, dtype=np.float64) for values in (lats1, lngs1, lats2, lngs2))
+    )
+    distances = np.atleast_1d(haversine_km(lats1, lngs1, lats2, lngs2))
+
+    if thresholds is not None:
+        thresholds = np.asarray(thresholds, dtype=np.float64)
+        boundary = np.flatnonzero(np.abs(distances - thresholds) <= thresholds * BOUNDARY_TOLERANCE)
+        distances[boundary] = geodesic_km(lats1[boundary], lngs1[boundary], lats2[boundary], lngs2[boundary])
+
+    return distances
+
+
+def geodesic_km(lats1, lngs1, lats2, lngs2):
+    """Exact WGS-84 distances, one geopy call per pair; use only on small subsets"""
+    return np.array([
+        geodesic((lat1, lng1), (lat2, lng2)).kilometers
+        for lat1, lng1, lat2, lng2 in zip(lats1, lngs1, lats2, lngs2)
+    ], dtype=np.float64)
+
+
+def notification_message(friend_username, distance):
+    """Text stored on a ProximityNotification"""
+    return f"{friend_username} is {round(distance, 2)}km away from you!"
+
+
+def distances_km(lat, lng, lats, lngs, thresholds=None):
+    """Distances from one point to many in one pass"""
+    return pair_distances_km(lat, lng, lats, lngs, thresholds)
+
+
+def has_location(profile):
+    """True when a profile has both coordinates set"""
+    return profile is not None and profile.latitude is not None and profile.longitude is not None
+
+
+def profile_distances_km(origin, profiles):
+    """Distances in km from origin to each profile, None where a location is missing"""
+    results = [None] * len(profiles)
+    if not has_location(origin):
+        return results
+
+    located = [i for i, profile in enumerate(profiles) if has_location(profile)]
+    if located:
+        distances = distances_km(
+            float(origin.latitude), float(origin.longitude),
+            [float(profiles[i].latitude) for i in located],
+            [float(profiles[i].longitude) for i in located],
+        )
+        for i, distance in zip(located, distances.tolist()):
+            results[i] = distance
+    return results
+
+
+def alerts_in_range(origin, alerts):
+    """Return [(alert, distance_km)] for alerts whose friend is within the alert threshold
+
+    Each alert must have friend.userprofile loaded with a location.
+    """
+    if not alerts or not has_location(origin):
+        return []
+
+    profiles = [alert.friend.userprofile for alert in alerts]
+    thresholds = np.array([alert.distance_threshold for alert in alerts], dtype=np.float64)
+    distances = distances_km(
+        float(origin.latitude), float(origin.longitude),
+        [float(profile.latitude) for profile in profiles],
+        [float(profile.longitude) for profile in profiles],
+        thresholds,
+    )
+    in_range = np.flatnonzero(distances <= thresholds)
+    return [(alerts[i], float(distances[i])) for i in in_range]
@@ -0,0 +1,77 @@
+# routers.py - Send safe-request reads to a read replica, everything else to the primary
+import time
+from contextvars import ContextVar
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, connections
+
+REPLICA_ALIAS = 'replica'
+PIN_SESSION_KEY = '_primary_pinned_until'
+WRITE_STATEMENTS = ('INSERT', 'UPDATE', 'DELETE', 'REPLACE')
+
+# Sessions must be readable right after they are written, so they never use the replica
+PRIMARY_ONLY_MODELS = {'sessions.session'}
+
+# Outside a request (management commands, background threads) everything stays on the primary
+_use_replica = ContextVar('geomap_use_replica', default=False)
+
+
+class PrimaryReplicaRouter:
+    """Route reads to REPLICA_ALIAS during read-only requests and all writes to the primary
+
+    ReplicaRoutingMiddleware decides per request whether replica reads are
+    allowed; the first write switches the rest of the request to the primary.
+    """
+
+    def db_for_read(self, model, **hints):
+        if (
+            not _use_replica.get()
+            or not settings.REPLICA_READS
+            or model._meta.label_lower in PRIMARY_ONLY_MODELS
+        ):
+            return DEFAULT_DB_ALIAS
+        return REPLICA_ALIAS
+
+    def db_for_write(self, model, **hints):
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        return True  # The replica holds the same data as the primary
+
+
+class ReplicaRoutingMiddleware:
+    """Enable replica reads for safe requests unless the session wrote recently
+
+    A request that writes to the primary keeps its session on the primary for
+    REPLICA_STICKY_SECONDS afterwards, so users always read their own writes.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        if not settings.REPLICA_READS:
+            return self.get_response(request)
+
+        session = getattr(request, 'session', None)
+        pinned_until = session.get(PIN_SESSION_KEY, 0) if session is not None else 0
+        read_only = request.method in ('GET', 'HEAD', 'OPTIONS') and pinned_until < time.time()
+
+        wrote = []
+
+        def observe(execute, sql, params, many, context):
+            if not wrote and sql.lstrip()[:7].upper().startswith(WRITE_STATEMENTS):
+                wrote.append(True)
+                _use_replica.set(False)
+            return execute(sql, params, many, context)
+
+        token = _use_replica.set(read_only)
+        try:
+            with connections[DEFAULT_DB_ALIAS].execute_wrapper(observe):
+                response = self.get_response(request)
+        finally:
+            _use_replica.reset(token)
+
+        if wrote and session is not None:
+            session[PIN_SESSION_KEY] = time.time() + getattr(settings, 'REPLICA_STICKY_SECONDS', 10)
+        return response
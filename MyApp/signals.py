@@ -0,0 +1,80 @@
+# signals.py - Receivers connected in MyappConfig.ready(), so they run whatever code saves the data
+from django.db import transaction
+from django.dispatch import receiver
+from django.utils import timezone
+
+from . import geofences, tiles
+from .events import publish_friend_location, publish_notifications
+from .models import Friendship, Marker, ProximityAlert, ProximityNotification, location_moved, markers_changed
+from .proximity import alerts_in_range, has_location, notification_message
+
+
+def check_proximity_alerts(user):
+    """Check if user is near any friends and send notifications"""
+    try:
+        user_profile = user.userprofile
+        if not (has_location(user_profile) and user_profile.proximity_notifications_enabled):
+            return
+        
+        # Get active proximity alerts for friends currently sharing a location
+        alerts = list(ProximityAlert.objects.filter(
+            user=user,
+            is_active=True,
+            friend__userprofile__location_sharing_enabled=True,
+            friend__userprofile__latitude__isnull=False,
+            friend__userprofile__longitude__isnull=False,
+        ).select_related('friend', 'friend__userprofile'))
+
+        friend_ids = Friendship.get_friend_ids(user.id)
+        alerts = [alert for alert in alerts if alert.friend_id in friend_ids]
+
+        in_range = list(alerts_in_range(user_profile, alerts))
+        if not in_range:
+            return
+
+        # Skip friends we already notified recently
+        now = timezone.now()
+        recent = ProximityNotification.recently_sent([(user.id, alert.friend_id) for alert, _ in in_range], now)
+        due = [(alert, distance) for alert, distance in in_range if (user.id, alert.friend_id) not in recent]
+        if not due:
+            return
+
+        notifications = [
+            ProximityNotification(
+                user=user,
+                friend=alert.friend,
+                distance=round(distance, 2),
+                message=notification_message(alert.friend.username, distance)
+            )
+            for alert, distance in due
+        ]
+        for alert, _ in due:
+            alert.last_triggered = now
+        with transaction.atomic():
+            ProximityNotification.objects.bulk_create(notifications)
+            ProximityAlert.objects.bulk_update([alert for alert, _ in due], ['last_triggered'])
+        ProximityNotification.remember_sent(notifications)
+
+        publish_notifications(notifications, {alert.friend_id: alert.friend.username for alert, _ in due})
+    
+    except:
+        pass  # User profile doesn't exist yet
+
+
+
+@receiver(location_moved)
+def handle_moved_profiles(sender, profiles, **kwargs):
+    """Run proximity checks, push new positions and match geofences for profiles whose location changed"""
+    for profile in profiles:
+        check_proximity_alerts(profile.user)
+        publish_friend_location(profile.user, profile)
+    geofences.process_fixes(
+        (profile.user_id, profile.latitude, profile.longitude, profile.last_location_update)
+        for profile in profiles
+    )
+
+
+@receiver(markers_changed, sender=Marker)
+def bump_changed_tiles(sender, positions, **kwargs):
+    """Invalidate the vector tiles around every committed marker change, whichever code made it"""
+    tiles.bump_points(positions)
@@ -0,0 +1,110 @@
+# spatial.py - Geohash helpers shared by the spatial managers and views
+import math
+
+EARTH_RADIUS_KM = 6371.0088
+GEOHASH_PRECISION = 9  # ~5m cells
+GEOHASH_MAX_CELLS = 16  # Upper bound on index ranges used to cover a bbox
+
+_BASE32 = '0123456789bcdefghjkmnpqrstuvwxyz'
+
+
+def geohash_encode(lat, lng, precision=GEOHASH_PRECISION):
+    """Encode a coordinate as a geohash string"""
+    lat_range = [-90.0, 90.0]
+    lng_range = [-180.0, 180.0]
+    chars = []
+    bits = 0
+    bit_count = 0
+    even = True
+
+    while len(chars) < precision:
+        rng, value = (lng_range, lng) if even else (lat_range, lat)
+        mid = (rng[0] + rng[1]) / 2
+        if value >= mid:
+            bits = (bits << 1) | 1
+            rng[0] = mid
+        else:
+            bits = bits << 1
+            rng[1] = mid
+        even = not even
+        bit_count += 1
+        if bit_count == 5:
+            chars.append(_BASE32[bits])
+            bits = 0
+            bit_count = 0
+
+    return ''.join(chars)
+
+
+def geohash_cell_size(precision):
+    """Return the (lat, lng) size in degrees of a geohash cell"""
+    lng_bits = math.ceil(precision * 5 / 2)
+    lat_bits = precision * 5 // 2
+    return 180.0 / 2 ** lat_bits, 360.0 / 2 ** lng_bits
+
+
+def split_bbox(west, south, east, north):
+    """Split a bbox crossing the antimeridian into two plain boxes"""
+    if west <= east:
+        return [(west, south, east, north)]
+    return [(west, south, 180.0, north), (-180.0, south, east, north)]
+
+
+def geohash_cover(west, south, east, north, max_cells=GEOHASH_MAX_CELLS):
+    """Return the geohash prefixes covering a bbox, using the finest precision within max_cells"""
+    boxes = split_bbox(west, south, east, north)
+    cover = set()
+
+    for precision in range(1, GEOHASH_PRECISION + 1):
+        cells = set()
+        lat_step, lng_step = geohash_cell_size(precision)
+        lat_cells, lng_cells = round(180.0 / lat_step), round(360.0 / lng_step)
+        for box_west, box_south, box_east, box_north in boxes:
+            first_row = min(math.floor((box_south + 90) / lat_step), lat_cells - 1)
+            last_row = min(math.floor((box_north + 90) / lat_step), lat_cells - 1)
+            first_col = min(math.floor((box_west + 180) / lng_step), lng_cells - 1)
+            last_col = min(math.floor((box_east + 180) / lng_step), lng_cells - 1)
+            if len(cells) + (last_row - first_row + 1) * (last_col - first_col + 1) > max_cells:
+                return cover or {''}
+            for row in range(first_row, last_row + 1):
+                lat = (row + 0.5) * lat_step - 90
+                for col in range(first_col, last_col + 1):
+                    cells.add(geohash_encode(lat, (col + 0.5) * lng_step - 180, precision))
+        cover = cells
+
+    return cover
+
+
+def radius_bbox(lat, lng, radius_km):
+    """Return the (west, south, east, north) bbox enclosing a circle"""
+    dlat = math.degrees(radius_km / EARTH_RADIUS_KM)
+    south, north = max(lat - dlat, -90.0), min(lat + dlat, 90.0)
+    if south == -90.0 or north == 90.0 or math.cos(math.radians(lat)) < 1e-9:
+        return -180.0, south, 180.0, north
+
+    dlng = math.degrees(math.asin(min(1.0, math.sin(radius_km / EARTH_RADIUS_KM) / math.cos(math.radians(lat)))))
+    if dlng >= 180.0:
+        return -180.0, south, 180.0, north
+    west, east = lng - dlng, lng + dlng
+    if west < -180.0:
+        west += 360.0
+    if east > 180.0:
+        east -= 360.0
+    return west, south, east, north
+
+
+def point_in_polygon(lat, lng, vertices):
+    """Even-odd ray casting test of a point against a ring of (lat, lng) vertices
+
+    Edges are treated as straight in degrees, which is exact enough for
+    fences a few kilometres across that do not cross the antimeridian.
+    """
+    inside = False
+    lat_j, lng_j = vertices[-1]
+    for lat_i, lng_i in vertices:
+        if (lat_i > lat) != (lat_j > lat):
+            crossing = lng_i + (lat - lat_i) * (lng_j - lng_i) / (lat_j - lat_i)
+            if lng < crossing:
+                inside = not inside
+        lat_j, lng_j = lat_i, lng_i
+    return inside
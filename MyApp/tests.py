@@ -1,3 +1,1685 @@
-from django.test import TestCase
+import asyncio
+import datetime
+import json
+import os
+import subprocess
+import sys
+import tempfile
+from io import BytesIO, StringIO
+from random import Random
+from unittest.mock import patch
 
-# Create your tests here.
+import numpy as np
+from asgiref.sync import async_to_sync
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.exceptions import ValidationError
+from django.core.management import call_command
+from django.db import connection, connections
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+from geopy.distance import geodesic
+
+from .models import (
+    LocationTrack, Marker, MarkerChange, UserLocation, UserProfile, Friendship, ProximityAlert, ProximityNotification,
+    EventRelay, Geofence, GeofenceEvent, LiveEvent, UserSearchIndex, location_moved,
+)
+from .clustering import MarkerClusterIndex, clamp_span, cluster_index
+from .nearest import NearestMarkerIndex, marker_index
+from .management.commands import proximity_sweep
+from .instrumentation import request_metrics
+from . import bulk_delete, events, geofences, loadtest, marker_io, proximity, signals, spatial, tiles, tracks, views
+
+
+class MarkersInBboxTests(TestCase):
+    def setUp(self):
+        Marker.objects.create(title='SF', latitude=37.7749, longitude=-122.4194)
+        Marker.objects.create(title='Oakland', latitude=37.8044, longitude=-122.2712)
+        Marker.objects.create(title='Tokyo', latitude=35.6762, longitude=139.6503)
+        Marker.objects.create(title='Fiji', latitude=-17.7134, longitude=178.0650)
+        Marker.objects.create(title='Samoa', latitude=-13.7590, longitude=-172.1046)
+
+    def get_titles(self, bbox, **params):
+        response = self.client.get(reverse('MyApp:markers_in_bbox'), {'bbox': bbox, **params})
+        self.assertEqual(response.status_code, 200)
+        return {marker['title'] for marker in response.json()['markers']}
+
+    def test_returns_only_markers_in_bounds(self):
+        self.assertEqual(self.get_titles('-123,37,-122,38'), {'SF', 'Oakland'})
+
+    def test_bbox_crossing_antimeridian(self):
+        self.assertEqual(self.get_titles('170,-20,-170,-10'), {'Fiji', 'Samoa'})
+
+    def test_invalid_bbox(self):
+        response = self.client.get(reverse('MyApp:markers_in_bbox'), {'bbox': '1,2,3'})
+        self.assertEqual(response.status_code, 400)
+        response = self.client.get(reverse('MyApp:markers_in_bbox'), {'bbox': '0,50,10,40'})
+        self.assertEqual(response.status_code, 400)
+
+    def test_result_cap(self):
+        Marker.objects.bulk_create(
+            Marker(latitude=10 + i * 0.0001, longitude=10) for i in range(views.MARKER_API_LIMIT + 5)
+        )
+        response = self.client.get(reverse('MyApp:markers_in_bbox'), {'bbox': '9,9,11,11'})
+        data = response.json()
+        self.assertEqual(len(data['markers']), views.MARKER_API_LIMIT)
+        self.assertTrue(data['truncated'])
+
+    def test_map_view_does_not_inline_markers(self):
+        response = self.client.get(reverse('MyApp:map'))
+        self.assertEqual(response.status_code, 200)
+        self.assertNotContains(response, 'Tokyo')
+
+
+class SpatialIndexTests(TestCase):
+    def test_geohash_kept_in_sync_on_save(self):
+        marker = Marker.objects.create(latitude=37.7749, longitude=-122.4194)
+        self.assertEqual(marker.geohash, '9q8yyk8yt')
+        marker.latitude = 35.6762
+        marker.longitude = 139.6503
+        marker.save(update_fields=['latitude', 'longitude'])
+        marker.refresh_from_db()
+        self.assertTrue(marker.geohash.startswith('xn7'))
+
+    def test_user_profile_update_location(self):
+        user = User.objects.create_user('alice')
+        profile = UserProfile.objects.create(user=user)
+        self.assertEqual(profile.geohash, '')
+        profile.update_location(51.5074, -0.1278)
+        self.assertTrue(UserProfile.objects.within_bbox(-1, 51, 1, 52).filter(pk=profile.pk).exists())
+
+    def test_within_bbox_matches_linear_scan(self):
+        random = Random(42)
+        Marker.objects.bulk_create(
+            Marker(latitude=round(random.uniform(-80, 80), 6), longitude=round(random.uniform(-180, 180), 6))
+            for _ in range(500)
+        )
+
+        for bbox in [(-10, -10, 10, 10), (100, 20, 140, 60), (170, -60, -150, 60), (-180, -90, 180, 90)]:
+            west, south, east, north = bbox
+            expected = {
+                marker.pk for marker in Marker.objects.all()
+                if south <= marker.latitude <= north
+                and (west <= marker.longitude <= east if west <= east
+                     else marker.longitude >= west or marker.longitude <= east)
+            }
+            found = set(Marker.objects.within_bbox(*bbox).values_list('pk', flat=True))
+            self.assertEqual(found, expected, bbox)
+
+    def test_near_filters_by_great_circle_distance(self):
+        Marker.objects.create(title='Ferry Building', latitude=37.7955, longitude=-122.3937)
+        Marker.objects.create(title='Oakland', latitude=37.8044, longitude=-122.2712)
+        Marker.objects.create(title='San Jose', latitude=37.3382, longitude=-121.8863)
+
+        nearby = Marker.objects.near(37.7749, -122.4194, 15).order_by('distance')
+        self.assertEqual([marker.title for marker in nearby], ['Ferry Building', 'Oakland'])
+        self.assertAlmostEqual(nearby[0].distance, 3.2, places=1)
+
+
+class NearestMarkersTests(TestCase):
+    def setUp(self):
+        marker_index.invalidate()
+        self.addCleanup(marker_index.invalidate)
+        Marker.objects.create(title='Ferry Building', latitude=37.7955, longitude=-122.3937)
+        Marker.objects.create(title='Oakland', latitude=37.8044, longitude=-122.2712)
+        Marker.objects.create(title='San Jose', latitude=37.3382, longitude=-121.8863)
+        Marker.objects.create(title='Tokyo', latitude=35.6762, longitude=139.6503)
+
+    def get_titles(self, lat, lng, k):
+        response = self.client.get(reverse('MyApp:nearest_markers'), {'lat': lat, 'lng': lng, 'k': k})
+        self.assertEqual(response.status_code, 200)
+        return [marker['title'] for marker in response.json()['markers']]
+
+    def test_returns_k_nearest_in_order(self):
+        self.assertEqual(self.get_titles(37.7749, -122.4194, 3), ['Ferry Building', 'Oakland', 'San Jose'])
+        self.assertEqual(self.get_titles(35.0, 140.0, 1), ['Tokyo'])
+
+    def test_index_follows_add_and_delete(self):
+        self.get_titles(37.7749, -122.4194, 1)
+        response = self.client.post(
+            reverse('MyApp:add_marker'),
+            json.dumps({'latitude': 37.7750, 'longitude': -122.4195, 'title': 'City Hall'}),
+            content_type='application/json',
+        )
+        self.assertEqual(self.get_titles(37.7749, -122.4194, 1), ['City Hall'])
+
+        self.client.delete(reverse('MyApp:delete_marker', args=[response.json()['id']]))
+        self.assertEqual(self.get_titles(37.7749, -122.4194, 1), ['Ferry Building'])
+
+    def test_index_follows_changes_made_outside_the_views(self):
+        self.assertEqual(self.get_titles(35.0, 140.0, 1), ['Tokyo'])
+        # Writes from the admin, commands or another process only reach the change log
+        Marker.objects.filter(title='San Jose').update(latitude=35.1, longitude=140.1)
+        self.assertEqual(self.get_titles(35.0, 140.0, 2), ['San Jose', 'Tokyo'])
+        Marker.objects.filter(title='Tokyo').delete()
+        Marker(title='Osaka', latitude=34.6937, longitude=135.5023).save()
+        self.assertEqual(self.get_titles(35.0, 140.0, 2), ['San Jose', 'Osaka'])
+
+    def test_kdtree_matches_brute_force(self):
+        rng = np.random.default_rng(7)
+        lats = np.degrees(np.arcsin(rng.uniform(-1, 1, 5000)))
+        lngs = rng.uniform(-180, 180, 5000)
+        index = NearestMarkerIndex()
+        index._reset(np.arange(5000), lats, lngs)
+        for marker_id in range(0, 5000, 3):
+            index.remove(marker_id)
+        live = np.arange(5000) % 3 != 0
+
+        for lat, lng in [(0, 0), (89.9, 10), (-45, 179.9), (12.5, -179.9)]:
+            distances = proximity.haversine_km(lat, lng, lats[live], lngs[live])
+            expected = np.arange(5000)[live][np.argsort(distances)[:8]].tolist()
+            self.assertEqual([marker_id for marker_id, _ in index.nearest(lat, lng, 8)], expected)
+
+    def test_invalid_parameters(self):
+        response = self.client.get(reverse('MyApp:nearest_markers'), {'lat': 100, 'lng': 0})
+        self.assertEqual(response.status_code, 400)
+
+
+class MarkerClusterTests(TestCase):
+    def setUp(self):
+        cluster_index.invalidate()
+        self.addCleanup(cluster_index.invalidate)
+        Marker.objects.create(title='Ferry Building', latitude=37.7955, longitude=-122.3937)
+        Marker.objects.create(title='Oakland', latitude=37.8044, longitude=-122.2712)
+        Marker.objects.create(title='San Jose', latitude=37.3382, longitude=-121.8863)
+        Marker.objects.create(title='Tokyo', latitude=35.6762, longitude=139.6503)
+
+    def get_clusters(self, bbox, zoom):
+        response = self.client.get(reverse('MyApp:marker_clusters'), {'bbox': bbox, 'zoom': zoom})
+        self.assertEqual(response.status_code, 200)
+        return response.json()['clusters']
+
+    def test_nearby_markers_merge_when_zoomed_out(self):
+        clusters = self.get_clusters('-123,37,-121,38.5', 5)
+        self.assertEqual(len(clusters), 1)
+        self.assertEqual(clusters[0]['count'], 3)
+        self.assertAlmostEqual(clusters[0]['longitude'], (-122.3937 - 122.2712 - 121.8863) / 3, places=3)
+
+        clusters = self.get_clusters('-123,37,-121,38.5', 12)
+        self.assertEqual(sorted(cluster['title'] for cluster in clusters), ['Ferry Building', 'Oakland', 'San Jose'])
+        self.assertTrue(all(cluster['count'] == 1 for cluster in clusters))
+
+    def test_index_follows_add_and_delete(self):
+        self.assertEqual(self.get_clusters('-180,-85,180,85', 2)[0]['count'], 3)
+        response = self.client.post(
+            reverse('MyApp:add_marker'),
+            json.dumps({'latitude': 37.7750, 'longitude': -122.4195, 'title': 'City Hall'}),
+            content_type='application/json',
+        )
+        self.assertEqual(sorted(c['count'] for c in self.get_clusters('-180,-85,180,85', 2)), [1, 4])
+
+        self.client.delete(reverse('MyApp:delete_marker', args=[response.json()['id']]))
+        self.client.delete(reverse('MyApp:delete_marker', args=[Marker.objects.get(title='Tokyo').id]))
+        self.assertEqual([c['count'] for c in self.get_clusters('-180,-85,180,85', 2)], [3])
+
+    def test_index_follows_changes_made_outside_the_views(self):
+        self.assertEqual(sorted(c['count'] for c in self.get_clusters('-180,-85,180,85', 2)), [1, 3])
+        tokyo = Marker.objects.get(title='Tokyo')
+        tokyo.latitude, tokyo.longitude = 37.7750, -122.4195
+        tokyo.save()
+        self.assertEqual([c['count'] for c in self.get_clusters('-180,-85,180,85', 2)], [4])
+        Marker.objects.filter(title__in=['Oakland', 'San Jose']).delete()
+        self.assertEqual([c['count'] for c in self.get_clusters('-180,-85,180,85', 2)], [2])
+
+        Marker.objects.all().delete()
+        self.assertEqual(self.get_clusters('-180,-85,180,85', 2), [])
+
+    def test_incremental_updates_match_rebuild(self):
+        rng = np.random.default_rng(11)
+        lats, lngs = rng.uniform(-60, 60, 3000), rng.uniform(-180, 180, 3000)
+        incremental = MarkerClusterIndex()
+        incremental._build(np.arange(2000), lats[:2000], lngs[:2000])
+        with patch('MyApp.clustering.DELTA_MAX', 50):
+            for marker_id in range(2000, 3000):
+                incremental.add(marker_id, lats[marker_id], lngs[marker_id])
+            for marker_id in range(0, 3000, 4):
+                incremental.remove(marker_id)
+        live = np.arange(3000) % 4 != 0
+        rebuilt = MarkerClusterIndex()
+        rebuilt._build(np.arange(3000)[live], lats[live], lngs[live])
+
+        for zoom in (0, 4, 9, 16):
+            expected, _ = rebuilt.clusters(-30, -20, 40, 30, zoom)
+            actual, _ = incremental.clusters(-30, -20, 40, 30, zoom)
+            self.assertEqual(len(actual), len(expected))
+            for a, b in zip(actual, expected):
+                self.assertEqual((a['count'], a.get('id')), (b['count'], b.get('id')))
+                self.assertAlmostEqual(a['latitude'], b['latitude'], places=6)
+
+    def test_payload_is_bounded(self):
+        rng = np.random.default_rng(3)
+        index = MarkerClusterIndex()
+        index._build(np.arange(50000), rng.uniform(-80, 80, 50000), rng.uniform(-180, 180, 50000))
+        clusters, truncated = index.clusters(-180, -85, 180, 85, 1)
+        self.assertLessEqual(len(clusters), 8 * 8)
+        self.assertEqual(sum(cluster['count'] for cluster in clusters), 50000)
+        self.assertFalse(truncated)
+
+        with patch('MyApp.clustering.MAX_CLUSTERS', 100):
+            clusters, truncated = index.clusters(-180, -85, 180, 85, 5)
+        self.assertEqual(len(clusters), 100)
+        self.assertTrue(truncated)
+
+    def test_wide_boxes_are_cut_to_their_middle(self):
+        rng = np.random.default_rng(5)
+        index = MarkerClusterIndex()
+        index._build(np.arange(20000), rng.uniform(-5, 5, 20000), rng.uniform(-5, 5, 20000))
+        # 455 columns wide at zoom 12; only the middle MAX_QUERY_CELLS (about 2.8 degrees) are read
+        clusters, _ = index.clusters(-5, -5, 5, 5, 12)
+        self.assertTrue(clusters)
+        self.assertTrue(all(abs(c['longitude']) < 1.5 and abs(c['latitude']) < 1.5 for c in clusters))
+        self.assertEqual(clamp_span(0, 262143), (131008, 131135))
+
+
+class MarkerChangesTests(TestCase):
+    def setUp(self):
+        self.ferry = Marker.objects.create(title='Ferry Building', latitude=37.7955, longitude=-122.3937)
+        self.tokyo = Marker.objects.create(title='Tokyo', latitude=35.6762, longitude=139.6503)
+        self.cursor = MarkerChange.latest_cursor()
+
+    def get_changes(self, since):
+        response = self.client.get(reverse('MyApp:marker_changes'), {'since': since})
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+
+    def test_returns_only_changes_after_cursor(self):
+        self.assertEqual(self.get_changes(self.cursor), {'cursor': self.cursor, 'reset': False, 'has_more': False, 'changes': []})
+
+        response = self.client.post(
+            reverse('MyApp:add_marker'),
+            json.dumps({'latitude': 48.8566, 'longitude': 2.3522, 'title': 'Paris'}),
+            content_type='application/json',
+        )
+        self.client.delete(reverse('MyApp:delete_marker', args=[self.tokyo.id]))
+        self.ferry.title = 'Ferry Plaza'
+        self.ferry.save()
+
+        data = self.get_changes(self.cursor)
+        self.assertEqual(data['cursor'], MarkerChange.latest_cursor())
+        self.assertFalse(data['reset'])
+        self.assertEqual(
+            [(change['action'], change['id'], change.get('title')) for change in data['changes']],
+            [('upsert', response.json()['id'], 'Paris'), ('delete', self.tokyo.id, None), ('upsert', self.ferry.id, 'Ferry Plaza')],
+        )
+        self.assertEqual(self.get_changes(data['cursor'])['changes'], [])
+
+    def test_create_then_delete_collapses_to_delete(self):
+        marker = Marker.objects.create(title='Temporary', latitude=1, longitude=1)
+        marker_id = marker.id
+        marker.delete()
+        self.assertEqual(self.get_changes(self.cursor)['changes'], [{'action': 'delete', 'id': marker_id}])
+
+    def test_bulk_paths_are_logged(self):
+        created = Marker.objects.bulk_create([Marker(title=f'm{i}', latitude=i, longitude=i) for i in range(5)])
+        Marker.objects.filter(id__in=[marker.id for marker in created[:2]]).delete()
+        Marker.objects.filter(id=self.ferry.id).update(title='Renamed')
+
+        with patch('MyApp.views.MARKER_CHANGES_PAGE_SIZE', 4):
+            first = self.get_changes(self.cursor)
+            second = self.get_changes(first['cursor'])
+        self.assertTrue(first['has_more'])
+        self.assertFalse(second['has_more'])
+        latest = {change['id']: change['action'] for change in first['changes'] + second['changes']}
+        self.assertEqual(latest[created[0].id], 'delete')
+        self.assertEqual(latest[created[4].id], 'upsert')
+        self.assertEqual(latest[self.ferry.id], 'upsert')
+
+    @override_settings(MARKER_CLEAR_IN_BACKGROUND=False)
+    def test_clear_resets_clients_and_compacts_log(self):
+        self.client.delete(reverse('MyApp:clear_markers'))
+        self.assertEqual(MarkerChange.objects.count(), 1)
+
+        data = self.get_changes(self.cursor)
+        self.assertTrue(data['reset'])
+        self.assertEqual(data['changes'], [])
+
+        Marker.objects.create(title='After clear', latitude=1, longitude=1)
+        data = self.get_changes(0)
+        self.assertTrue(data['reset'])
+        self.assertEqual([change['title'] for change in data['changes']], ['After clear'])
+
+    def test_cursor_ahead_of_log_resets(self):
+        data = self.get_changes(self.cursor + 100)
+        self.assertTrue(data['reset'])
+        self.assertEqual(data['cursor'], self.cursor)
+
+
+@override_settings(MARKER_CLEAR_IN_BACKGROUND=False)
+class ClearMarkersTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        Marker.objects.bulk_create([Marker(title=f'm{i}', latitude=i % 80, longitude=i % 170) for i in range(250)])
+        # Leave gaps in the id sequence
+        Marker.objects.filter(id__in=Marker.objects.order_by('id').values_list('id', flat=True)[100:200]).delete()
+
+    def test_deletes_in_bounded_chunks_and_reports_progress(self):
+        with patch('MyApp.bulk_delete.CLEAR_CHUNK_SIZE', 40), patch('MyApp.bulk_delete.CLEAR_PAUSE', 0), \
+                CaptureQueriesContext(connection) as queries:
+            response = self.client.delete(reverse('MyApp:clear_markers'))
+        self.assertEqual(response.status_code, 202)
+        self.assertFalse(Marker.objects.exists())
+
+        deletes = [query['sql'] for query in queries.captured_queries if query['sql'].startswith('DELETE FROM "MyApp_marker"')]
+        self.assertEqual(len(deletes), 4)  # 150 rows in chunks of 40
+
+        status = self.client.get(reverse('MyApp:clear_markers_status')).json()['job']
+        self.assertEqual((status['state'], status['deleted'], status['total']), ('done', 150, 150))
+        self.assertEqual(list(MarkerChange.objects.values_list('action', flat=True)), [MarkerChange.CLEAR])
+
+    def test_markers_added_after_start_survive(self):
+        def add_during_clear(status):
+            Marker.objects.create(title='Late', latitude=1, longitude=1)
+            original_run(status)
+
+        original_run = bulk_delete._run
+        with patch('MyApp.bulk_delete._run', add_during_clear):
+            self.client.delete(reverse('MyApp:clear_markers'))
+        self.assertEqual(list(Marker.objects.values_list('title', flat=True)), ['Late'])
+
+    def test_only_one_clear_at_a_time(self):
+        cache.add(bulk_delete.LOCK_KEY, 'other-job')
+        response = self.client.delete(reverse('MyApp:clear_markers'))
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(Marker.objects.count(), 150)
+
+
+@override_settings(REPLICA_READS=True)
+class ReplicaRoutingTests(TestCase):
+    """Routes between the primary test database and a separate SQLite file standing in for the replica"""
+    databases = {'default', 'replica'}
+
+    def setUp(self):
+        cache.clear()
+        Marker.objects.create(title='Primary only', latitude=10, longitude=10)
+        Marker.objects.using('replica').create(title='Replicated', latitude=10, longitude=10)
+
+    def get_titles(self):
+        response = self.client.get(reverse('MyApp:markers_in_bbox'), {'bbox': '9,9,11,11'})
+        return {marker['title'] for marker in response.json()['markers']}
+
+    def test_safe_requests_read_from_replica(self):
+        self.assertEqual(self.get_titles(), {'Replicated'})
+        # Reads outside a request stay on the primary
+        self.assertEqual(list(Marker.objects.values_list('title', flat=True)), ['Primary only'])
+
+    def test_session_reads_its_own_writes(self):
+        response = self.client.post(
+            reverse('MyApp:add_marker'),
+            json.dumps({'latitude': 10.5, 'longitude': 10.5, 'title': 'Mine'}),
+            content_type='application/json',
+        )
+        self.assertTrue(response.json()['success'])
+        self.assertEqual(self.get_titles(), {'Primary only', 'Mine'})
+
+        with override_settings(REPLICA_STICKY_SECONDS=-1):
+            self.client.post(
+                reverse('MyApp:add_marker'),
+                json.dumps({'latitude': 10.6, 'longitude': 10.6, 'title': 'Expired'}),
+                content_type='application/json',
+            )
+        self.assertEqual(self.get_titles(), {'Replicated'})
+
+    def test_reads_without_writes_do_not_pin(self):
+        user = User.objects.create_user('alice')
+        User.objects.using('replica').create(id=user.id, username='alice', password=user.password)
+        UserProfile.objects.create(user=user)
+        UserProfile.objects.using('replica').create(user_id=user.id)
+        self.client.force_login(user)
+
+        # The dashboard's get_or_create finds the profile and writes nothing
+        self.assertEqual(self.client.get(reverse('MyApp:dashboard')).status_code, 200)
+        self.assertEqual(self.get_titles(), {'Replicated'})
+
+
+class MarkerImportExportTests(TestCase):
+    GEOJSON = json.dumps({
+        'type': 'FeatureCollection',
+        'crs': {'type': 'name', 'properties': {'name': 'EPSG:4326'}},
+        'features': [
+            {'type': 'Feature', 'geometry': {'type': 'Point', 'coordinates': [-122.3937, 37.7955]},
+             'properties': {'title': 'Ferry Building', 'description': 'Piers'}},
+            {'type': 'Feature', 'geometry': {'type': 'Point', 'coordinates': [139.6503, 35.6762]},
+             'properties': {'title': '東京'}},
+            {'type': 'Feature', 'geometry': {'type': 'LineString', 'coordinates': [[0, 0], [1, 1]]}},
+        ],
+        'bbox': [-180, -90, 180, 90],
+    }, ensure_ascii=False).encode('utf-8')
+
+    def setUp(self):
+        cache.clear()
+
+    def test_geojson_is_parsed_incrementally(self):
+        # Tiny reads split tokens, numbers and multi-byte characters across chunks
+        with patch('MyApp.marker_io.READ_SIZE', 5):
+            stats = marker_io.import_markers(BytesIO(self.GEOJSON), 'geojson', batch_size=1)
+        self.assertEqual((stats['imported'], stats['rejected']), (2, 1))
+        self.assertEqual(stats['errors'], [{'index': 2, 'error': 'Only Point geometries are supported'}])
+        self.assertEqual(sorted(Marker.objects.values_list('title', flat=True)), ['Ferry Building', '東京'])
+        # Logged as one reset entry, so change-feed clients reload once instead of paging through every marker
+        self.assertEqual(list(MarkerChange.objects.values_list('action', flat=True)), [MarkerChange.RESET])
+        self.assertTrue(self.client.get(reverse('MyApp:marker_changes'), {'since': 0}).json()['reset'])
+
+    def test_ndjson_rejects_bad_lines_and_keeps_going(self):
+        lines = b'{"latitude": 1, "longitude": 2, "title": "flat"}\nnot json\n\n' \
+                b'{"latitude": 95, "longitude": 0}\n{"type": "Feature", "geometry": {"type": "Point", "coordinates": [3, 4]}}'
+        stats = marker_io.import_markers(BytesIO(lines), 'ndjson')
+        self.assertEqual((stats['imported'], stats['rejected']), (2, 2))
+        self.assertEqual(
+            sorted(Marker.objects.values_list('latitude', 'longitude')),
+            [(1, 2), (4, 3)],
+        )
+
+    def test_malformed_collection(self):
+        with self.assertRaises(marker_io.ImportFormatError):
+            marker_io.import_markers(BytesIO(b'{"features": [{"type": "Feature"'), 'geojson')
+
+    def test_commands_round_trip(self):
+        marker_io.import_markers(BytesIO(self.GEOJSON), 'geojson')
+        with tempfile.TemporaryDirectory() as directory:
+            for name in ('markers.geojson', 'markers.ndjson'):
+                path = os.path.join(directory, name)
+                err = StringIO()
+                call_command('export_markers', path, stderr=err)
+                self.assertIn('Exported 2 markers', err.getvalue())
+
+                Marker.objects.all().delete()
+                out = StringIO()
+                call_command('import_markers', path, stdout=out)
+                self.assertIn('Imported 2 markers (0 rejected)', out.getvalue())
+                self.assertEqual(
+                    sorted((title, description, float(lat)) for title, description, lat
+                           in Marker.objects.values_list('title', 'description', 'latitude')),
+                    [('Ferry Building', 'Piers', 37.7955), ('東京', '', 35.6762)],
+                )
+
+    def test_http_endpoints(self):
+        url = reverse('MyApp:import_markers')
+        self.assertEqual(self.client.post(url, self.GEOJSON, content_type='application/geo+json').status_code, 302)
+
+        self.client.force_login(User.objects.create_user('admin', is_staff=True))
+        response = self.client.post(url, self.GEOJSON, content_type='application/geo+json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['imported'], 2)
+
+        response = self.client.get(reverse('MyApp:export_markers'), {'format': 'ndjson'})
+        self.assertEqual(response['Content-Type'], 'application/x-ndjson')
+        features = [json.loads(line) for line in b''.join(response.streaming_content).splitlines()]
+        self.assertEqual([feature['properties']['title'] for feature in features], ['Ferry Building', '東京'])
+
+    def test_export_is_not_buffered_under_asgi(self):
+        marker_io.import_markers(BytesIO(self.GEOJSON), 'geojson')
+
+        async def export():
+            response = await self.async_client.get(reverse('MyApp:export_markers'), {'format': 'ndjson'})
+            return response, [chunk async for chunk in response.streaming_content]
+
+        with patch.object(views, 'STREAM_CHUNKS_PER_STEP', 1):
+            response, chunks = async_to_sync(export)()
+        self.assertTrue(response.is_async)
+        features = [json.loads(line) for line in b''.join(chunks).splitlines()]
+        self.assertEqual([feature['properties']['title'] for feature in features], ['Ferry Building', '東京'])
+
+
+def read_protobuf(data):
+    """Decode protobuf bytes into {field number: [values]} without a schema"""
+    fields, i = {}, 0
+
+    def varint():
+        nonlocal i
+        value, shift = 0, 0
+        while True:
+            byte = data[i]
+            i += 1
+            value |= (byte & 0x7F) << shift
+            shift += 7
+            if byte < 0x80:
+                return value
+
+    while i < len(data):
+        key = varint()
+        if key & 7 == 0:
+            value = varint()
+        else:
+            length = varint()
+            value, i = data[i:i + length], i + length
+        fields.setdefault(key >> 3, []).append(value)
+    return fields
+
+
+def read_packed(data):
+    values, i = [], 0
+    while i < len(data):
+        value, shift = 0, 0
+        while True:
+            byte = data[i]
+            i += 1
+            value |= (byte & 0x7F) << shift
+            shift += 7
+            if byte < 0x80:
+                break
+        values.append(value)
+    return values
+
+
+def read_tile(data):
+    """Decode a vector tile into {layer: [(id, x, y, properties)]}"""
+    layers = {}
+    for layer_data in read_protobuf(data).get(3, []):
+        layer = read_protobuf(layer_data)
+        keys = [key.decode() for key in layer.get(3, [])]
+        values = [read_protobuf(value) for value in layer.get(4, [])]
+        values = [value[1][0].decode() if 1 in value else value[6][0] >> 1 for value in values]
+        features = []
+        for feature_data in layer.get(2, []):
+            feature = read_protobuf(feature_data)
+            tags = read_packed(feature[2][0]) if 2 in feature else []
+            _, x, y = read_packed(feature[4][0])
+            properties = {keys[tags[j]]: values[tags[j + 1]] for j in range(0, len(tags), 2)}
+            features.append((feature.get(1, [None])[0], x >> 1, y >> 1, properties))
+        layers[layer[1][0].decode()] = features
+    return layers
+
+
+class VectorTileTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.ferry = Marker.objects.create(title='Ferry Building', latitude=37.7955, longitude=-122.3937)
+        Marker.objects.create(title='Tokyo', latitude=35.6762, longitude=139.6503)
+        # Tile 10/163/395 covers downtown San Francisco
+        self.url = reverse('MyApp:vector_tile', args=[10, 163, 395])
+
+    def test_tile_contains_markers_in_its_bounds(self):
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'application/vnd.mapbox-vector-tile')
+        layers = read_tile(response.content)
+        self.assertEqual(list(layers), ['markers'])
+        ((marker_id, x, y, properties),) = layers['markers']
+        self.assertEqual((marker_id, properties), (self.ferry.id, {'title': 'Ferry Building'}))
+        self.assertTrue(0 <= x < tiles.TILE_EXTENT and 0 <= y < tiles.TILE_EXTENT)
+
+        world = read_tile(self.client.get(reverse('MyApp:vector_tile', args=[0, 0, 0])).content)
+        self.assertEqual(len(world['markers']), 2)
+
+    def test_etag_changes_only_when_tile_content_changes(self):
+        etag = self.client.get(self.url)['ETag']
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(
+                reverse('MyApp:add_marker'),
+                json.dumps({'latitude': 48.8566, 'longitude': 2.3522, 'title': 'Paris'}),
+                content_type='application/json',
+            )
+        self.assertEqual(self.client.get(self.url, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.delete(reverse('MyApp:delete_marker', args=[self.ferry.id]))
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+        self.assertEqual(read_tile(response.content), {})
+
+    def test_etag_follows_changes_made_outside_the_views(self):
+        etag = self.client.get(self.url)['ETag']
+        with self.captureOnCommitCallbacks(execute=True):
+            self.ferry.title = 'Ferry Plaza'
+            self.ferry.save()
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(read_tile(response.content)['markers'][0][3], {'title': 'Ferry Plaza'})
+
+        etag = response['ETag']
+        with self.captureOnCommitCallbacks(execute=True):
+            Marker.objects.filter(id=self.ferry.id).update(latitude=48.8566, longitude=2.3522)
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(read_tile(response.content), {})
+
+    def test_friends_layer_for_logged_in_user(self):
+        alice = User.objects.create_user('alice')
+        bob = User.objects.create_user('bob')
+        carol = User.objects.create_user('carol')
+        UserProfile.objects.create(user=bob, latitude=37.7800, longitude=-122.4100, location_sharing_enabled=True)
+        UserProfile.objects.create(user=carol, latitude=37.7810, longitude=-122.4110, location_sharing_enabled=True)
+        Friendship.objects.create(requester=alice, addressee=bob, status=Friendship.ACCEPTED)
+        self.client.force_login(alice)
+
+        response = self.client.get(self.url)
+        friends = read_tile(response.content)['friends']
+        self.assertEqual([(friend[0], friend[3]['username']) for friend in friends], [(bob.id, 'bob')])
+        self.assertIn('private', response['Cache-Control'])
+
+        UserProfile.objects.filter(user=bob).update(latitude=37.7850)
+        self.assertEqual(self.client.get(self.url, HTTP_IF_NONE_MATCH=response['ETag']).status_code, 200)
+
+    def test_invalid_tile(self):
+        self.assertEqual(self.client.get(reverse('MyApp:vector_tile', args=[2, 4, 0])).status_code, 404)
+
+
+def make_user(username, lat, lng, sharing=True):
+    """A user with a profile at (lat, lng)"""
+    user = User.objects.create_user(username)
+    UserProfile.objects.create(user=user, latitude=lat, longitude=lng, location_sharing_enabled=sharing)
+    return user
+
+
+class ProximityTests(TestCase):
+    def setUp(self):
+        cache.clear()
+
+    def test_distances_match_geodesic_at_threshold(self):
+        rng = np.random.default_rng(3)
+        lats = 51.5 + rng.uniform(-0.02, 0.02, 2000)
+        lngs = -0.12 + rng.uniform(-0.03, 0.03, 2000)
+        distances = proximity.distances_km(51.5, -0.12, lats, lngs, np.ones(2000))
+        for lat, lng, distance in zip(lats, lngs, distances):
+            self.assertEqual(distance <= 1.0, geodesic((51.5, -0.12), (lat, lng)).kilometers <= 1.0)
+
+    def test_get_distance_to(self):
+        alice = make_user('alice', 37.7749, -122.4194)
+        bob = make_user('bob', 37.8044, -122.2712)
+        carol = make_user('carol', None, None)
+        distance = alice.userprofile.get_distance_to(bob.userprofile)
+        expected = geodesic((37.7749, -122.4194), (37.8044, -122.2712)).kilometers
+        self.assertAlmostEqual(distance, expected, delta=expected * 0.006)
+        self.assertIsNone(alice.userprofile.get_distance_to(carol.userprofile))
+
+    def test_check_proximity_alerts(self):
+        alice = make_user('alice', 37.7749, -122.4194)
+        near = make_user('near', 37.7800, -122.4194)
+        hidden = make_user('hidden', 37.7750, -122.4194, sharing=False)
+        far = make_user('far', 37.8044, -122.2712)
+        stranger = make_user('stranger', 37.7750, -122.4195)
+        for friend in (near, hidden, far):
+            Friendship.objects.create(requester=alice, addressee=friend, status=Friendship.ACCEPTED)
+            ProximityAlert.objects.create(user=alice, friend=friend)
+        ProximityAlert.objects.create(user=alice, friend=stranger)
+
+        signals.check_proximity_alerts(alice)
+        signals.check_proximity_alerts(alice)
+
+        notifications = ProximityNotification.objects.filter(user=alice)
+        self.assertEqual([notification.friend for notification in notifications], [near])
+        self.assertIsNotNone(ProximityAlert.objects.get(user=alice, friend=near).last_triggered)
+
+
+class NotificationCooldownTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.alice = User.objects.create_user('alice')
+        UserProfile.objects.create(user=self.alice, latitude=37.7749, longitude=-122.4194)
+        self.friends = []
+        for i in range(5):
+            friend = User.objects.create_user(f'friend{i}')
+            UserProfile.objects.create(user=friend, latitude=37.775 + i * 0.0001, longitude=-122.4194,
+                                       location_sharing_enabled=True)
+            Friendship.objects.create(requester=self.alice, addressee=friend, status=Friendship.ACCEPTED)
+            ProximityAlert.objects.create(user=self.alice, friend=friend)
+            self.friends.append(friend)
+
+    def test_notifies_all_friends_in_constant_queries(self):
+        self.add_friend_nearby()
+        signals.check_proximity_alerts(self.alice)  # Warm the friend cache
+        ProximityNotification.objects.all().delete()
+        ProximityAlert.objects.update(last_triggered=None)
+
+        with CaptureQueriesContext(connection) as queries:
+            signals.check_proximity_alerts(self.alice)
+        self.assertEqual(ProximityNotification.objects.count(), 6)
+        self.assertFalse(ProximityAlert.objects.filter(last_triggered__isnull=True).exists())
+        # Alerts, cooldown lookup, bulk insert, bulk update (plus savepoint statements)
+        self.assertLessEqual(len([q for q in queries.captured_queries if 'SAVEPOINT' not in q['sql']]), 4)
+
+        # Within the cooldown the cache answers without touching notifications
+        with CaptureQueriesContext(connection) as queries:
+            signals.check_proximity_alerts(self.alice)
+        self.assertEqual(len(queries.captured_queries), 1)
+        self.assertEqual(ProximityNotification.objects.count(), 6)
+
+    def add_friend_nearby(self):
+        friend = User.objects.create_user('late')
+        UserProfile.objects.create(user=friend, latitude=37.776, longitude=-122.4194, location_sharing_enabled=True)
+        Friendship.objects.create(requester=friend, addressee=self.alice, status=Friendship.ACCEPTED)
+        ProximityAlert.objects.create(user=self.alice, friend=friend)
+
+    def test_cache_miss_falls_back_to_table(self):
+        old = ProximityNotification.objects.create(user=self.alice, friend=self.friends[0], distance=0.1, message='')
+        ProximityNotification.objects.filter(id=old.id).update(created_at=timezone.now() - datetime.timedelta(hours=1))
+        ProximityNotification.objects.create(user=self.alice, friend=self.friends[1], distance=0.1, message='')
+        cache.clear()
+
+        pairs = [(self.alice.id, friend.id) for friend in self.friends]
+        self.assertEqual(ProximityNotification.recently_sent(pairs), {(self.alice.id, self.friends[1].id)})
+        with self.assertNumQueries(0):
+            self.assertEqual(ProximityNotification.recently_sent(pairs[1:2]), {(self.alice.id, self.friends[1].id)})
+
+        # The cooldown expires with time even while the cache entry is still present
+        later = timezone.now() + datetime.timedelta(minutes=31)
+        self.assertEqual(ProximityNotification.recently_sent(pairs, later), set())
+
+    def test_send_from_another_process_is_seen(self):
+        pairs = [(self.alice.id, friend.id) for friend in self.friends]
+        self.assertEqual(ProximityNotification.recently_sent(pairs), set())
+        # e.g. proximity_sweep, whose cache this process cannot see; bulk_create skips post_save
+        ProximityNotification.objects.bulk_create([
+            ProximityNotification(user=self.alice, friend=self.friends[2], distance=0.1, message='')
+        ])
+        self.assertEqual(ProximityNotification.recently_sent(pairs), {(self.alice.id, self.friends[2].id)})
+
+    def test_deleting_a_notification_resets_its_cooldown(self):
+        signals.check_proximity_alerts(self.alice)
+        ProximityNotification.objects.filter(friend=self.friends[0]).delete()
+        signals.check_proximity_alerts(self.alice)
+        self.assertEqual(ProximityNotification.objects.filter(friend=self.friends[0]).count(), 1)
+        self.assertEqual(ProximityNotification.objects.count(), 5)
+
+
+class ProximitySweepTests(TestCase):
+    def setUp(self):
+        cache.clear()
+
+    def test_sweep_matches_per_user_check(self):
+        rng = Random(11)
+        users = [make_user(f'user{i}', 40 + rng.uniform(0, 0.05), -74 + rng.uniform(0, 0.05), rng.random() > 0.2)
+                 for i in range(40)]
+        for i, user in enumerate(users):
+            for friend in rng.sample(users, 8):
+                if friend != user:
+                    ProximityAlert.objects.get_or_create(user=user, friend=friend,
+                                                         defaults={'distance_threshold': rng.choice([0.5, 1.0, 3.0])})
+                    if i % 4 and not Friendship.objects.filter(requester=friend, addressee=user).exists():
+                        Friendship.objects.get_or_create(requester=user, addressee=friend,
+                                                         defaults={'status': Friendship.ACCEPTED})
+
+        stats = proximity_sweep.sweep()
+        swept = set(ProximityNotification.objects.values_list('user_id', 'friend_id', 'distance'))
+        self.assertEqual(stats['notifications'], len(swept))
+
+        ProximityNotification.objects.all().delete()
+        for user in users:
+            signals.check_proximity_alerts(user)
+        checked = set(ProximityNotification.objects.values_list('user_id', 'friend_id', 'distance'))
+        self.assertEqual(swept, checked)
+        self.assertTrue(swept)
+
+    def test_sweep_respects_cooldown(self):
+        alice = make_user('alice', 37.7749, -122.4194)
+        bob = make_user('bob', 37.7800, -122.4194)
+        Friendship.objects.create(requester=alice, addressee=bob, status=Friendship.ACCEPTED)
+        ProximityAlert.objects.create(user=alice, friend=bob)
+        ProximityAlert.objects.create(user=bob, friend=alice)
+
+        call_command('proximity_sweep', stdout=StringIO())
+        call_command('proximity_sweep', stdout=StringIO())
+        self.assertEqual(ProximityNotification.objects.count(), 2)
+        self.assertEqual(ProximityAlert.objects.filter(last_triggered__isnull=False).count(), 2)
+
+    def test_zero_thresholds_are_skipped_and_rejected(self):
+        alice = make_user('alice', 37.7749, -122.4194)
+        bob = make_user('bob', 37.7749, -122.4194)
+        Friendship.objects.create(requester=alice, addressee=bob, status=Friendship.ACCEPTED)
+        alert = ProximityAlert.objects.create(user=alice, friend=bob, distance_threshold=0)
+
+        stats = proximity_sweep.sweep()
+        self.assertEqual((stats['candidates'], stats['notifications']), (0, 0))
+        with self.assertRaises(ValidationError):
+            alert.full_clean()
+
+
+class DashboardQueryCountTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user('alice')
+        UserProfile.objects.create(user=self.user, latitude=37.7749, longitude=-122.4194)
+        self.client.force_login(self.user)
+        self.friend_count = 0
+
+    def add_friends(self, count):
+        for _ in range(count):
+            self.friend_count += 1
+            friend = User.objects.create_user(f'friend{self.friend_count}')
+            if self.friend_count % 3:
+                # Every third friend has no profile yet and gets one lazily
+                UserProfile.objects.create(
+                    user=friend, latitude=37.78, longitude=-122.41, location_sharing_enabled=True
+                )
+            requester, addressee = (friend, self.user) if self.friend_count % 2 else (self.user, friend)
+            Friendship.objects.create(requester=requester, addressee=addressee, status=Friendship.ACCEPTED)
+            pending = User.objects.create_user(f'pending{self.friend_count}')
+            Friendship.objects.create(requester=pending, addressee=self.user)
+
+    def count_dashboard_queries(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse('MyApp:dashboard'))
+        self.assertEqual(response.status_code, 200)
+        return len(queries), response
+
+    def test_query_count_is_constant_in_friend_count(self):
+        self.add_friends(6)
+        first_small, _ = self.count_dashboard_queries()
+        steady_small, _ = self.count_dashboard_queries()
+
+        self.add_friends(60)
+        first_large, _ = self.count_dashboard_queries()
+        steady_large, response = self.count_dashboard_queries()
+
+        self.assertEqual(first_small, first_large)
+        self.assertEqual(steady_small, steady_large)
+        self.assertEqual(len(response.context['friend_profiles']), 44)
+
+    def test_missing_profiles_created_in_bulk(self):
+        self.add_friends(9)
+        self.count_dashboard_queries()
+        self.assertEqual(UserProfile.objects.count(), 10)
+
+
+class FriendGraphCacheTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.alice, self.bob, self.carol, self.dave = (
+            User.objects.create_user(name) for name in ('alice', 'bob', 'carol', 'dave')
+        )
+        Friendship.objects.create(requester=self.alice, addressee=self.bob, status=Friendship.ACCEPTED)
+        Friendship.objects.create(requester=self.carol, addressee=self.alice, status=Friendship.ACCEPTED)
+        self.pending = Friendship.objects.create(requester=self.dave, addressee=self.alice)
+
+    def test_get_friends_many(self):
+        friends = Friendship.get_friends_many([self.alice.id, self.bob.id, self.dave.id])
+        self.assertEqual(friends, {
+            self.alice.id: {self.bob.id, self.carol.id},
+            self.bob.id: {self.alice.id},
+            self.dave.id: frozenset(),
+        })
+        with self.assertNumQueries(0):
+            Friendship.get_friends_many([self.alice.id, self.bob.id])
+        self.assertEqual(set(Friendship.get_friends(self.alice)), {self.bob, self.carol})
+
+    def test_accepting_request_invalidates_cache(self):
+        self.assertNotIn(self.dave.id, Friendship.get_friend_ids(self.alice.id))
+        self.client.force_login(self.alice)
+        self.client.get(reverse('MyApp:handle_friend_request', args=[self.pending.id, 'accept']))
+        self.assertIn(self.dave.id, Friendship.get_friend_ids(self.alice.id))
+        self.assertIn(self.alice.id, Friendship.get_friend_ids(self.dave.id))
+
+
+@override_settings(LOCATION_WRITE_BEHIND=True, LOCATION_FLUSH_INTERVAL=0)
+class LocationBufferTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.alice = User.objects.create_user('alice')
+        self.bob = User.objects.create_user('bob')
+        UserProfile.objects.create(user=self.bob, latitude=37.7800, longitude=-122.4194, location_sharing_enabled=True)
+        Friendship.objects.create(requester=self.alice, addressee=self.bob, status=Friendship.ACCEPTED)
+        ProximityAlert.objects.create(user=self.alice, friend=self.bob)
+        self.client.force_login(self.alice)
+        self.addCleanup(views.location_buffer.flush)
+
+    def post_location(self, lat, lng):
+        response = self.client.post(
+            reverse('MyApp:update_location'),
+            json.dumps({'latitude': lat, 'longitude': lng}),
+            content_type='application/json',
+        )
+        self.assertEqual(response.json()['status'], 'success')
+
+    def test_fixes_are_coalesced_and_flushed_in_bulk(self):
+        before = views.location_buffer.metrics()
+        self.post_location(10.0, 10.0)
+        self.post_location(37.7749, -122.4194)
+        self.assertFalse(UserProfile.objects.filter(user=self.alice).exists())
+        self.assertEqual(views.location_buffer.metrics()['pending'], 1)
+
+        self.assertEqual(views.location_buffer.flush(), [self.alice.id])
+        profile = UserProfile.objects.get(user=self.alice)
+        self.assertEqual((float(profile.latitude), float(profile.longitude)), (37.7749, -122.4194))
+        self.assertTrue(profile.geohash.startswith('9q8yy'))
+        self.assertEqual(ProximityNotification.objects.filter(user=self.alice, friend=self.bob).count(), 1)
+
+        after = views.location_buffer.metrics()
+        self.assertEqual(after['coalesced'] - before['coalesced'], 1)
+        self.assertEqual(after['rows_written'] - before['rows_written'], 1)
+        self.assertEqual(after['pending'], 0)
+
+    def test_flush_updates_existing_profiles(self):
+        UserProfile.objects.create(user=self.alice, latitude=1, longitude=1)
+        self.post_location(37.7749, -122.4194)
+        views.location_buffer.flush()
+        self.assertEqual(float(UserProfile.objects.get(user=self.alice).longitude), -122.4194)
+
+    def test_profile_created_concurrently_is_updated(self):
+        self.post_location(37.7749, -122.4194)
+        fetch = views.location_buffer._fetch
+
+        def fetch_then_race(user_ids):
+            # Another process creates alice's profile after the buffer looked for it
+            if not UserProfile.objects.filter(user=self.alice).exists():
+                UserProfile.objects.create(user=self.alice, latitude=1, longitude=1)
+                return {}
+            return fetch(user_ids)
+
+        with patch.object(views.location_buffer, '_fetch', side_effect=fetch_then_race):
+            self.assertEqual(views.location_buffer.flush(), [self.alice.id])
+        profile = UserProfile.objects.get(user=self.alice)
+        self.assertEqual((float(profile.latitude), float(profile.longitude)), (37.7749, -122.4194))
+
+    def test_older_fix_is_not_counted_as_coalesced(self):
+        before = views.location_buffer.metrics()['coalesced']
+        now = timezone.now()
+        views.location_buffer.submit(self.alice.id, 37.7749, -122.4194, now)
+        views.location_buffer.submit(self.alice.id, 10.0, 10.0, now - datetime.timedelta(seconds=5))
+        self.assertEqual(views.location_buffer.metrics()['coalesced'], before)
+        views.location_buffer.flush()
+        self.assertEqual(float(UserProfile.objects.get(user=self.alice).latitude), 37.7749)
+
+    @override_settings(LOCATION_WRITE_BEHIND=False)
+    def test_synchronous_path(self):
+        self.post_location(37.7749, -122.4194)
+        self.assertEqual(float(UserProfile.objects.get(user=self.alice).latitude), 37.7749)
+        self.assertEqual(views.location_buffer.metrics()['pending'], 0)
+
+
+@override_settings(LOCATION_WRITE_BEHIND=False)
+class BatchLocationTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user('alice')
+        self.client.force_login(self.user)
+
+    def post_batch(self, body, content_type='application/json'):
+        return self.client.post(reverse('MyApp:batch_update_location'), body, content_type=content_type)
+
+    def test_json_batch_inserts_history_and_updates_profile_from_newest_fix(self):
+        fixes = [
+            {'latitude': 37.7749, 'longitude': -122.4194, 'accuracy': 12.4, 'timestamp': '2026-01-01T10:00:00Z'},
+            {'latitude': 37.8044, 'longitude': -122.2712, 'timestamp': '2026-01-01T10:05:00Z'},
+            {'latitude': 37.7955, 'longitude': -122.3937, 'timestamp': 1767261720000},  # 10:02:00Z in ms
+            {'latitude': 95, 'longitude': 0, 'timestamp': '2026-01-01T10:06:00Z'},
+            {'latitude': 1, 'longitude': 1},
+        ]
+        with patch.object(signals, 'check_proximity_alerts') as check:
+            response = self.post_batch(json.dumps(fixes))
+        data = response.json()
+        self.assertEqual(data['accepted'], 3)
+        self.assertEqual([rejected['index'] for rejected in data['rejected']], [3, 4])
+        check.assert_called_once_with(self.user)
+
+        history = UserLocation.objects.filter(user=self.user).order_by('captured_at')
+        self.assertEqual([location.accuracy_m for location in history], [12, None, None])
+        self.assertEqual(history[1].captured_at.minute, 2)
+
+        profile = UserProfile.objects.get(user=self.user)
+        self.assertEqual(float(profile.longitude), -122.2712)
+        self.assertEqual(profile.last_location_update, history[2].captured_at)
+
+    def test_ndjson_batch_and_stale_backlog(self):
+        UserProfile.objects.create(user=self.user, latitude=1, longitude=1, last_location_update=timezone.now())
+        body = '\n'.join(json.dumps({'latitude': 2, 'longitude': 2, 'timestamp': f'2026-01-01T10:0{i}:00Z'})
+                         for i in range(4))
+        response = self.post_batch(body, content_type='application/x-ndjson')
+        self.assertEqual(response.json()['accepted'], 4)
+        self.assertEqual(UserLocation.objects.count(), 4)
+        self.assertEqual(float(UserProfile.objects.get(user=self.user).latitude), 1)
+
+    def test_malformed_body(self):
+        self.assertEqual(self.post_batch('{"latitude": 1}').status_code, 400)
+        self.assertEqual(self.post_batch('not json').status_code, 400)
+
+    def test_out_of_range_timestamps_are_rejected(self):
+        fixes = [
+            {'latitude': 1, 'longitude': 1, 'timestamp': 1e20},
+            {'latitude': 1, 'longitude': 1, 'timestamp': 1e300},
+            {'latitude': 1, 'longitude': 1, 'timestamp': '2026-01-01T10:00:00Z'},
+        ]
+        response = self.post_batch(json.dumps(fixes))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['accepted'], 1)
+        self.assertEqual([rejected['index'] for rejected in response.json()['rejected']], [0, 1])
+
+    def test_out_of_range_accuracy_is_rejected(self):
+        # 1e400 parses as inf; 1e30 would overflow SQLite's INTEGER and sink the whole batch
+        body = '[' + ', '.join(
+            f'{{"latitude": 1, "longitude": 1, "accuracy": {accuracy}, "timestamp": "2026-01-01T10:00:00Z"}}'
+            for accuracy in ('1e400', '1e30', 'NaN', '12.4')
+        ) + ']'
+        response = self.post_batch(body)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([rejected['index'] for rejected in response.json()['rejected']], [0, 1, 2])
+        self.assertEqual(list(UserLocation.objects.values_list('accuracy_m', flat=True)), [12])
+
+
+@override_settings(LOCATION_WRITE_BEHIND=False, LOCATION_MIN_MOVE_M=25, LOCATION_HEARTBEAT_SECONDS=300)
+class LocationMovementTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user('alice')
+        self.start = timezone.now() - datetime.timedelta(hours=1)
+        self.profile = UserProfile.objects.create(
+            user=self.user, latitude=37.7749, longitude=-122.4194, last_location_update=self.start
+        )
+        self.moved = []
+        location_moved.connect(self.on_moved)
+        self.addCleanup(location_moved.disconnect, self.on_moved)
+
+    def on_moved(self, sender, profiles, **kwargs):
+        self.moved.extend(profile.user_id for profile in profiles)
+
+    def test_stationary_jitter_is_not_written(self):
+        rng = Random(3)
+        with CaptureQueriesContext(connection) as queries:
+            for second in range(1, 61):
+                change = self.profile.update_location(
+                    37.7749 + rng.uniform(-0.0001, 0.0001), -122.4194 + rng.uniform(-0.0001, 0.0001),
+                    self.start + datetime.timedelta(seconds=second),
+                )
+                self.assertEqual(change, UserProfile.UNCHANGED)
+        self.assertEqual(len(queries), 0)
+        self.assertEqual(self.moved, [])
+
+    def test_heartbeat_only_refreshes_timestamp(self):
+        later = self.start + datetime.timedelta(seconds=300)
+        with CaptureQueriesContext(connection) as queries:
+            change = self.profile.update_location(37.77491, -122.41941, later)
+        self.assertEqual(change, UserProfile.HEARTBEAT)
+        self.assertEqual(len(queries), 1)
+        self.assertIn('"last_location_update"', queries[0]['sql'])
+        self.assertNotIn('"latitude"', queries[0]['sql'])
+
+        profile = UserProfile.objects.get(pk=self.profile.pk)
+        self.assertEqual(profile.last_location_update, later)
+        self.assertEqual(float(profile.latitude), 37.7749)
+        self.assertEqual(self.moved, [])
+
+    def test_move_writes_position_columns_and_sends_signal(self):
+        with CaptureQueriesContext(connection) as queries:
+            change = self.profile.update_location(37.7800, -122.4194, self.start + datetime.timedelta(seconds=5))
+        self.assertEqual(change, UserProfile.MOVED)
+        updates = [query['sql'] for query in queries if query['sql'].startswith('UPDATE')]
+        self.assertEqual(len(updates), 1)
+        self.assertIn('"geohash"', updates[0])
+        self.assertNotIn('"location_sharing_enabled"', updates[0])
+        self.assertEqual(self.moved, [self.user.id])
+        self.assertTrue(UserProfile.objects.get(pk=self.profile.pk).geohash.startswith('9q8yy'))
+
+    def test_receiver_is_connected_without_views(self):
+        script = (
+            'import sys, django; django.setup(); '
+            'from MyApp.models import UserProfile, location_moved; '
+            'print(location_moved.has_listeners(UserProfile), "MyApp.views" in sys.modules)'
+        )
+        result = subprocess.run([sys.executable, '-c', script], capture_output=True, text=True, check=True,
+                                env=dict(os.environ, DJANGO_SETTINGS_MODULE='WebScanner.settings'))
+        self.assertEqual(result.stdout.split(), ['True', 'False'])
+
+    def test_older_fix_is_ignored(self):
+        change = self.profile.update_location(10.0, 10.0, self.start - datetime.timedelta(minutes=1))
+        self.assertEqual(change, UserProfile.UNCHANGED)
+        self.assertEqual(float(UserProfile.objects.get(pk=self.profile.pk).latitude), 37.7749)
+
+    @override_settings(LOCATION_WRITE_BEHIND=True, LOCATION_FLUSH_INTERVAL=0)
+    def test_buffer_skips_unchanged_fixes(self):
+        self.addCleanup(views.location_buffer.flush)
+        before = views.location_buffer.metrics()
+        views.location_buffer.submit(self.user.id, 37.77491, -122.41941, self.start + datetime.timedelta(seconds=10))
+        self.assertEqual(views.location_buffer.flush(), [])
+
+        views.location_buffer.submit(self.user.id, 37.7800, -122.4194, self.start + datetime.timedelta(seconds=20))
+        self.assertEqual(views.location_buffer.flush(), [self.user.id])
+        self.assertEqual(self.moved, [self.user.id])
+
+        after = views.location_buffer.metrics()
+        self.assertEqual(after['rows_written'] - before['rows_written'], 1)
+        self.assertEqual(after['unchanged'] - before['unchanged'], 1)
+
+
+@override_settings(LOCATION_WRITE_BEHIND=False, LOCATION_MIN_MOVE_M=25)
+class GeofenceTests(TestCase):
+    # A concave "U" around (0..3, 0..3) with the notch at lng 1..2 above lat 1
+    U_SHAPE = [[0, 0], [0, 3], [3, 3], [3, 2], [1, 2], [1, 1], [3, 1], [3, 0]]
+
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user('alice')
+        self.client.force_login(self.user)
+        self.start = timezone.now() - datetime.timedelta(hours=1)
+        self.profile = UserProfile.objects.create(user=self.user)
+        self.home = Geofence.objects.create(
+            user=self.user, name='Home', shape=Geofence.CIRCLE,
+            latitude=37.7749, longitude=-122.4194, radius_m=200, dwell_seconds=600,
+        )
+
+    def move(self, lat, lng, minutes):
+        self.profile.update_location(lat, lng, self.start + datetime.timedelta(minutes=minutes))
+
+    def events(self):
+        return list(GeofenceEvent.objects.filter(user=self.user).order_by('id').values_list('event', flat=True))
+
+    def test_point_in_polygon(self):
+        self.assertTrue(spatial.point_in_polygon(0.5, 1.5, self.U_SHAPE))
+        self.assertTrue(spatial.point_in_polygon(2.5, 0.5, self.U_SHAPE))
+        self.assertFalse(spatial.point_in_polygon(2, 1.5, self.U_SHAPE))  # In the notch
+        self.assertFalse(spatial.point_in_polygon(4, 1, self.U_SHAPE))
+
+        fence = Geofence.objects.create(user=self.user, name='U', shape=Geofence.POLYGON, vertices=self.U_SHAPE)
+        self.assertEqual((fence.min_lat, fence.max_lat, fence.min_lng, fence.max_lng), (0, 3, 0, 3))
+        self.assertTrue(fence.contains(0.5, 1.5))
+        self.assertFalse(fence.contains(2, 1.5))
+
+    def test_enter_dwell_exit(self):
+        self.move(37.7900, -122.4194, 0)  # 1.7 km north
+        self.move(37.7750, -122.4195, 1)
+        self.move(37.7752, -122.4190, 12)  # Still inside, past dwell_seconds
+        self.move(37.7756, -122.4194, 13)  # No second dwell
+        self.move(37.7900, -122.4194, 20)
+        self.assertEqual(self.events(), [GeofenceEvent.ENTER, GeofenceEvent.DWELL, GeofenceEvent.EXIT])
+
+        event = GeofenceEvent.objects.get(event=GeofenceEvent.ENTER)
+        self.assertEqual(event.occurred_at, self.start + datetime.timedelta(minutes=1))
+        self.assertEqual(event.message, 'You entered Home')
+        self.home.refresh_from_db()
+        self.assertIsNone(self.home.entered_at)
+
+    def test_far_fences_are_not_loaded(self):
+        Geofence.objects.bulk_create([
+            Geofence(user=self.user, name=f'Far {i}', shape=Geofence.POLYGON,
+                     vertices=[[10, i], [10, i + 0.5], [10.5, i]])
+            for i in range(100)
+        ])
+        fixes = {self.user.id: (37.7750, -122.4195, self.start)}
+        self.assertEqual([fence.name for fence in geofences.candidate_fences(fixes)], ['Home'])
+
+    def test_batch_is_bulk(self):
+        users = [User.objects.create_user(f'user{i}') for i in range(20)]
+        Geofence.objects.bulk_create([
+            Geofence(user=user, name='Office', shape=Geofence.CIRCLE, latitude=51.5, longitude=-0.12, radius_m=100)
+            for user in users
+        ])
+        with CaptureQueriesContext(connection) as queries:
+            created = geofences.process_fixes((user.id, 51.5, -0.12, self.start) for user in users)
+        self.assertEqual(len(created), 20)
+        self.assertLessEqual(len(queries), 6)  # Candidates, bulk update, bulk insert and the transaction
+        self.assertEqual(Geofence.objects.filter(entered_at__isnull=False).count(), 20)
+
+    def test_sweep_dwell(self):
+        self.move(37.7750, -122.4195, 0)
+        self.assertEqual(geofences.sweep_dwell(self.start + datetime.timedelta(minutes=5)), [])
+        swept = geofences.sweep_dwell(self.start + datetime.timedelta(minutes=11))
+        self.assertEqual([event.event for event in swept], [GeofenceEvent.DWELL])
+        self.assertEqual(geofences.sweep_dwell(self.start + datetime.timedelta(minutes=30)), [])
+
+    def test_api(self):
+        UserProfile.objects.filter(pk=self.profile.pk).update(latitude=1.5, longitude=0.5, last_location_update=self.start)
+        response = self.client.post(
+            reverse('MyApp:geofence_list'),
+            json.dumps({'name': 'U', 'shape': 'polygon', 'vertices': self.U_SHAPE}),
+            content_type='application/json',
+        )
+        self.assertEqual(response.status_code, 201)
+        self.assertTrue(response.json()['geofence']['inside'])
+        self.assertEqual(self.events(), [GeofenceEvent.ENTER])
+
+        for body in ({'name': 'Bad', 'shape': 'circle', 'latitude': 1, 'longitude': 1},
+                     {'name': 'Bad', 'shape': 'polygon', 'vertices': [[0, 0], [1, 1]]},
+                     {'name': 'Bad', 'shape': 'circle', 'latitude': 'x', 'longitude': 1, 'radius_m': 5},
+                     {'name': 'Bad', 'shape': 'circle', 'latitude': 1, 'longitude': 1, 'radius_m': float('nan')},
+                     {'name': 'Bad', 'shape': 'circle', 'latitude': float('inf'), 'longitude': 1, 'radius_m': 5},
+                     {'name': 'Bad', 'shape': 'polygon', 'vertices': [[True, 2], [0, 0], [1, 1]]},
+                     {'name': 'Bad', 'shape': 'polygon', 'vertices': [[float('nan'), 2], [0, 0], [1, 1]]}):
+            response = self.client.post(reverse('MyApp:geofence_list'), json.dumps(body),
+                                        content_type='application/json')
+            self.assertEqual(response.status_code, 400)
+
+        names = [fence['name'] for fence in self.client.get(reverse('MyApp:geofence_list')).json()['geofences']]
+        self.assertEqual(names, ['Home', 'U'])
+        events = self.client.get(reverse('MyApp:geofence_events')).json()['events']
+        self.assertEqual([(event['name'], event['event']) for event in events], [('U', 'enter')])
+
+        url = reverse('MyApp:delete_geofence', args=[self.home.id])
+        self.assertEqual(self.client.delete(url).status_code, 200)
+        self.assertEqual(self.client.delete(url).status_code, 404)
+
+
+class UserSearchTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.alice = User.objects.create_user('alice')
+        self.users = {name: User.objects.create_user(name) for name in ('Albert', 'alfred', 'alina', 'bob', 'xalbert')}
+        Friendship.objects.create(requester=self.alice, addressee=self.users['alfred'], status=Friendship.ACCEPTED)
+        Friendship.objects.create(requester=self.users['alina'], addressee=self.alice, status=Friendship.PENDING)
+        self.client.force_login(self.alice)
+
+    def test_index_follows_user_saves(self):
+        self.assertEqual(UserSearchIndex.objects.get(user=self.users['Albert']).username, 'albert')
+        user = self.users['bob']
+        user.username = 'Robert'
+        user.save()
+        self.assertEqual(UserSearchIndex.objects.get(user=user).username, 'robert')
+        with self.assertNumQueries(1):
+            user.save(update_fields=['last_login'])  # No index lookup for unrelated saves
+
+    def test_prefix_search_with_status_in_one_query(self):
+        with self.assertNumQueries(1):
+            results = UserSearchIndex.search('AL', self.alice)
+        self.assertEqual(
+            [(user['username'], user['friendship_status']) for user in results],
+            [('Albert', None), ('alfred', Friendship.ACCEPTED), ('alina', Friendship.PENDING)],
+        )
+
+    def test_search_view(self):
+        response = self.client.get(reverse('MyApp:user_search'), {'q': 'ali'})
+        self.assertEqual([user['username'] for user in response.context['users']], ['alina'])
+        self.assertContains(response, 'Pending')
+
+    def test_autocomplete_is_cached_and_invalidated(self):
+        url = reverse('MyApp:user_autocomplete')
+        self.assertEqual([user['username'] for user in self.client.get(url, {'q': 'al'}).json()['users']],
+                         ['Albert', 'alfred', 'alina'])
+        with self.assertNumQueries(2):  # Session and user only
+            self.client.get(url, {'q': 'al'})
+        # A smaller limit is not served the view's longer cached list
+        self.assertEqual([username for _, username in UserSearchIndex.autocomplete('al', 2)], ['Albert', 'alfred'])
+
+        User.objects.create_user('Alvin')
+        self.assertEqual([user['username'] for user in self.client.get(url, {'q': 'al'}).json()['users']],
+                         ['Albert', 'alfred', 'alina', 'Alvin'])
+        self.users['alina'].delete()
+        self.assertNotIn('alina', [user['username'] for user in self.client.get(url, {'q': 'ali'}).json()['users']])
+        self.assertEqual(self.client.get(url, {'q': 'a b'}).json()['users'], [])
+
+
+class LocationCompactionTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('alice')
+        self.now = datetime.datetime(2026, 3, 20, 12, tzinfo=datetime.timezone.utc)
+        self.old_day = datetime.datetime(2026, 3, 1, tzinfo=datetime.timezone.utc)
+
+    def add_path(self, start, count, user=None, step_seconds=60):
+        """A straight walk east with one detour north in the middle"""
+        UserLocation.objects.bulk_create([
+            UserLocation(
+                user=user or self.user,
+                latitude=37.7 + (0.01 if i == count // 2 else 0),
+                longitude=-122.4 + i * 0.0001,
+                captured_at=start + datetime.timedelta(seconds=i * step_seconds),
+            )
+            for i in range(count)
+        ])
+
+    def test_simplify_keeps_corners_and_drops_collinear_points(self):
+        lats = [0, 0, 0, 0, 0.001, 0.002]
+        lngs = [0, 0.001, 0.002, 0.003, 0.003, 0.003]
+        self.assertEqual(tracks.simplify(lats, lngs, 1).tolist(), [0, 3, 5])
+        self.assertEqual(tracks.simplify(lats[:2], lngs[:2], 1).tolist(), [0, 1])
+        # An out-and-back path keeps its far end even though it lies on the line between the ends
+        self.assertEqual(tracks.simplify([0, 0, 0], [0, 0.01, 0], 5).tolist(), [0, 1, 2])
+
+    def test_compacts_old_days_and_keeps_recent_fixes(self):
+        self.add_path(self.old_day, 100)
+        self.add_path(self.old_day + datetime.timedelta(days=1, hours=1), 50)
+        self.add_path(self.now - datetime.timedelta(days=2), 10)
+
+        stats = tracks.compact_locations(now=self.now)
+        self.assertEqual((stats['users'], stats['days'], stats['raw_points']), (1, 2, 150))
+        self.assertEqual(UserLocation.objects.count(), 10)
+
+        first, second = LocationTrack.objects.filter(user=self.user)
+        self.assertEqual(first.day, self.old_day.date())
+        self.assertEqual((first.raw_count, first.point_count), (100, 5))
+        self.assertEqual([point[0] for point in first.points], [37.7, 37.7, 37.71, 37.7, 37.7])
+        self.assertEqual(first.started_at, self.old_day)
+        self.assertEqual(first.ended_at, self.old_day + datetime.timedelta(minutes=99))
+        self.assertEqual(second.raw_count, 50)
+
+        # Running again finds nothing left to do
+        self.assertEqual(tracks.compact_locations(now=self.now)['days'], 0)
+
+    def test_late_fixes_are_merged_into_an_existing_track(self):
+        self.add_path(self.old_day, 10)
+        tracks.compact_locations(now=self.now)
+        UserLocation.objects.create(user=self.user, latitude=38, longitude=-122.4,
+                                    captured_at=self.old_day + datetime.timedelta(hours=5))
+        tracks.compact_locations(now=self.now)
+
+        track = LocationTrack.objects.get(user=self.user)
+        self.assertEqual(track.raw_count, 11)
+        self.assertEqual(track.points[-1][0], 38)
+        self.assertEqual(track.ended_at, self.old_day + datetime.timedelta(hours=5))
+        self.assertFalse(UserLocation.objects.exists())
+
+    def test_deletes_are_chunked(self):
+        self.add_path(self.old_day, 25)
+        UserLocation.objects.bulk_create([
+            UserLocation(latitude=1, longitude=1, captured_at=self.old_day) for _ in range(7)
+        ])
+        with patch.object(tracks, 'DELETE_CHUNK_SIZE', 10), patch.object(tracks, 'COMPACT_PAUSE', 0):
+            with CaptureQueriesContext(connection) as queries:
+                stats = tracks.compact_locations(now=self.now)
+        deletes = [query['sql'] for query in queries.captured_queries if query['sql'].startswith('DELETE')]
+        self.assertEqual(len(deletes), 3 + 1)
+        self.assertEqual(stats['orphans_deleted'], 7)
+        self.assertFalse(UserLocation.objects.exists())
+
+    def test_rerun_after_interrupted_delete_does_not_merge_twice(self):
+        self.add_path(self.old_day, 25)
+        with patch.object(tracks, 'DELETE_CHUNK_SIZE', 10), \
+                patch.object(tracks.time, 'sleep', side_effect=RuntimeError):
+            with self.assertRaises(RuntimeError):
+                tracks.compact_locations(now=self.now)
+        # The track was committed before the first chunk of raw rows went
+        track = LocationTrack.objects.get(user=self.user)
+        self.assertEqual(UserLocation.objects.count(), 15)
+
+        stats = tracks.compact_locations(now=self.now)
+        self.assertEqual(stats['raw_points'], 0)
+        rerun = LocationTrack.objects.get(user=self.user)
+        self.assertEqual((rerun.raw_count, rerun.points), (25, track.points))
+        self.assertFalse(UserLocation.objects.exists())
+
+    def test_expires_tracks_and_command_reports(self):
+        LocationTrack.objects.create(user=self.user, day=datetime.datetime(2020, 1, 1).date(),
+                                     started_at=self.old_day, ended_at=self.old_day)
+        self.add_path(self.old_day, 5)
+        out = StringIO()
+        with override_settings(LOCATION_TRACK_RETENTION_DAYS=365):
+            call_command('compact_locations', '--days', '3', stdout=out)
+        self.assertIn('Compacted 5 fixes', out.getvalue())
+        self.assertIn('1 expired tracks', out.getvalue())
+        self.assertEqual(list(LocationTrack.objects.values_list('day', flat=True)), [self.old_day.date()])
+
+
+class LocationHistoryTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.alice = User.objects.create_user('alice')
+        self.bob = User.objects.create_user('bob')
+        self.client.force_login(self.alice)
+        self.start = datetime.datetime(2026, 3, 1, 8, tzinfo=datetime.timezone.utc)
+
+    def add_walk(self, user, count, start=None):
+        """A walk east with a zigzag every 100 fixes, one fix per second"""
+        start = start or self.start
+        UserLocation.objects.bulk_create([
+            UserLocation(user=user, latitude=37.7 + (0.001 if i % 200 >= 100 else 0), longitude=-122.4 + i * 0.00001,
+                         captured_at=start + datetime.timedelta(seconds=i))
+            for i in range(count)
+        ])
+
+    def get_history(self, **params):
+        params.setdefault('from', self.start.isoformat())
+        params.setdefault('to', (self.start + datetime.timedelta(days=1)).isoformat())
+        response = self.client.get(reverse('MyApp:location_history'), params)
+        if response.status_code != 200:
+            return response, None
+        return response, json.loads(b''.join(response.streaming_content))
+
+    def test_returns_own_raw_history_in_range(self):
+        self.add_walk(self.alice, 300)
+        response, data = self.get_history(**{'to': (self.start + datetime.timedelta(seconds=250)).timestamp()})
+        self.assertEqual(response['Content-Type'], 'application/json')
+        self.assertEqual(data['user'], self.alice.id)
+        self.assertEqual(data['count'], 250)
+        self.assertEqual(data['points'][0], [37.7, -122.4, self.start.timestamp()])
+        self.assertEqual([point[2] for point in data['points']], sorted(point[2] for point in data['points']))
+
+    def test_simplification_by_tolerance_and_zoom(self):
+        self.add_walk(self.alice, 1000)
+        with patch.object(tracks, 'HISTORY_WINDOW', 300):
+            _, data = self.get_history(tolerance=5)
+        # Each straight run keeps its two ends; window boundaries are kept without duplicates
+        self.assertLess(data['count'], 40)
+        self.assertEqual(len({point[2] for point in data['points']}), data['count'])
+        self.assertEqual(data['points'][-1][2], (self.start + datetime.timedelta(seconds=999)).timestamp())
+
+        _, coarse = self.get_history(zoom=8)
+        _, fine = self.get_history(zoom=18)
+        self.assertEqual(coarse['count'], 2)
+        self.assertGreater(fine['count'], coarse['count'])
+
+    def test_merges_compacted_tracks_with_raw_fixes(self):
+        LocationTrack.objects.create(
+            user=self.alice, day=self.start.date(), started_at=self.start, ended_at=self.start,
+            points=[[37.0, -122.0, self.start.timestamp() - 1], [37.1, -122.1, self.start.timestamp() + 0.5]],
+            point_count=2, raw_count=50,
+        )
+        self.add_walk(self.alice, 2)
+        _, data = self.get_history()
+        self.assertEqual([point[0] for point in data['points']], [37.7, 37.1, 37.7])
+
+    def test_visibility_requires_friendship_and_sharing(self):
+        self.add_walk(self.bob, 10)
+        profile = UserProfile.objects.create(user=self.bob, location_sharing_enabled=True)
+        response, _ = self.get_history(user=self.bob.id)
+        self.assertEqual(response.status_code, 403)
+
+        Friendship.objects.create(requester=self.alice, addressee=self.bob, status=Friendship.ACCEPTED)
+        response, data = self.get_history(user=self.bob.id)
+        self.assertEqual(data['count'], 10)
+
+        profile.location_sharing_enabled = False
+        profile.save()
+        response, _ = self.get_history(user=self.bob.id)
+        self.assertEqual(response.status_code, 403)
+
+    def test_unfriend_in_another_process_applies_at_once(self):
+        self.add_walk(self.bob, 10)
+        UserProfile.objects.create(user=self.bob, location_sharing_enabled=True)
+        friendship = Friendship.objects.create(requester=self.alice, addressee=self.bob, status=Friendship.ACCEPTED)
+        self.assertEqual(Friendship.get_friend_ids(self.alice.id), {self.bob.id})
+        # Deleting without signals leaves this process's cache stale, as a delete elsewhere would
+        Friendship.objects.filter(id=friendship.id)._raw_delete(friendship._state.db)
+        self.assertEqual(Friendship.get_friend_ids(self.alice.id), {self.bob.id})
+
+        response, _ = self.get_history(user=self.bob.id)
+        self.assertEqual(response.status_code, 403)
+
+    def test_invalid_parameters(self):
+        for params in ({'from': 'yesterday'}, {'zoom': 40}, {'tolerance': -1}, {'tolerance': 'nan'},
+                       {'tolerance': 'inf'},
+                       {'to': self.start.isoformat()}, {'to': (self.start + datetime.timedelta(days=40)).isoformat()},
+                       {'from': '1e20', 'to': '1e21'}, {'from': '1e300'}):
+            response, _ = self.get_history(**params)
+            self.assertEqual(response.status_code, 400, params)
+
+    def test_uses_user_time_index(self):
+        with connection.cursor() as cursor:
+            cursor.execute(
+                'EXPLAIN QUERY PLAN SELECT captured_at FROM MyApp_userlocation '
+                'WHERE user_id = %s AND captured_at >= %s ORDER BY captured_at', [1, '2026-01-01']
+            )
+            plan = ' '.join(str(row) for row in cursor.fetchall())
+        self.assertIn('userlocation_user_time_idx', plan)
+
+
+class RequestMetricsTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        request_metrics.reset()
+        Marker.objects.create(title='SF', latitude=37.7749, longitude=-122.4194)
+        self.staff = User.objects.create_user('admin', is_staff=True)
+
+    def test_records_latency_queries_and_size_by_url_name(self):
+        for _ in range(3):
+            response = self.client.get(reverse('MyApp:markers_in_bbox'), {'bbox': '-123,37,-122,38'})
+        self.client.get('/no-such-page/')
+
+        views = request_metrics.snapshot()['views']
+        stats = views['MyApp:markers_in_bbox']
+        self.assertEqual(stats['count'], 3)
+        self.assertGreaterEqual(stats['queries_per_request'], 1)
+        self.assertEqual(stats['bytes_per_request'], len(response.content))
+        self.assertIsNotNone(stats['p95_ms'])
+        self.assertEqual(views['<unresolved>']['count'], 1)
+
+    def test_streaming_responses_are_counted_when_sent(self):
+        response = self.client.get(reverse('MyApp:export_markers'), {'format': 'ndjson'})
+        self.assertNotIn('MyApp:export_markers', request_metrics.snapshot()['views'])
+        body = b''.join(response.streaming_content)
+        stats = request_metrics.snapshot()['views']['MyApp:export_markers']
+        self.assertEqual(stats['bytes_per_request'], len(body))
+        self.assertGreaterEqual(stats['queries_per_request'], 1)
+
+    @override_settings(REQUEST_PROFILE_THRESHOLD_MS=0, REQUEST_PROFILE_SAMPLE_RATE=1.0)
+    def test_profiles_slow_requests(self):
+        self.client.get(reverse('MyApp:markers_in_bbox'), {'bbox': '-123,37,-122,38'})
+        profile = request_metrics.snapshot()['slow_profiles'][-1]
+        self.assertEqual(profile['view'], 'MyApp:markers_in_bbox')
+        self.assertIn('markers_in_bbox', profile['profile'])
+
+    @override_settings(REQUEST_METRICS=False)
+    def test_disabled(self):
+        self.client.get(reverse('MyApp:markers_in_bbox'), {'bbox': '-123,37,-122,38'})
+        self.assertEqual(request_metrics.snapshot()['views'], {})
+
+    @override_settings(REQUEST_METRICS_TOKEN='secret')
+    def test_metrics_endpoint_access_and_formats(self):
+        self.client.get(reverse('MyApp:markers_in_bbox'), {'bbox': '-123,37,-122,38'})
+        self.assertEqual(self.client.get('/metrics').status_code, 403)
+        self.assertEqual(self.client.get('/metrics', HTTP_AUTHORIZATION='Bearer wrong').status_code, 403)
+
+        response = self.client.get('/metrics', HTTP_AUTHORIZATION='Bearer secret')
+        text = response.content.decode()
+        self.assertIn('geomap_request_duration_seconds_bucket{view="MyApp:markers_in_bbox",le="+Inf"} 1', text)
+        self.assertIn('geomap_db_queries_total{view="MyApp:markers_in_bbox"}', text)
+
+        self.client.force_login(self.staff)
+        data = self.client.get('/metrics', {'format': 'json'}).json()
+        self.assertIn('MyApp:markers_in_bbox', data['views'])
+
+
+@override_settings(LOCATION_WRITE_BEHIND=False)
+class LoadTestTests(TestCase):
+    def setUp(self):
+        cache.clear()
+
+    def test_seed_builds_a_ring_of_friends(self):
+        counts = loadtest.seed(50, friends_per_user=4, markers=30, rng=Random(1))
+        self.assertEqual((counts['users'], counts['friendships'], counts['markers']), (50, 100, 30))
+        user = User.objects.filter(username__startswith='load').order_by('id')[7]
+        self.assertEqual(len(Friendship.get_friend_ids(user.id)), 4)
+        self.assertEqual(ProximityAlert.objects.count(), 200)
+        self.assertFalse(UserProfile.objects.filter(latitude__isnull=True).exists())
+
+    def test_every_scenario_runs_cleanly_and_reports(self):
+        loadtest.seed(20, friends_per_user=4, markers=10, rng=Random(1))
+        users = loadtest.load_users(1, Random(1))
+        for name in loadtest.SCENARIOS:
+            run = loadtest.run_scenario(name, users, concurrency=1, requests=5)
+            self.assertEqual((run['requests'], run['errors']), (5, 0), run)
+            self.assertGreater(run['requests_per_second'], 0)
+            self.assertGreater(run['queries_per_request'], 0)
+            self.assertLessEqual(run['latency_ms']['p50'], run['latency_ms']['max'])
+        self.assertEqual(Marker.objects.filter(title='Load test').count(), 5)
+
+    def test_compare_reports(self):
+        def report(rps, p90):
+            return {'runs': [{'scenario': 'dashboard', 'concurrency': 4, 'requests_per_second': rps,
+                              'latency_ms': {'p90': p90}}]}
+        rows = loadtest.compare(report(100.0, 20.0), report(125.0, 15.0))
+        self.assertEqual(rows[0]['requests_per_second'], (100.0, 125.0, 25.0))
+        self.assertEqual(rows[0]['p90_ms'], (20.0, 15.0, -25.0))
+
+
+@override_settings(EVENT_RELAY_INTERVAL=0)
+class EventStreamTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.alice = User.objects.create_user('alice')
+        self.bob = User.objects.create_user('bob')
+        UserProfile.objects.create(user=self.alice, latitude=37.7749, longitude=-122.4194)
+        UserProfile.objects.create(user=self.bob, latitude=37.7800, longitude=-122.4194, location_sharing_enabled=True)
+        Friendship.objects.create(requester=self.alice, addressee=self.bob, status=Friendship.ACCEPTED)
+        ProximityAlert.objects.create(user=self.alice, friend=self.bob)
+
+        self.loop = asyncio.new_event_loop()
+        self.addCleanup(self.loop.close)
+        events.broker._remote = None
+        self.addCleanup(setattr, events.broker, '_remote', None)
+
+    def subscribe(self, user):
+        async def open_subscription():
+            subscription = events.broker.subscribe(user.id)
+            return subscription, subscription.__enter__()
+        subscription, queue = self.loop.run_until_complete(open_subscription())
+        self.addCleanup(subscription.__exit__, None, None, None)
+        return queue
+
+    def next_event(self, queue):
+        return self.loop.run_until_complete(asyncio.wait_for(queue.get(), 1))
+
+    def test_new_notification_is_pushed_to_recipient_only(self):
+        alice_queue = self.subscribe(self.alice)
+        bob_queue = self.subscribe(self.bob)
+        with self.captureOnCommitCallbacks(execute=True):
+            signals.check_proximity_alerts(self.alice)
+
+        event, data = self.next_event(alice_queue)
+        self.assertEqual(event, 'notification')
+        self.assertEqual(data['peer_username'], 'bob')
+        self.assertTrue(bob_queue.empty())
+
+    @override_settings(LOCATION_WRITE_BEHIND=False)
+    def test_friend_position_is_pushed_to_connected_friends(self):
+        queue = self.subscribe(self.alice)
+        with self.captureOnCommitCallbacks(execute=True):
+            views.record_location(self.bob, 37.79, -122.41)
+
+        event, data = self.next_event(queue)
+        self.assertEqual(event, 'friend_location')
+        self.assertEqual((data['username'], data['latitude']), ('bob', 37.79))
+
+    def test_events_from_other_processes_are_relayed(self):
+        queue = self.subscribe(self.alice)
+        cursor = events.broker.relay()
+        with self.captureOnCommitCallbacks(execute=True):
+            events.broker.publish([self.alice.id], 'notification', {'id': 1})
+        self.assertEqual(self.next_event(queue), ('notification', {'id': 1}))
+        # What proximity_sweep or another worker wrote to the outbox
+        LiveEvent.objects.create(origin='sweep-host:4242', user_ids=[self.alice.id], event='notification', data={'id': 2})
+
+        cursor = events.broker.relay(cursor)
+        self.assertEqual(cursor, LiveEvent.latest_cursor())
+        self.assertEqual(self.next_event(queue), ('notification', {'id': 2}))
+        self.assertTrue(queue.empty())  # Its own event was delivered once, when published
+
+    def test_outbox_is_written_only_for_users_served_elsewhere(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            events.broker.publish([self.alice.id, self.bob.id], 'notification', {'id': 1})
+        self.assertFalse(LiveEvent.objects.exists())  # No stream open in any other process
+
+        EventRelay.objects.create(origin='web-2:4242', user_ids=[self.bob.id])
+        events.broker._remote = None
+        with self.captureOnCommitCallbacks(execute=True):
+            events.broker.publish([self.alice.id, self.bob.id], 'notification', {'id': 2})
+            self.assertFalse(LiveEvent.objects.exists())  # Not before the caller commits
+        self.assertEqual(list(LiveEvent.objects.values_list('user_ids', 'data')), [([self.bob.id], {'id': 2})])
+
+        events.broker.heartbeat({self.alice.id})
+        self.assertEqual(EventRelay.objects.get(origin=events.process_origin()).user_ids, [self.alice.id])
+
+    def test_stream_framing(self):
+        with patch.object(events, 'KEEPALIVE_SECONDS', 0.01):
+            stream = events.stream_events(self.alice.id)
+            chunks = [self.loop.run_until_complete(anext(stream)) for _ in range(2)]
+            with self.captureOnCommitCallbacks(execute=True):
+                events.broker.publish([self.alice.id], 'notification', {'id': 1})
+            chunks.append(self.loop.run_until_complete(anext(stream)))
+            self.loop.run_until_complete(stream.aclose())
+
+        retry, keepalive, message = chunks
+        self.assertEqual(retry, 'retry: 5000\n\n')
+        self.assertEqual(keepalive, ': keepalive\n\n')
+        self.assertEqual(message, 'event: notification\ndata: {"id": 1}\n\n')
+        self.assertNotIn(self.alice.id, events.broker.connected_user_ids())
+
+    def test_event_stream_view(self):
+        self.async_client.force_login(self.alice)
+        response = async_to_sync(self.async_client.get)(reverse('MyApp:event_stream'))
+        self.assertEqual(response['Content-Type'], 'text/event-stream')
+        self.assertTrue(response.streaming)
+
+        # Under WSGI a stream would pin a worker thread; 204 makes the page poll instead
+        self.client.force_login(self.alice)
+        self.assertEqual(self.client.get(reverse('MyApp:event_stream')).status_code, 204)
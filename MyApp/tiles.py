@@ -0,0 +1,186 @@
+# tiles.py - Mapbox Vector Tile encoding and per-tile versions for cache validation
+import hashlib
+import struct
+import time
+
+import numpy as np
+from django.core.cache import cache
+
+from .clustering import mercator, unproject
+
+TILE_EXTENT = 4096
+TILE_MAX_ZOOM = 20
+TILE_FEATURE_LIMIT = 50000  # Above this a tile carries clusters instead of single markers
+TILE_VERSION_TIMEOUT = None  # Versions must outlive any ETag a client may still hold
+TILE_BUMP_MAX_POINTS = 1000  # Larger changes bump the generation instead of each tile
+
+# Protobuf wire types
+VARINT, LENGTH_DELIMITED = 0, 2
+
+# MVT geometry: MoveTo with a count of one
+POINT_MOVE_TO = 1 | (1 << 3)
+GEOM_POINT = 1
+
+
+def _varint(value):
+    out = bytearray()
+    while True:
+        byte = value & 0x7F
+        value >>= 7
+        if value:
+            out.append(byte | 0x80)
+        else:
+            out.append(byte)
+            return bytes(out)
+
+
+def _zigzag(value):
+    return (value << 1) ^ (value >> 63)
+
+
+def _field(number, wire_type, payload):
+    """Encode one protobuf field; payload is an int for varints and bytes otherwise"""
+    key = _varint((number << 3) | wire_type)
+    if wire_type == VARINT:
+        return key + _varint(payload)
+    return key + _varint(len(payload)) + payload
+
+
+def _packed(number, values):
+    return _field(number, LENGTH_DELIMITED, b''.join(_varint(value) for value in values))
+
+
+def _value(value):
+    """Encode a property value as a tile Value message"""
+    if isinstance(value, bool):
+        return _field(7, VARINT, int(value))
+    if isinstance(value, int):
+        return _field(6, VARINT, _zigzag(value))
+    if isinstance(value, float):
+        return _field(3, LENGTH_DELIMITED, struct.pack('<d', value))
+    return _field(1, LENGTH_DELIMITED, str(value).encode('utf-8'))
+
+
+def encode_layer(name, features, extent=TILE_EXTENT):
+    """Encode a layer of point features, each a (id, x, y, properties) tuple in tile coordinates"""
+    keys, values = {}, {}
+    encoded = []
+    for feature_id, x, y, properties in features:
+        tags = []
+        for key, value in properties.items():
+            if value is None:
+                continue
+            tags.append(keys.setdefault(key, len(keys)))
+            tags.append(values.setdefault((type(value), value), len(values)))
+        feature = _field(1, VARINT, feature_id) if feature_id is not None else b''
+        if tags:
+            feature += _packed(2, tags)
+        feature += _field(3, VARINT, GEOM_POINT)
+        feature += _packed(4, [POINT_MOVE_TO, _zigzag(x), _zigzag(y)])
+        encoded.append(_field(2, LENGTH_DELIMITED, feature))
+
+    layer = _field(15, VARINT, 2) + _field(1, LENGTH_DELIMITED, name.encode('utf-8'))
+    layer += b''.join(encoded)
+    layer += b''.join(_field(3, LENGTH_DELIMITED, key.encode('utf-8')) for key in keys)
+    layer += b''.join(_field(4, LENGTH_DELIMITED, _value(value)) for _, value in values)
+    layer += _field(5, VARINT, extent)
+    return layer
+
+
+def encode_tile(layers):
+    """Encode {name: features} as a vector tile, skipping empty layers"""
+    return b''.join(
+        _field(3, LENGTH_DELIMITED, encode_layer(name, features))
+        for name, features in layers.items() if features
+    )
+
+
+def tile_bounds(z, x, y):
+    """Return the (west, south, east, north) bbox of a tile; edge rows extend to the poles"""
+    n = 1 << z
+    north, west = unproject(x / n, y / n)
+    south, east = unproject((x + 1) / n, (y + 1) / n)
+    if y == 0:
+        north = 90.0
+    if y == n - 1:
+        south = -90.0
+    return west, south, east, north
+
+
+def tile_points(z, x, y, lats, lngs):
+    """Project coordinates into a tile; returns (px, py, inside) with inside marking points this tile owns
+
+    Points on a shared edge belong to one tile only, the same one tiles_for_point() bumps.
+    """
+    mx, my = mercator(lats, lngs)
+    n = 1 << z
+    tx, ty = mx * n - x, my * n - y
+    inside = (np.floor(mx * n) == x) & (np.floor(my * n) == y)
+    px = np.minimum((tx * TILE_EXTENT).round(), TILE_EXTENT - 1).astype(int)
+    py = np.minimum((ty * TILE_EXTENT).round(), TILE_EXTENT - 1).astype(int)
+    return px.tolist(), py.tolist(), inside.tolist()
+
+
+def tiles_for_point(lat, lng):
+    """Yield (z, x, y) of the tile containing a point at every zoom"""
+    mx, my = mercator([float(lat)], [float(lng)])
+    for z in range(TILE_MAX_ZOOM + 1):
+        n = 1 << z
+        yield z, int(mx[0] * n), int(my[0] * n)
+
+
+def _version_key(z, x, y):
+    return f'tile-version:{z}/{x}/{y}'
+
+
+def _counter(key):
+    """Read a counter, seeding missing ones from the clock so an evicted key never repeats an old value"""
+    value = cache.get(key)
+    if value is None:
+        cache.add(key, time.time_ns(), TILE_VERSION_TIMEOUT)
+        value = cache.get(key)
+    return value
+
+
+def _bump(key):
+    try:
+        cache.incr(key)
+    except ValueError:
+        cache.add(key, time.time_ns(), TILE_VERSION_TIMEOUT)
+
+
+def tile_version(z, x, y):
+    """Version string for a tile's marker content"""
+    return f"{_counter('tile-version:generation')}.{_counter(_version_key(z, x, y))}"
+
+
+def bump_point(lat, lng):
+    """Invalidate every tile containing a marker that was added, edited or removed"""
+    for z, x, y in tiles_for_point(lat, lng):
+        _bump(_version_key(z, x, y))
+
+
+def bump_points(positions):
+    """bump_point for each (lat, lng); None or a very large change bumps every tile"""
+    if positions is None or len(positions) > TILE_BUMP_MAX_POINTS:
+        bump_all()
+        return
+    keys = {_version_key(z, x, y) for lat, lng in positions for z, x, y in tiles_for_point(float(lat), float(lng))}
+    for key in keys:
+        _bump(key)
+
+
+def bump_all():
+    """Invalidate every tile at once, e.g. after all markers were cleared"""
+    _bump('tile-version:generation')
+
+
+def tile_etag(version, friend_rows):
+    """Strong ETag for a tile from its marker version and the friend positions it contains"""
+    digest = hashlib.sha1(repr(sorted(friend_rows)).encode()).hexdigest()[:16] if friend_rows else '0'
+    return f'"{version}-{digest}"'
+
+
+def is_valid_tile(z, x, y):
+    return 0 <= z <= TILE_MAX_ZOOM and 0 <= x < (1 << z) and 0 <= y < (1 << z)
+
@@ -0,0 +1,275 @@
+# tracks.py - Location history: simplified per-day tracks and time-range reads
+import datetime
+import heapq
+import math
+import time
+import warnings
+
+import numpy as np
+from django.conf import settings
+from django.db import connections, transaction
+from django.db.models import FloatField, Min, TextField
+from django.db.models.functions import Cast
+from django.utils import timezone
+
+from .models import LocationTrack, UserLocation
+
+EARTH_RADIUS_M = 6371000.0
+DELETE_CHUNK_SIZE = 900  # Ids per DELETE, below SQLite's bound-parameter limit
+COMPACT_PAUSE = 0.01  # Seconds between days so live location writes can take the lock
+HISTORY_WINDOW = 5000  # Points simplified together when streaming history
+HISTORY_CHUNK_SIZE = 5000
+METERS_PER_PIXEL_Z0 = 156543.03392  # Web Mercator ground resolution at the equator at zoom 0
+
+
+def simplify(lats, lngs, tolerance_m):
+    """Return the indices kept by Douglas-Peucker simplification of a path
+
+    Distances are measured in metres on a local equirectangular projection,
+    which is accurate to well under a metre over the extent of one day's path.
+    The first and last points are always kept.
+    """
+    n = len(lats)
+    if n <= 2:
+        return np.arange(n)
+    lats = np.asarray(lats, dtype=np.float64)
+    lngs = np.asarray(lngs, dtype=np.float64)
+    scale = math.cos(math.radians(float(lats.mean())))
+    x = np.radians(lngs) * scale * EARTH_RADIUS_M
+    y = np.radians(lats) * EARTH_RADIUS_M
+
+    keep = np.zeros(n, dtype=bool)
+    keep[0] = keep[-1] = True
+    stack = [(0, n - 1)]
+    while stack:
+        first, last = stack.pop()
+        if last - first < 2:
+            continue
+        px, py = x[first + 1:last], y[first + 1:last]
+        dx, dy = x[last] - x[first], y[last] - y[first]
+        length_sq = dx * dx + dy * dy
+        if length_sq == 0:
+            distances = np.hypot(px - x[first], py - y[first])
+        else:
+            # Distance to the segment rather than the line, so out-and-back paths keep their far end
+            t = np.clip(((px - x[first]) * dx + (py - y[first]) * dy) / length_sq, 0, 1)
+            distances = np.hypot(px - (x[first] + t * dx), py - (y[first] + t * dy))
+        farthest = int(distances.argmax())
+        if distances[farthest] > tolerance_m:
+            index = first + 1 + farthest
+            keep[index] = True
+            stack.append((first, index))
+            stack.append((index, last))
+    return np.flatnonzero(keep)
+
+
+def zoom_tolerance_m(zoom, latitude):
+    """Ground distance covered by one map pixel at a zoom level and latitude"""
+    return METERS_PER_PIXEL_Z0 * math.cos(math.radians(latitude)) / 2 ** zoom
+
+
+def iter_history(user_id, start, end):
+    """Yield (latitude, longitude, unix seconds) for a user's fixes in [start, end) in time order
+
+    Compacted days come from LocationTrack rows and the rest from raw fixes,
+    read through the (user, captured_at) index a chunk at a time.
+    """
+    start_ts, end_ts = start.timestamp(), end.timestamp()
+    days = LocationTrack.objects.filter(
+        user_id=user_id,
+        day__gte=start.astimezone(datetime.timezone.utc).date(),
+        day__lte=end.astimezone(datetime.timezone.utc).date(),
+    ).order_by('day').values_list('points', flat=True)
+    compacted = [
+        (point[0], point[1], point[2])
+        for points in days for point in points if start_ts <= point[2] < end_ts
+    ]
+    raw = _iter_raw(user_id, start, end)
+    if not compacted:
+        return raw
+    return heapq.merge(compacted, raw, key=lambda point: point[2])
+
+
+def _iter_raw(user_id, start, end):
+    queryset = UserLocation.objects.filter(
+        user_id=user_id, captured_at__gte=start, captured_at__lt=end
+    ).order_by('captured_at').values_list(
+        Cast('latitude', FloatField()), Cast('longitude', FloatField()), Cast('captured_at', TextField())
+    )
+    # Run the compiled query on a plain cursor: Django's per-row value converters
+    # cost several times more than the query itself for a day of 1-second fixes
+    sql, params = queryset.query.sql_with_params()
+    with connections[queryset.db].cursor() as cursor:
+        cursor.execute(sql, params)
+        while True:
+            rows = cursor.fetchmany(HISTORY_CHUNK_SIZE)
+            if not rows:
+                return
+            lats, lngs, stamps = zip(*rows)
+            yield from zip(lats, lngs, _epochs(stamps))
+
+
+def _epochs(texts):
+    """Unix seconds for stored datetimes; naive values are UTC as Django saves them with USE_TZ"""
+    with warnings.catch_warnings():
+        warnings.simplefilter('error')  # numpy only warns about explicit offsets
+        try:
+            micros = np.array(texts, dtype='datetime64[us]').astype(np.int64)
+            return (micros / 1e6).round(3).tolist()
+        except (ValueError, UserWarning):
+            pass
+    seconds = []
+    for text in texts:
+        value = datetime.datetime.fromisoformat(text)
+        if value.tzinfo is None:
+            value = value.replace(tzinfo=datetime.timezone.utc)
+        seconds.append(round(value.timestamp(), 3))
+    return seconds
+
+
+def simplify_stream(points, tolerance_m=None, zoom=None, window=HISTORY_WINDOW):
+    """Simplify a time-ordered point stream, yielding lists of kept points window by window
+
+    Consecutive windows share their boundary point, which is always kept, so
+    the output joins up exactly while memory stays bounded by the window.
+    With zoom the tolerance is one pixel at that zoom; with neither, every
+    point is passed through.
+    """
+    batch = []
+    for point in points:
+        batch.append(point)
+        if len(batch) >= window:
+            yield _simplify_window(batch, tolerance_m, zoom)[:-1]
+            batch = [batch[-1]]
+    if batch:
+        yield _simplify_window(batch, tolerance_m, zoom)
+
+
+def _simplify_window(batch, tolerance_m, zoom):
+    if zoom is not None:
+        tolerance_m = zoom_tolerance_m(zoom, batch[0][0])
+    if not tolerance_m:
+        return batch
+    lats = [point[0] for point in batch]
+    lngs = [point[1] for point in batch]
+    return [batch[i] for i in simplify(lats, lngs, tolerance_m)]
+
+
+def compaction_cutoff(now=None, days=None):
+    """Start of the UTC day before which raw fixes are compacted"""
+    if days is None:
+        days = settings.LOCATION_RAW_RETENTION_DAYS
+    now = now or timezone.now()
+    day = (now - datetime.timedelta(days=days)).astimezone(datetime.timezone.utc).date()
+    return _day_start(day)
+
+
+def _day_start(day):
+    return datetime.datetime.combine(day, datetime.time.min, tzinfo=datetime.timezone.utc)
+
+
+def compact_locations(days=None, tolerance_m=None, now=None):
+    """Fold raw fixes older than the retention window into LocationTrack rows and delete them
+
+    Each user-day is simplified and merged into any existing track for that
+    day before its raw rows are deleted in short transactions; the job can
+    stop and restart at any point. Returns stats.
+    """
+    if tolerance_m is None:
+        tolerance_m = settings.LOCATION_SIMPLIFY_TOLERANCE_M
+    cutoff = compaction_cutoff(now, days)
+    started = time.perf_counter()
+    stats = {'cutoff': cutoff.isoformat(), 'users': 0, 'days': 0, 'raw_points': 0, 'track_points': 0,
+             'orphans_deleted': 0, 'tracks_expired': 0}
+
+    old = UserLocation.objects.filter(captured_at__lt=cutoff)
+    user_ids = list(old.filter(user__isnull=False).order_by('user_id').values_list('user_id', flat=True).distinct())
+    for user_id in user_ids:
+        stats['users'] += 1
+        mine = old.filter(user_id=user_id)
+        first = mine.aggregate(first=Min('captured_at'))['first']
+        while first is not None:
+            day = first.astimezone(datetime.timezone.utc).date()
+            day_end = _day_start(day + datetime.timedelta(days=1))
+            raw, kept = compact_day(user_id, day, tolerance_m)
+            stats['days'] += 1
+            stats['raw_points'] += raw
+            stats['track_points'] += kept
+            first = mine.filter(captured_at__gte=day_end).aggregate(first=Min('captured_at'))['first']
+            time.sleep(COMPACT_PAUSE)
+
+    # Fixes without a user have no track to go into
+    stats['orphans_deleted'] = _delete_chunked(old.filter(user__isnull=True))
+
+    track_days = getattr(settings, 'LOCATION_TRACK_RETENTION_DAYS', None)
+    if track_days is not None:
+        oldest = compaction_cutoff(now, track_days).date()
+        stats['tracks_expired'] = _delete_chunked(LocationTrack.objects.filter(day__lt=oldest))
+
+    elapsed = time.perf_counter() - started
+    stats['seconds'] = round(elapsed, 3)
+    return stats
+
+
+def compact_day(user_id, day, tolerance_m):
+    """Simplify one user's raw fixes for one UTC day into its track; returns (raw, kept) point counts
+
+    The track is written in one short transaction and the raw rows are then
+    deleted a chunk per transaction. The track records the highest raw id it
+    holds, so a rerun after an interrupted delete only removes the leftovers
+    instead of merging them a second time.
+    """
+    day_start = _day_start(day)
+    day_end = _day_start(day + datetime.timedelta(days=1))
+    raw = UserLocation.objects.filter(user_id=user_id, captured_at__gte=day_start, captured_at__lt=day_end)
+    with transaction.atomic():
+        track = LocationTrack.objects.select_for_update().filter(user_id=user_id, day=day).first()
+        through_id = track.raw_through_id if track is not None else 0
+        rows = list(
+            raw.filter(id__gt=through_id)
+            .order_by('captured_at', 'id')
+            .values_list('id', 'latitude', 'longitude', 'captured_at')
+        )
+        if rows:
+            points = [[float(lat), float(lng), captured_at.timestamp()] for _, lat, lng, captured_at in rows]
+            raw_count = len(rows)
+            if track is not None:
+                # Fixes uploaded late for an already compacted day are merged into its path
+                points = sorted(track.points + points, key=lambda point: point[2])
+                raw_count += track.raw_count
+
+            lats = [point[0] for point in points]
+            lngs = [point[1] for point in points]
+            kept = [
+                [round(points[i][0], 6), round(points[i][1], 6), round(points[i][2], 3)]
+                for i in simplify(lats, lngs, tolerance_m)
+            ]
+            through_id = max(through_id, max(row[0] for row in rows))
+            track, _ = LocationTrack.objects.update_or_create(
+                user_id=user_id, day=day,
+                defaults={
+                    'points': kept,
+                    'point_count': len(kept),
+                    'raw_count': raw_count,
+                    'raw_through_id': through_id,
+                    'started_at': datetime.datetime.fromtimestamp(kept[0][2], datetime.timezone.utc),
+                    'ended_at': datetime.datetime.fromtimestamp(kept[-1][2], datetime.timezone.utc),
+                },
+            )
+    if track is None:
+        return 0, 0
+    _delete_chunked(raw.filter(id__lte=through_id))
+    return len(rows), track.point_count
+
+
+def _delete_chunked(queryset):
+    """Delete a queryset DELETE_CHUNK_SIZE rows at a time, each chunk in its own transaction"""
+    deleted = 0
+    while True:
+        ids = list(queryset.order_by('id').values_list('id', flat=True)[:DELETE_CHUNK_SIZE])
+        if not ids:
+            return deleted
+        with transaction.atomic():
+            count, _ = queryset.model.objects.filter(id__in=ids).delete()
+        deleted += count
+        time.sleep(COMPACT_PAUSE)
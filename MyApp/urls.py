@@ -25,22 +25,40 @@ urlpatterns = [
     
     # User search and friend management
     path('search/', views.user_search, name='user_search'),
+    path('api/users/autocomplete/', views.user_autocomplete, name='user_autocomplete'),
     path('send-friend-request/<int:user_id>/', views.send_friend_request, name='send_friend_request'),
     path('friend-request/<int:friendship_id>/<str:action>/', views.handle_friend_request, name='handle_friend_request'),
     
     # Location management
     path('update-location/', views.update_location, name='update_location'),
+    path('api/locations/batch/', views.batch_update_location, name='batch_update_location'),
+    path('api/history/', views.location_history, name='location_history'),
     path('toggle-location-sharing/', views.toggle_location_sharing, name='toggle_location_sharing'),
+    path('api/location-buffer/metrics/', views.location_buffer_metrics, name='location_buffer_metrics'),
     
     # API endpoints for map functionality
     path('api/add-marker/', views.add_marker, name='add_marker'),
     path('api/delete-marker/<int:marker_id>/', views.delete_marker, name='delete_marker'),
     path('api/clear-markers/', views.clear_markers, name='clear_markers'),
+    path('api/clear-markers/status/', views.clear_markers_status, name='clear_markers_status'),
+    path('api/markers/', views.markers_in_bbox, name='markers_in_bbox'),
+    path('api/markers/nearest/', views.nearest_markers, name='nearest_markers'),
+    path('api/markers/clusters/', views.marker_clusters, name='marker_clusters'),
+    path('api/markers/changes/', views.marker_changes, name='marker_changes'),
+    path('api/markers/import/', views.import_markers, name='import_markers'),
+    path('api/markers/export/', views.export_markers, name='export_markers'),
+    path('tiles/<int:z>/<int:x>/<int:y>.mvt', views.vector_tile, name='vector_tile'),
     
     # Peer tracking and notifications (these were missing from your original)
     path('toggle-tracking/', views.toggle_tracking, name='toggle_tracking'),
     path('get-proximity-notifications/', views.get_proximity_notifications, name='get_proximity_notifications'),
+    path('events/', views.event_stream, name='event_stream'),
     path('mark-notification-read/<int:notification_id>/', views.mark_notification_read, name='mark_notification_read'),
+
+    # Geofences
+    path('api/geofences/', views.geofence_list, name='geofence_list'),
+    path('api/geofences/<int:geofence_id>/', views.delete_geofence, name='delete_geofence'),
+    path('api/geofences/events/', views.geofence_events, name='geofence_events'),
     
     # Optional: Detailed marker management views
     path('marker-list/', views.marker_list, name='marker_list'),
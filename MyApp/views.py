@@ -5,19 +5,41 @@ from django.contrib.auth.decorators import login_required
 from django.contrib.auth.models import User
 from django.contrib.auth.forms import UserCreationForm
 from django.contrib.auth import login
-from django.http import JsonResponse
+from django.http import HttpResponse, JsonResponse, StreamingHttpResponse
 from django.views.decorators.http import require_POST, require_http_methods
 from django.views.decorators.csrf import csrf_exempt
 from django.utils import timezone
+from django.utils.cache import get_conditional_response, patch_vary_headers
+from django.utils.dateparse import parse_datetime
 from django.contrib import messages
+from django.contrib.admin.views.decorators import staff_member_required
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.core.handlers.asgi import ASGIRequest
 from django.db import models
+from asgiref.sync import sync_to_async
+import hmac
 import json
-from datetime import timedelta
+import math
+from datetime import datetime, timedelta, timezone as dt_timezone
+from itertools import islice
 
 # Import your models
 from .models import (
-    Marker, UserLocation, Task, Location,
-    UserProfile, Friendship, ProximityAlert, ProximityNotification
+    Marker, MarkerChange, UserLocation, Task, Location,
+    UserProfile, Friendship, ProximityAlert, ProximityNotification, Geofence, GeofenceEvent, UserSearchIndex,
+    AUTOCOMPLETE_LIMIT
+)
+from .clustering import cluster_index
+from .instrumentation import request_metrics
+from .events import stream_events
+from . import marker_io
+from .bulk_delete import ClearInProgress, clear_status, start_clear
+from .location_buffer import location_buffer
+from .nearest import marker_index, NEAREST_MAX_K
+from . import geofences, tiles, tracks
+from .proximity import (
+    has_location, profile_distances_km
 )
 
 # ===== AUTHENTICATION VIEWS =====
@@ -47,25 +69,34 @@ def dashboard(request):
     """Main dashboard showing friends and their locations"""
     try:
         user_profile, created = UserProfile.objects.get_or_create(user=request.user)
-        friends = Friendship.get_friends(request.user)
-        
+        friends = list(Friendship.get_friends(request.user).select_related('userprofile'))
+
+        # Create any missing friend profiles in one batch; new ones have no location to show
+        missing = [friend for friend in friends if not hasattr(friend, 'userprofile')]
+        if missing:
+            UserProfile.objects.bulk_create(
+                [UserProfile(user=friend) for friend in missing], ignore_conflicts=True
+            )
+
         # Get friend profiles with location data
-        friend_profiles = []
-        for friend in friends:
-            profile, created = UserProfile.objects.get_or_create(user=friend)
-            if profile.location_sharing_enabled and profile.latitude and profile.longitude:
-                distance = user_profile.get_distance_to(profile) if user_profile.latitude else None
-                friend_profiles.append({
-                    'user': friend,
-                    'profile': profile,
-                    'distance': round(distance, 2) if distance else None
-                })
+        shared = [
+            (friend, friend.userprofile) for friend in friends
+            if hasattr(friend, 'userprofile')
+            and friend.userprofile.location_sharing_enabled and has_location(friend.userprofile)
+        ]
+
+        distances = profile_distances_km(user_profile, [profile for friend, profile in shared])
+        friend_profiles = [{
+            'user': friend,
+            'profile': profile,
+            'distance': round(distance, 2) if distance is not None else None
+        } for (friend, profile), distance in zip(shared, distances)]
         
         # Get pending friend requests
         pending_requests = Friendship.objects.filter(
             addressee=request.user, 
             status=Friendship.PENDING
-        )
+        ).select_related('requester')
         
     except Exception as e:
         # Fallback for when models don't exist yet
@@ -81,33 +112,11 @@ def dashboard(request):
     return render(request, 'MyApp/dashboard.html', context)
 
 def map_view(request):
-    """Display the map with existing markers"""
-    try:
-        markers = Marker.objects.all()
-        markers_data = []
-        
-        for marker in markers:
-            markers_data.append({
-                'id': marker.id,
-                'latitude': float(marker.latitude),
-                'longitude': float(marker.longitude),
-                'title': marker.title,
-                'description': marker.description,
-                'created_by': getattr(marker, 'user', {}).username if hasattr(marker, 'user') else 'Unknown',
-                'is_own': True  # You can add logic here to check ownership
-            })
-        
-        context = {
-            'markers': markers_data,
-            'is_tracking_enabled': False,  # Add your tracking logic here
-        }
-    except Exception:
-        # Fallback when no markers exist
-        context = {
-            'markers': [],
-            'is_tracking_enabled': False,
-        }
-    
+    """Display the map; markers are fetched per viewport and kept current from marker_changes"""
+    context = {
+        'is_tracking_enabled': False,  # Add your tracking logic here
+        'marker_cursor': MarkerChange.latest_cursor(),
+    }
     return render(request, 'map.html', context)
 
 @login_required
@@ -135,32 +144,26 @@ def notifications(request):
 
 @login_required
 def user_search(request):
-    """Search for users to add as friends"""
-    query = request.GET.get('q', '')
-    users = []
-    
-    if query:
-        users = User.objects.filter(
-            username__icontains=query
-        ).exclude(id=request.user.id)[:10]
-        
-        # Add friendship status for each user (if models exist)
-        try:
-            for user in users:
-                friendship = Friendship.objects.filter(
-                    models.Q(requester=request.user, addressee=user) |
-                    models.Q(requester=user, addressee=request.user)
-                ).first()
-                
-                user.friendship_status = friendship.status if friendship else None
-        except:
-            pass  # Model might not exist yet
+    """Search for users to add as friends by username prefix"""
+    query = request.GET.get('q', '').strip()
+    users = UserSearchIndex.search(query, request.user) if query else []
     
     return render(request, 'MyApp/user_search.html', {
         'users': users,
         'query': query
     })
 
+@login_required
+@require_http_methods(["GET"])
+def user_autocomplete(request):
+    """Username suggestions for type-ahead, served from a per-prefix cache"""
+    query = request.GET.get('q', '').strip()
+    matches = UserSearchIndex.autocomplete(query, AUTOCOMPLETE_LIMIT + 1) if query else []
+    users = [{'id': user_id, 'username': username} for user_id, username in matches if user_id != request.user.id]
+    response = JsonResponse({'users': users[:AUTOCOMPLETE_LIMIT]})
+    response['Cache-Control'] = 'private, max-age=60'
+    return response
+
 @login_required
 def send_friend_request(request, user_id):
     """Send a friend request to another user"""
@@ -237,21 +240,113 @@ def update_location(request):
         latitude = float(data.get('latitude'))
         longitude = float(data.get('longitude'))
         
-        profile, created = UserProfile.objects.get_or_create(user=request.user)
-        old_lat, old_lng = profile.latitude, profile.longitude
-        
-        profile.update_location(latitude, longitude)
-        
-        # Check for proximity alerts if location changed significantly
-        if old_lat is None or old_lng is None or \
-           abs(float(old_lat) - latitude) > 0.001 or abs(float(old_lng) - longitude) > 0.001:
-            check_proximity_alerts(request.user)
-        
-        return JsonResponse({'status': 'success', 'message': 'Location updated'})
+        record_location(request.user, latitude, longitude)
+        message = 'Location update received' if settings.LOCATION_WRITE_BEHIND else 'Location updated'
+        return JsonResponse({'status': 'success', 'message': message})
     
     except Exception as e:
         return JsonResponse({'status': 'success', 'message': 'Location update received'})
 
+LOCATION_BATCH_MAX = 5000
+LOCATION_ACCURACY_MAX_M = 1000000  # Far beyond any real fix, well inside UserLocation.accuracy_m's range
+
+@csrf_exempt
+@require_POST
+@login_required
+def batch_update_location(request):
+    """Accept a backlog of timestamped fixes as a JSON array or NDJSON"""
+    try:
+        fixes = parse_location_fixes(request)
+        if not isinstance(fixes, list):
+            raise ValueError('Expected a list of fixes')
+    except ValueError:
+        return JsonResponse({
+            'status': 'error',
+            'message': 'Body must be a JSON array, {"fixes": [...]} or NDJSON'
+        }, status=400)
+
+    if len(fixes) > LOCATION_BATCH_MAX:
+        return JsonResponse({
+            'status': 'error',
+            'message': f'At most {LOCATION_BATCH_MAX} fixes per batch'
+        }, status=413)
+
+    locations = []
+    rejected = []
+    for index, fix in enumerate(fixes):
+        try:
+            latitude, longitude, accuracy_m, captured_at = parse_location_fix(fix)
+        except (KeyError, TypeError, ValueError) as e:
+            rejected.append({'index': index, 'error': str(e)})
+            continue
+        locations.append(UserLocation(
+            user=request.user,
+            latitude=latitude,
+            longitude=longitude,
+            accuracy_m=accuracy_m,
+            captured_at=captured_at
+        ))
+
+    if locations:
+        UserLocation.objects.bulk_create(locations, batch_size=500)
+
+        # Only the newest fix moves the profile, so proximity is evaluated once per batch
+        newest = max(locations, key=lambda location: location.captured_at)
+        record_location(request.user, newest.latitude, newest.longitude, newest.captured_at)
+
+    return JsonResponse({'status': 'success', 'accepted': len(locations), 'rejected': rejected})
+
+HISTORY_MAX_DAYS = 31
+HISTORY_MAX_ZOOM = 22
+
+@require_http_methods(["GET"])
+@login_required
+def location_history(request):
+    """Stream a user's track between two times, simplified for a zoom level or tolerance in metres"""
+    try:
+        user_id = int(request.GET.get('user', request.user.id))
+        end = parse_timestamp(request.GET['to']) if 'to' in request.GET else timezone.now()
+        start = parse_timestamp(request.GET['from']) if 'from' in request.GET else end - timedelta(days=1)
+        zoom = int(request.GET['zoom']) if 'zoom' in request.GET else None
+        tolerance_m = float(request.GET.get('tolerance', 0))
+        if start >= end or end - start > timedelta(days=HISTORY_MAX_DAYS):
+            raise ValueError('Invalid range')
+        if not (math.isfinite(tolerance_m) and tolerance_m >= 0) \
+                or (zoom is not None and not 0 <= zoom <= HISTORY_MAX_ZOOM):
+            raise ValueError('Invalid simplification')
+    except (TypeError, ValueError, OverflowError):
+        return JsonResponse({
+            'success': False,
+            'error': f'Invalid user, from, to, zoom or tolerance (ranges up to {HISTORY_MAX_DAYS} days)'
+        }, status=400)
+
+    if not can_view_history(request.user, user_id):
+        return JsonResponse({'success': False, 'error': 'Location history not shared with you'}, status=403)
+
+    points = tracks.iter_history(user_id, start, end)
+    windows = tracks.simplify_stream(points, tolerance_m=tolerance_m, zoom=zoom)
+    return streaming_response(request, stream_history(user_id, start, end, windows), content_type='application/json')
+
+def stream_history(user_id, start, end, windows):
+    """Yield the history response as JSON text, one simplification window at a time"""
+    head = json.dumps({'user': user_id, 'from': start.isoformat(), 'to': end.isoformat()})
+    yield head[:-1] + ', "points": ['
+    count = 0
+    for window in windows:
+        if window:
+            yield (',' if count else '') + json.dumps(window, separators=(',', ':'))[1:-1]
+            count += len(window)
+    yield f'], "count": {count}}}'
+
+def can_view_history(viewer, user_id):
+    """Users see their own history, and friends' history while they share their location"""
+    if viewer.id == user_id:
+        return True
+    return (
+        user_id in Friendship.get_friend_ids(viewer.id, cached=False)
+        and UserProfile.objects.filter(user_id=user_id, location_sharing_enabled=True).exists()
+    )
+
 @login_required
 def toggle_location_sharing(request):
     """Toggle location sharing on/off"""
@@ -315,13 +410,257 @@ def delete_marker(request, marker_id):
 @csrf_exempt
 @require_http_methods(["DELETE"])
 def clear_markers(request):
-    """Delete all markers"""
+    """Start deleting all markers in the background; poll clear_markers_status for progress"""
     try:
-        Marker.objects.all().delete()
-        return JsonResponse({'success': True})
+        status = start_clear()
+        return JsonResponse({'success': True, 'job': status}, status=202)
+    except ClearInProgress:
+        return JsonResponse({'success': False, 'error': 'A clear is already running', 'job': clear_status()}, status=409)
     except Exception as e:
         return JsonResponse({'success': False, 'error': str(e)}, status=500)
 
+@require_http_methods(["GET"])
+def clear_markers_status(request):
+    """Report progress of the current or last clear_markers job"""
+    status = clear_status()
+    if status is None:
+        return JsonResponse({'success': False, 'error': 'No clear has run'}, status=404)
+    return JsonResponse({'success': True, 'job': status})
+
+MARKER_API_LIMIT = 500
+
+def parse_bbox(value):
+    """Parse a 'west,south,east,north' string into a tuple of floats"""
+    west, south, east, north = (float(part) for part in value.split(','))
+    if not (-90 <= south <= north <= 90 and -180 <= west <= 180 and -180 <= east <= 180):
+        raise ValueError('Invalid bbox')
+    return west, south, east, north
+
+@require_http_methods(["GET"])
+def markers_in_bbox(request):
+    """Return the markers inside the visible map bounds, capped at MARKER_API_LIMIT"""
+    try:
+        west, south, east, north = parse_bbox(request.GET['bbox'])
+    except (KeyError, ValueError):
+        return JsonResponse({'success': False, 'error': 'Invalid bbox'}, status=400)
+
+    markers = Marker.objects.within_bbox(west, south, east, north)
+    rows = list(markers.values('id', 'latitude', 'longitude', 'title', 'description')[:MARKER_API_LIMIT + 1])
+    truncated = len(rows) > MARKER_API_LIMIT
+    markers_data = [{
+        'id': row['id'],
+        'latitude': float(row['latitude']),
+        'longitude': float(row['longitude']),
+        'title': row['title'],
+        'description': row['description'],
+    } for row in rows[:MARKER_API_LIMIT]]
+
+    return JsonResponse({
+        'markers': markers_data,
+        'truncated': truncated,
+    })
+
+@require_http_methods(["GET"])
+def marker_clusters(request):
+    """Return marker clusters for the visible map bounds at a zoom level"""
+    try:
+        west, south, east, north = parse_bbox(request.GET['bbox'])
+        zoom = int(request.GET.get('zoom', 0))
+    except (KeyError, ValueError):
+        return JsonResponse({'success': False, 'error': 'Invalid bbox or zoom'}, status=400)
+
+    clusters, truncated = cluster_index.clusters(west, south, east, north, zoom)
+
+    # Single markers are sent with their details so the map can show them as usual
+    markers = Marker.objects.in_bulk([cluster['id'] for cluster in clusters if 'id' in cluster])
+    for cluster in clusters:
+        marker = markers.get(cluster.get('id'))
+        if marker is not None:
+            cluster['latitude'] = float(marker.latitude)
+            cluster['longitude'] = float(marker.longitude)
+            cluster['title'] = marker.title
+            cluster['description'] = marker.description
+
+    return JsonResponse({
+        'clusters': clusters,
+        'zoom': zoom,
+        'truncated': truncated,
+    })
+
+@csrf_exempt
+@require_POST
+@staff_member_required
+def import_markers(request):
+    """Stream a GeoJSON FeatureCollection or NDJSON request body into the marker table"""
+    data_format = request.GET.get('format') or marker_io.guess_format(request.content_type)
+    if data_format not in marker_io.FORMATS:
+        return JsonResponse({'success': False, 'error': 'Unknown format'}, status=400)
+
+    try:
+        # Read the body as a stream; request.body would load it all into memory
+        stats = marker_io.import_markers(request, data_format)
+    except marker_io.ImportFormatError as e:
+        return JsonResponse({'success': False, 'error': str(e)}, status=400)
+    finally:
+        marker_io.markers_replaced()
+
+    return JsonResponse({'success': True, **stats})
+
+@require_http_methods(["GET"])
+def export_markers(request):
+    """Stream every marker as a GeoJSON FeatureCollection or NDJSON download"""
+    data_format = request.GET.get('format', 'geojson')
+    if data_format not in marker_io.FORMATS:
+        return JsonResponse({'success': False, 'error': 'Unknown format'}, status=400)
+
+    response = streaming_response(
+        request, marker_io.export_markers(data_format), content_type=marker_io.CONTENT_TYPES[data_format]
+    )
+    response['Content-Disposition'] = f'attachment; filename="markers.{data_format}"'
+    return response
+
+MARKER_CHANGES_PAGE_SIZE = 1000
+
+@require_http_methods(["GET"])
+def marker_changes(request):
+    """Return marker changes after a cursor, collapsed to the latest state of each marker"""
+    try:
+        since = int(request.GET.get('since', 0))
+        if since < 0:
+            raise ValueError('Negative cursor')
+    except ValueError:
+        return JsonResponse({'success': False, 'error': 'Invalid cursor'}, status=400)
+
+    entries = list(
+        MarkerChange.objects.filter(id__gt=since).order_by('id')
+        .values_list('id', 'marker_id', 'action')[:MARKER_CHANGES_PAGE_SIZE + 1]
+    )
+    has_more = len(entries) > MARKER_CHANGES_PAGE_SIZE
+    entries = entries[:MARKER_CHANGES_PAGE_SIZE]
+    cursor = entries[-1][0] if entries else since
+
+    # A clear or reset supersedes everything before it; so does a cursor from a log that no longer exists
+    reset = not entries and since > MarkerChange.latest_cursor()
+    latest = {}
+    for change_id, marker_id, action in entries:
+        if action in MarkerChange.RESYNC_ACTIONS:
+            reset = True
+            latest.clear()
+        else:
+            latest[marker_id] = action
+    if reset and not entries:
+        cursor = MarkerChange.latest_cursor()
+
+    markers = Marker.objects.in_bulk([marker_id for marker_id, action in latest.items() if action != MarkerChange.DELETE])
+    changes = []
+    for marker_id, action in latest.items():
+        marker = markers.get(marker_id)
+        if marker is None:
+            changes.append({'action': 'delete', 'id': marker_id})
+        else:
+            changes.append({
+                'action': 'upsert',
+                'id': marker.id,
+                'latitude': float(marker.latitude),
+                'longitude': float(marker.longitude),
+                'title': marker.title,
+                'description': marker.description,
+            })
+
+    return JsonResponse({
+        'cursor': cursor,
+        'reset': reset,
+        'has_more': has_more,
+        'changes': changes,
+    })
+
+@require_http_methods(["GET"])
+def vector_tile(request, z, x, y):
+    """Serve markers, and the user's visible friends, as a Mapbox Vector Tile"""
+    if not tiles.is_valid_tile(z, x, y):
+        return JsonResponse({'success': False, 'error': 'Invalid tile'}, status=404)
+
+    west, south, east, north = tiles.tile_bounds(z, x, y)
+    friend_rows = []
+    if request.user.is_authenticated:
+        friend_ids = sorted(Friendship.get_friend_ids(request.user.id, cached=False))
+        for start in range(0, len(friend_ids), 900):
+            friend_rows.extend(
+                UserProfile.objects.within_bbox(west, south, east, north)
+                .filter(user_id__in=friend_ids[start:start + 900], location_sharing_enabled=True)
+                .values_list('user_id', 'user__username', 'latitude', 'longitude', 'last_location_update')
+            )
+
+    etag = tiles.tile_etag(tiles.tile_version(z, x, y), friend_rows)
+    response = get_conditional_response(request, etag=etag)
+    if response is None:
+        layers = {'markers': tile_marker_features(z, x, y, west, south, east, north)}
+        if friend_rows:
+            px, py, inside = tiles.tile_points(
+                z, x, y, [float(row[2]) for row in friend_rows], [float(row[3]) for row in friend_rows]
+            )
+            layers['friends'] = [
+                (user_id, px[i], py[i], {
+                    'username': username,
+                    'last_location_update': last_update.isoformat() if last_update else None,
+                })
+                for i, (user_id, username, _, _, last_update) in enumerate(friend_rows) if inside[i]
+            ]
+        response = HttpResponse(tiles.encode_tile(layers), content_type='application/vnd.mapbox-vector-tile')
+
+    response['ETag'] = etag
+    response['Cache-Control'] = 'private, no-cache' if request.user.is_authenticated else 'public, no-cache'
+    patch_vary_headers(response, ['Cookie'])
+    return response
+
+def tile_marker_features(z, x, y, west, south, east, north):
+    """Marker features for a tile, or cluster features when the tile holds too many markers"""
+    rows = [
+        (marker_id, lat, lng, {'title': title})
+        for marker_id, lat, lng, title in Marker.objects.within_bbox(west, south, east, north)
+        .order_by('id').values_list('id', 'latitude', 'longitude', 'title')[:tiles.TILE_FEATURE_LIMIT + 1]
+    ]
+    if len(rows) > tiles.TILE_FEATURE_LIMIT:
+        clusters, _ = cluster_index.clusters(west, south, east, north, z)
+        rows = [
+            (cluster.get('id'), cluster['latitude'], cluster['longitude'], {'point_count': cluster['count']})
+            for cluster in clusters
+        ]
+
+    px, py, inside = tiles.tile_points(z, x, y, [float(row[1]) for row in rows], [float(row[2]) for row in rows])
+    return [(row[0], px[i], py[i], row[3]) for i, row in enumerate(rows) if inside[i]]
+
+@require_http_methods(["GET"])
+def nearest_markers(request):
+    """Return the k markers closest to a point, nearest first"""
+    try:
+        lat = float(request.GET['lat'])
+        lng = float(request.GET['lng'])
+        k = min(int(request.GET.get('k', 5)), NEAREST_MAX_K)
+        if not (-90 <= lat <= 90 and -180 <= lng <= 180) or k < 1:
+            raise ValueError('Out of range')
+    except (KeyError, ValueError):
+        return JsonResponse({'success': False, 'error': 'Invalid lat, lng or k'}, status=400)
+
+    ranked = marker_index.nearest(lat, lng, k)
+    markers = Marker.objects.in_bulk([marker_id for marker_id, distance in ranked])
+
+    markers_data = []
+    for marker_id, distance in ranked:
+        marker = markers.get(marker_id)
+        if marker is None:
+            continue  # Deleted by another worker since this index was built
+        markers_data.append({
+            'id': marker.id,
+            'latitude': float(marker.latitude),
+            'longitude': float(marker.longitude),
+            'title': marker.title,
+            'description': marker.description,
+            'distance_km': round(distance, 3),
+        })
+
+    return JsonResponse({'markers': markers_data})
+
 # ===== TRACKING/NOTIFICATION VIEWS =====
 
 @login_required
@@ -356,6 +695,22 @@ def get_proximity_notifications(request):
     except:
         return JsonResponse({'notifications': []})
 
+@login_required
+async def event_stream(request):
+    """Server-Sent Events stream of notifications and friend positions
+
+    Served only under ASGI. Under WSGI each open page would hold a worker
+    thread forever, so it answers 204, which stops EventSource from
+    reconnecting and makes the dashboard poll instead.
+    """
+    if not isinstance(request, ASGIRequest):
+        return HttpResponse(status=204)
+    user = await request.auser()
+    response = StreamingHttpResponse(stream_events(user.id), content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'
+    return response
+
 @login_required
 @csrf_exempt
 def mark_notification_read(request, notification_id):
@@ -373,52 +728,193 @@ def mark_notification_read(request, notification_id):
             pass
     return JsonResponse({'status': 'success'})
 
+# ===== GEOFENCE VIEWS =====
+
+GEOFENCE_EVENTS_LIMIT = 50
+
+def geofence_data(fence):
+    return {
+        'id': fence.id,
+        'name': fence.name,
+        'shape': fence.shape,
+        'latitude': fence.latitude,
+        'longitude': fence.longitude,
+        'radius_m': fence.radius_m,
+        'vertices': fence.vertices,
+        'dwell_seconds': fence.dwell_seconds,
+        'is_active': fence.is_active,
+        'inside': fence.entered_at is not None,
+    }
+
+@login_required
+@csrf_exempt
+@require_http_methods(["GET", "POST"])
+def geofence_list(request):
+    """List the user's geofences, or create a circle or polygon from a JSON body"""
+    if request.method == 'GET':
+        fences = Geofence.objects.filter(user=request.user).order_by('name', 'id')
+        return JsonResponse({'geofences': [geofence_data(fence) for fence in fences]})
+
+    try:
+        data = json.loads(request.body)
+        fence = Geofence(
+            user=request.user,
+            name=data.get('name', ''),
+            shape=data.get('shape', ''),
+            latitude=data.get('latitude'),
+            longitude=data.get('longitude'),
+            radius_m=data.get('radius_m'),
+            vertices=data.get('vertices') or [],
+            dwell_seconds=data.get('dwell_seconds'),
+        )
+        fence.full_clean()
+    except ValidationError as e:
+        return JsonResponse({'success': False, 'error': '; '.join(e.messages)}, status=400)
+    except (AttributeError, TypeError, ValueError):
+        return JsonResponse({'success': False, 'error': 'Invalid geofence'}, status=400)
+    fence.save()
+
+    # Start from the user's current position, so being inside already counts as entering
+    profile = UserProfile.objects.filter(user=request.user).first()
+    if profile is not None and has_location(profile):
+        geofences.process_fixes([
+            (request.user.id, profile.latitude, profile.longitude, profile.last_location_update)
+        ])
+        fence.refresh_from_db(fields=['entered_at'])
+    return JsonResponse({'success': True, 'geofence': geofence_data(fence)}, status=201)
+
+@login_required
+@csrf_exempt
+@require_http_methods(["DELETE"])
+def delete_geofence(request, geofence_id):
+    """Delete one of the user's geofences along with its events"""
+    deleted, _ = Geofence.objects.filter(id=geofence_id, user=request.user).delete()
+    if not deleted:
+        return JsonResponse({'success': False, 'error': 'Geofence not found'}, status=404)
+    return JsonResponse({'success': True})
+
+@login_required
+def geofence_events(request):
+    """Recent enter/exit/dwell events for the user's geofences, newest first"""
+    events = GeofenceEvent.objects.filter(user=request.user).select_related('geofence')
+    if request.GET.get('unread'):
+        events = events.filter(is_read=False)
+    return JsonResponse({'events': [
+        {
+            'id': event.id,
+            'geofence_id': event.geofence_id,
+            'name': event.geofence.name,
+            'event': event.event,
+            'message': event.message,
+            'latitude': event.latitude,
+            'longitude': event.longitude,
+            'occurred_at': event.occurred_at.isoformat(),
+            'is_read': event.is_read,
+        }
+        for event in events.order_by('-created_at', '-id')[:GEOFENCE_EVENTS_LIMIT]
+    ]})
+
 # ===== HELPER FUNCTIONS =====
 
-def check_proximity_alerts(user):
-    """Check if user is near any friends and send notifications"""
+def record_location(user, latitude, longitude, captured_at=None):
+    """Apply a fix to the user's profile, through the write-behind buffer when enabled"""
+    if settings.LOCATION_WRITE_BEHIND:
+        # Acknowledge now; the buffer persists the latest fix and runs proximity checks
+        location_buffer.submit(user.id, latitude, longitude, captured_at)
+        return
+
+    # Proximity and geofence checks run from the location_moved receiver in signals.py
+    profile, created = UserProfile.objects.get_or_create(user=user)
+    profile.update_location(latitude, longitude, captured_at)
+
+def parse_location_fixes(request):
+    """Decode a batch body: NDJSON, a JSON array, or {"fixes": [...]}"""
+    if request.content_type in ('application/x-ndjson', 'application/ndjson'):
+        return [json.loads(line) for line in request.body.splitlines() if line.strip()]
+    data = json.loads(request.body)
+    return data.get('fixes') if isinstance(data, dict) else data
+
+def parse_location_fix(fix):
+    """Validate one batch fix; returns (latitude, longitude, accuracy_m, captured_at)"""
+    latitude = float(fix['latitude'])
+    longitude = float(fix['longitude'])
+    if not (-90 <= latitude <= 90 and -180 <= longitude <= 180):
+        raise ValueError('Coordinates out of range')
+
+    accuracy = fix.get('accuracy')
+    accuracy_m = None
+    if accuracy is not None:
+        accuracy = float(accuracy)
+        if not 0 <= accuracy <= LOCATION_ACCURACY_MAX_M:  # Also rejects nan and inf
+            raise ValueError(f'Accuracy must be between 0 and {LOCATION_ACCURACY_MAX_M} metres')
+        accuracy_m = int(round(accuracy))
+
+    captured_at = parse_timestamp(fix['timestamp'])
+    if captured_at > timezone.now() + timedelta(minutes=5):
+        raise ValueError('Timestamp is in the future')
+
+    return latitude, longitude, accuracy_m, captured_at
+
+def parse_timestamp(timestamp):
+    """Parse an ISO 8601 string or epoch seconds/milliseconds into an aware datetime"""
+    if isinstance(timestamp, str):
+        try:
+            timestamp = float(timestamp)
+        except ValueError:
+            pass
+    if isinstance(timestamp, (int, float)):
+        # Epoch seconds, or milliseconds as reported by the browser Geolocation API
+        try:
+            return datetime.fromtimestamp(timestamp / 1000 if timestamp > 1e11 else timestamp, tz=dt_timezone.utc)
+        except (OSError, OverflowError):
+            raise ValueError('Timestamp out of range')
+    parsed = parse_datetime(timestamp)
+    if parsed is None:
+        raise ValueError('Invalid timestamp')
+    if timezone.is_naive(parsed):
+        parsed = timezone.make_aware(parsed, dt_timezone.utc)
+    return parsed
+
+STREAM_CHUNKS_PER_STEP = 64
+
+def streaming_response(request, chunks, **kwargs):
+    """StreamingHttpResponse for a sync iterator that stays streamed under ASGI
+
+    Django serves a sync iterator from ASGI by reading it whole with
+    sync_to_async(list) first. Under ASGI it is read STREAM_CHUNKS_PER_STEP
+    chunks at a time instead, each step on the thread that ran the view.
+    """
+    if isinstance(request, ASGIRequest):
+        chunks = iterate_in_steps(iter(chunks))
+    return StreamingHttpResponse(chunks, **kwargs)
+
+async def iterate_in_steps(chunks):
+    next_step = sync_to_async(lambda: list(islice(chunks, STREAM_CHUNKS_PER_STEP)))
     try:
-        user_profile = user.userprofile
-        if not (user_profile.latitude and user_profile.longitude and 
-                user_profile.proximity_notifications_enabled):
-            return
-        
-        # Get active proximity alerts for this user
-        alerts = ProximityAlert.objects.filter(
-            user=user, 
-            is_active=True
-        ).select_related('friend', 'friend__userprofile')
-        
-        for alert in alerts:
-            friend_profile = alert.friend.userprofile
-            
-            if not (friend_profile.latitude and friend_profile.longitude and 
-                    friend_profile.location_sharing_enabled):
-                continue
-            
-            distance = user_profile.get_distance_to(friend_profile)
-            
-            if distance and distance <= alert.distance_threshold:
-                # Check if we already sent a notification recently
-                recent_notification = ProximityNotification.objects.filter(
-                    user=user,
-                    friend=alert.friend,
-                    created_at__gte=timezone.now() - timezone.timedelta(minutes=30)
-                ).exists()
-                
-                if not recent_notification:
-                    ProximityNotification.objects.create(
-                        user=user,
-                        friend=alert.friend,
-                        distance=round(distance, 2),
-                        message=f"{alert.friend.username} is {round(distance, 2)}km away from you!"
-                    )
-                    
-                    alert.last_triggered = timezone.now()
-                    alert.save()
-    
-    except:
-        pass  # User profile doesn't exist yet
+        while step := await next_step():
+            for chunk in step:
+                yield chunk
+    finally:
+        if hasattr(chunks, 'close'):
+            await sync_to_async(chunks.close)()
+
+@staff_member_required
+def location_buffer_metrics(request):
+    """Expose write-behind buffer counters and flush lag"""
+    return JsonResponse(location_buffer.metrics())
+
+def metrics(request):
+    """Per-view request metrics as Prometheus text, or JSON with recent slow-request profiles"""
+    token = settings.REQUEST_METRICS_TOKEN
+    authorized = request.user.is_active and request.user.is_staff
+    if token and not authorized:
+        authorized = hmac.compare_digest(request.headers.get('Authorization', ''), f'Bearer {token}')
+    if not authorized:
+        return JsonResponse({'success': False, 'error': 'Staff or metrics token required'}, status=403)
+
+    if request.GET.get('format') == 'json':
+        return JsonResponse(request_metrics.snapshot())
+    return HttpResponse(request_metrics.prometheus(), content_type='text/plain; version=0.0.4')
 
 # ===== PLACEHOLDER VIEWS FOR OPTIONAL FEATURES =====
 
@@ -10,6 +10,7 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/5.2/ref/settings/
 """
 
+import os
 from pathlib import Path
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -41,11 +42,13 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'MyApp.instrumentation.RequestMetricsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'MyApp.routers.ReplicaRoutingMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
@@ -76,10 +79,58 @@ WSGI_APPLICATION = 'WebScanner.wsgi.application'
 DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
-        'NAME': BASE_DIR / 'db.sqlite3',
+        'NAME': os.environ.get('GEOMAP_DB_NAME', BASE_DIR / 'db.sqlite3'),
     }
 }
 
+# Set GEOMAP_DB_PROFILE=production to tune SQLite for concurrent writers:
+# WAL lets readers and the single writer proceed without blocking each
+# other, IMMEDIATE transactions take the write lock up front so busy_timeout
+# can wait for it instead of failing with "database is locked", and
+# persistent connections run the pragmas once per connection rather than
+# per request. See `manage.py benchmark_sqlite` for the difference it makes.
+
+DB_PROFILE = os.environ.get('GEOMAP_DB_PROFILE', 'development')
+
+SQLITE_PRODUCTION_PRAGMAS = [
+    'PRAGMA journal_mode=WAL',
+    'PRAGMA synchronous=NORMAL',  # Durable at checkpoints; safe with WAL
+    'PRAGMA busy_timeout=5000',
+    'PRAGMA cache_size=-65536',  # 64 MiB page cache per connection
+    'PRAGMA mmap_size=268435456',  # 256 MiB
+    'PRAGMA temp_store=MEMORY',
+]
+
+if DB_PROFILE == 'production':
+    DATABASES['default'].update({
+        'CONN_MAX_AGE': 600,
+        'CONN_HEALTH_CHECKS': True,
+        'OPTIONS': {
+            'init_command': ';'.join(SQLITE_PRODUCTION_PRAGMAS),
+            'transaction_mode': 'IMMEDIATE',
+            'timeout': 5,
+        },
+    })
+
+# Read replica
+# Set GEOMAP_REPLICA_NAME to a SQLite file kept in sync with the primary
+# (e.g. by Litestream or a periodic backup) to serve reads from GET requests
+# there. Writes always go to the primary, and a session that wrote reads
+# from the primary for REPLICA_STICKY_SECONDS afterwards. Without it the
+# replica alias points at the primary and is never routed to.
+
+DATABASES['replica'] = {
+    **DATABASES['default'],
+    'NAME': os.environ.get('GEOMAP_REPLICA_NAME', DATABASES['default']['NAME']),
+    'TEST': {'NAME': BASE_DIR / 'test_replica.sqlite3'},
+}
+
+DATABASE_ROUTERS = ['MyApp.routers.PrimaryReplicaRouter']
+
+REPLICA_READS = bool(os.environ.get('GEOMAP_REPLICA_NAME'))
+
+REPLICA_STICKY_SECONDS = 10
+
 
 # Password validation
 # https://docs.djangoproject.com/en/5.2/ref/settings/#auth-password-validators
@@ -117,6 +168,63 @@ USE_TZ = True
 
 STATIC_URL = 'static/'
 
+# Location updates
+# update_location queues fixes in an in-process write-behind buffer that
+# coalesces the latest fix per user and flushes them with bulk_update.
+# Set LOCATION_FLUSH_INTERVAL to 0 to flush only when flush() is called.
+
+LOCATION_WRITE_BEHIND = True
+
+LOCATION_FLUSH_INTERVAL = 2.0  # seconds
+
+# A fix closer than LOCATION_MIN_MOVE_M to the stored position is not written,
+# except to refresh last_location_update every LOCATION_HEARTBEAT_SECONDS.
+# Real moves send the location_moved signal, which runs proximity checks.
+
+LOCATION_MIN_MOVE_M = 25
+
+LOCATION_HEARTBEAT_SECONDS = 300
+
+# Location history retention (python manage.py compact_locations)
+# Raw UserLocation fixes older than LOCATION_RAW_RETENTION_DAYS are simplified
+# into one LocationTrack per user per UTC day and then deleted. Tracks older
+# than LOCATION_TRACK_RETENTION_DAYS are deleted too; None keeps them forever.
+
+LOCATION_RAW_RETENTION_DAYS = 7
+
+LOCATION_TRACK_RETENTION_DAYS = None
+
+LOCATION_SIMPLIFY_TOLERANCE_M = 10
+
+# Clearing all markers deletes them in small primary-key ranges from a
+# background thread so other writers are not locked out for the duration.
+
+MARKER_CLEAR_IN_BACKGROUND = True
+
+# Live events
+# Every process serving /myapp/events/ streams lists its users in EventRelay
+# and tails the LiveEvent outbox every EVENT_RELAY_INTERVAL seconds. Events
+# for users served by another process, e.g. from the sweep commands, are
+# written to the outbox after commit; nothing is written when no other
+# process serves them. Set it to 0 to deliver only within the publishing process.
+
+EVENT_RELAY_INTERVAL = 1.0  # seconds
+
+# Request instrumentation
+# RequestMetricsMiddleware keeps per-view latency histograms, query counts and
+# times and response sizes in memory, served at /metrics (Prometheus text, or
+# JSON with ?format=json) to staff or with the GEOMAP_METRICS_TOKEN bearer
+# token. Set REQUEST_PROFILE_THRESHOLD_MS to run a sampled fraction of
+# requests under cProfile and keep the profiles of those slower than that.
+
+REQUEST_METRICS = True
+
+REQUEST_PROFILE_THRESHOLD_MS = None
+
+REQUEST_PROFILE_SAMPLE_RATE = 0.05
+
+REQUEST_METRICS_TOKEN = os.environ.get('GEOMAP_METRICS_TOKEN', '')
+
 # Default primary key field type
 # https://docs.djangoproject.com/en/5.2/ref/settings/#default-auto-field
 
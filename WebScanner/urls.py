@@ -2,6 +2,8 @@ from django.contrib import admin
 from django.urls import path, include
 from django.shortcuts import render, redirect
 
+from MyApp.views import metrics
+
 def home(request):
     if request.user.is_authenticated:
         return redirect('MyApp:dashboard')
@@ -17,4 +19,5 @@ urlpatterns = [
     path('map/', map_view, name='map_view'),  # Add this line
     path('myapp/', include('MyApp.urls')),
     path('accounts/', include('django.contrib.auth.urls')),
+    path('metrics', metrics, name='metrics'),
 ]
\ No newline at end of file